@@ -0,0 +1,82 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+class _ClientSlot:
+    __slots__ = ("busy", "pending")
+
+    def __init__(self):
+        self.busy = False
+        self.pending: Optional[asyncio.Future] = None
+
+
+class FrameAdmission:
+    """
+    Per-client admission in front of inference. A client has at most one
+    frame in flight plus the newest frame waiting behind it; when another
+    frame arrives the waiting one is dropped, so a slow backend only ever
+    spends inference on the freshest frame instead of a backlog.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, _ClientSlot] = {}
+        self.served = 0
+        self.queued = 0
+        self.dropped = 0
+
+    async def run(self, key: str, work: Callable[[], Awaitable[Any]]) -> Tuple[bool, Any]:
+        """
+        Runs `work` for client `key` once it is admitted.
+        Returns (True, result) when served, (False, None) when the frame was
+        superseded by a newer one before it got its turn.
+        """
+        slot = self._clients.get(key)
+        if slot is None:
+            slot = self._clients[key] = _ClientSlot()
+
+        if slot.busy:
+            if slot.pending is not None and not slot.pending.done():
+                slot.pending.set_result(False)
+                self.dropped += 1
+            turn = asyncio.get_running_loop().create_future()
+            slot.pending = turn
+            self.queued += 1
+            if not await turn:
+                return False, None
+        else:
+            slot.busy = True
+
+        try:
+            result = await work()
+            self.served += 1
+            return True, result
+        finally:
+            self._handoff(key, slot)
+
+    def _handoff(self, key: str, slot: _ClientSlot):
+        nxt, slot.pending = slot.pending, None
+        if nxt is not None and not nxt.done():
+            # The waiting frame inherits the busy slot
+            nxt.set_result(True)
+            return
+        slot.busy = False
+        if self._clients.get(key) is slot:
+            del self._clients[key]
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "served": self.served,
+            "queued": self.queued,
+            "dropped": self.dropped,
+        }
+
+
+_admission: Optional[FrameAdmission] = None
+
+
+def get_frame_admission() -> FrameAdmission:
+    global _admission
+    if _admission is None:
+        _admission = FrameAdmission()
+    return _admission
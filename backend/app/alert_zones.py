@@ -0,0 +1,212 @@
+"""
+Alert-zone rule for drivers approaching a crosswalk, evaluated over columns
+(distance, speed, ts, previously active distance) with NumPy so every driver
+of a crosswalk, or of many crosswalks at once, is handled in one pass.
+
+Run `python -m app.alert_zones` from backend/ for a microbenchmark against
+the per-driver loop.
+"""
+import argparse
+import math
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.state import DEBOUNCE_MIN_DISTANCE_DELTA, DRIVER_PRESENCE_TTL
+
+MIN_ALERT_SPEED_MPS = 1.0
+DRIVER_REACTION_TIME_S = 1.5
+AVG_DECELERATION_MPS2 = 6.0
+SAFETY_BUFFER_M = 20
+OUTER_ALERT_TIME_FACTOR = 2.5
+
+nan = math.nan
+
+
+class ZoneMasks(NamedTuple):
+    """Per-driver boolean masks; see evaluate_zones."""
+    expired: np.ndarray
+    outer_trigger: np.ndarray
+    driver_critical: np.ndarray
+    alert_end: np.ndarray
+
+
+class CrosswalkZones(NamedTuple):
+    sids: List[str]
+    masks: ZoneMasks
+    nearest: Optional[str]  # sid of the closest outer-zone driver, if any
+
+
+def driver_columns(
+    drivers_map: Dict[str, Dict[str, Any]], active_map: Dict[str, float]
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Unpacks a crosswalk's drivers into (sids, distance, speed, ts, prev_active)
+    float64 columns. Missing distance/speed/previous values become NaN and a
+    missing ts becomes 0, matching how the rule treats them.
+    """
+    sids = list(drivers_map.keys())
+    infos = drivers_map.values()
+    # Lists of plain floats convert far faster than lists containing None
+    distance = np.array([nan if (v := i.get("distance")) is None else v for i in infos], dtype=np.float64)
+    speed = np.array([nan if (v := i.get("speed")) is None else v for i in infos], dtype=np.float64)
+    ts = np.array([i.get("ts", 0) for i in infos], dtype=np.float64)
+    prev = np.array([nan if (v := active_map.get(s)) is None else v for s in sids], dtype=np.float64)
+    return sids, distance, speed, ts, prev
+
+
+def evaluate_zones(
+    distance: np.ndarray,
+    speed: np.ndarray,
+    ts: np.ndarray,
+    prev_active: np.ndarray,
+    has_peds: Any,
+    now: float,
+) -> ZoneMasks:
+    """
+    expired:         not seen for DRIVER_PRESENCE_TTL, drop the driver.
+    outer_trigger:   inside the outer zone while peds wait (ped_critical).
+    driver_critical: inside the inner zone and either newly so or moved by
+                     at least the debounce delta, so (re)send driver_critical.
+    alert_end:       was active but has left the inner zone (or peds left).
+    Drivers without a distance or slower than MIN_ALERT_SPEED_MPS keep their
+    previous state. `has_peds` is a bool or a per-driver bool array.
+    """
+    expired = ts < now - DRIVER_PRESENCE_TTL
+    with np.errstate(invalid="ignore"):
+        moving = ~expired & ~np.isnan(distance) & (speed > MIN_ALERT_SPEED_MPS)
+        inner = speed * DRIVER_REACTION_TIME_S + (speed * speed) / (2.0 * AVG_DECELERATION_MPS2) + SAFETY_BUFFER_M
+        outer = inner * OUTER_ALERT_TIME_FACTOR
+        outer_trigger = moving & has_peds & (distance <= outer)
+        active = moving & has_peds & (distance <= inner)
+        was_active = ~np.isnan(prev_active)
+        moved = ~was_active | (np.abs(prev_active - distance) >= DEBOUNCE_MIN_DISTANCE_DELTA)
+    return ZoneMasks(
+        expired=expired,
+        outer_trigger=outer_trigger,
+        driver_critical=active & moved,
+        alert_end=moving & ~active & was_active,
+    )
+
+
+def evaluate_crosswalks(
+    crosswalks: Sequence[Tuple[Dict[str, Dict[str, Any]], Dict[str, float], int]], now: float
+) -> List[CrosswalkZones]:
+    """
+    Evaluates many crosswalks, given as (drivers_map, active_map, ped_count),
+    with a single evaluate_zones call over the concatenated driver columns.
+    """
+    columns = [driver_columns(drivers, active) for drivers, active, _ in crosswalks]
+    counts = np.array([len(c[0]) for c in columns], dtype=np.intp)
+    if counts.sum() == 0:
+        empty = ZoneMasks(*(np.zeros(0, dtype=bool) for _ in ZoneMasks._fields))
+        return [CrosswalkZones([], empty, None) for _ in crosswalks]
+
+    distance, speed, ts, prev = (np.concatenate([c[i] for c in columns]) for i in range(1, 5))
+    has_peds = np.repeat(np.array([peds > 0 for _, _, peds in crosswalks]), counts)
+    masks = evaluate_zones(distance, speed, ts, prev, has_peds, now)
+
+    # Closest triggering driver per crosswalk: sort triggering drivers by
+    # (crosswalk, distance) and take the first of every crosswalk's run
+    all_sids = [sid for sids, *_ in columns for sid in sids]
+    segment = np.repeat(np.arange(len(crosswalks)), counts)
+    triggering = np.flatnonzero(masks.outer_trigger)
+    order = triggering[np.lexsort((distance[triggering], segment[triggering]))]
+    run_start = np.ones(len(order), dtype=bool)
+    run_start[1:] = segment[order[1:]] != segment[order[:-1]]
+    nearest = np.full(len(crosswalks), -1, dtype=np.intp)
+    nearest[segment[order[run_start]]] = order[run_start]
+
+    results = []
+    start = 0
+    for i, (sids, *_) in enumerate(columns):
+        end = start + len(sids)
+        masks_i = ZoneMasks(*(mask[start:end] for mask in masks))
+        results.append(CrosswalkZones(sids, masks_i, all_sids[nearest[i]] if nearest[i] >= 0 else None))
+        start = end
+    return results
+
+
+def evaluate_zones_scalar(
+    drivers_map: Dict[str, Dict[str, Any]], active_map: Dict[str, float], ped_count: int, now: float
+) -> Tuple[List[str], List[str], List[str], List[str], Optional[str]]:
+    """
+    The per-driver loop evaluate_zones replaces; kept as the reference for
+    parity tests and the benchmark. Returns sid lists for each mask and the
+    nearest triggering sid.
+    """
+    expired, outer, critical, ended = [], [], [], []
+    nearest, nearest_d = None, None
+    for sid, info in drivers_map.items():
+        if info.get("ts", 0) < now - DRIVER_PRESENCE_TTL:
+            expired.append(sid)
+            continue
+        d = info.get("distance")
+        speed = info.get("speed")
+        if d is None or speed is None or speed <= MIN_ALERT_SPEED_MPS:
+            continue
+        inner_alert_distance = speed * DRIVER_REACTION_TIME_S + (speed * speed) / (2.0 * AVG_DECELERATION_MPS2) + SAFETY_BUFFER_M
+        if ped_count > 0 and d <= inner_alert_distance * OUTER_ALERT_TIME_FACTOR:
+            outer.append(sid)
+            if nearest_d is None or d < nearest_d:
+                nearest, nearest_d = sid, d
+        prev = active_map.get(sid)
+        if ped_count > 0 and d <= inner_alert_distance:
+            if prev is None or abs(prev - d) >= DEBOUNCE_MIN_DISTANCE_DELTA:
+                critical.append(sid)
+        elif prev is not None:
+            ended.append(sid)
+    return expired, outer, critical, ended, nearest
+
+
+def random_crosswalks(n_crosswalks: int, n_drivers: int, now: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    crosswalks = []
+    for c in range(n_crosswalks):
+        drivers, active = {}, {}
+        for d in range(n_drivers):
+            sid = f"c{c}d{d}"
+            drivers[sid] = {
+                "distance": None if rng.random() < 0.05 else float(rng.uniform(0, 250)),
+                "speed": None if rng.random() < 0.05 else float(rng.uniform(0, 20)),
+                "ts": now - float(rng.uniform(0, 2 * DRIVER_PRESENCE_TTL)),
+            }
+            if rng.random() < 0.3:
+                active[sid] = float(rng.uniform(0, 250))
+        crosswalks.append((drivers, active, int(rng.integers(0, 3))))
+    return crosswalks
+
+
+def _bench(fn, repeat):
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vectorized vs per-driver alert-zone evaluation")
+    parser.add_argument("--crosswalks", type=int, default=50)
+    parser.add_argument("--drivers", type=int, default=200, help="drivers per crosswalk")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    now = time.time()
+    crosswalks = random_crosswalks(args.crosswalks, args.drivers, now)
+    scalar = _bench(lambda: [evaluate_zones_scalar(d, a, p, now) for d, a, p in crosswalks], args.repeat)
+    per_cw = _bench(lambda: [evaluate_crosswalks([cw], now) for cw in crosswalks], args.repeat)
+    batched = _bench(lambda: evaluate_crosswalks(crosswalks, now), args.repeat)
+    columns = [np.concatenate(c) for c in zip(*(driver_columns(d, a)[1:] for d, a, _ in crosswalks))]
+    has_peds = np.repeat([p > 0 for _, _, p in crosswalks], args.drivers)
+    kernel = _bench(lambda: evaluate_zones(*columns, has_peds, now), args.repeat)
+    total = args.crosswalks * args.drivers
+    for label, seconds in (
+        ("scalar loop", scalar),
+        ("numpy per crosswalk", per_cw),
+        ("numpy batched", batched),
+        ("numpy kernel only", kernel),
+    ):
+        print(f"{label:>20}: {seconds * 1e3:8.3f} ms  ({seconds / total * 1e9:7.1f} ns/driver)")
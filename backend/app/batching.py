@@ -0,0 +1,150 @@
+import asyncio
+import os
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from prediction import predictImagesAreCrosswalk
+from app.inference_pool import InferenceOverloaded, InferencePool, get_inference_pool
+
+PREDICT_MAX_BATCH_SIZE = int(os.getenv("PREDICT_MAX_BATCH_SIZE", "8"))
+PREDICT_MAX_WAIT_MS = float(os.getenv("PREDICT_MAX_WAIT_MS", "10"))
+PREDICT_MAX_QUEUED_FRAMES = int(os.getenv("PREDICT_MAX_QUEUED_FRAMES", "64"))
+
+
+class PredictionBatcher:
+    """
+    Collects frames submitted by concurrent `predict` events for up to
+    `max_wait` seconds (or until `max_batch_size` frames are pending),
+    runs them through `predict_batch` in one call and resolves every
+    caller's future with its own result.
+
+    Batches are executed on `pool` (one batch per pool worker at a time);
+    while all workers are busy new frames keep accumulating into the next
+    batch. Without a pool, batches run one at a time in a helper thread.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[Any]], List[Any]],
+        pool: Optional[InferencePool] = None,
+        max_batch_size: int = PREDICT_MAX_BATCH_SIZE,
+        max_wait: float = PREDICT_MAX_WAIT_MS / 1000.0,
+        max_queued: int = PREDICT_MAX_QUEUED_FRAMES,
+    ):
+        self._predict_batch = predict_batch
+        self._pool = pool
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self.max_queued = max(1, max_queued)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.frames = 0
+        self.rejected = 0
+
+    async def submit(self, frame: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._queue.qsize() >= self.max_queued:
+            self.rejected += 1
+            raise InferenceOverloaded("prediction queue is full")
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((frame, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _execute(self, frames: List[Any]) -> List[Any]:
+        if self._pool is None:
+            return await asyncio.to_thread(self._predict_batch, frames)
+        return await self._pool.run(self._predict_batch, frames)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        frames = [frame for frame, _ in batch]
+        try:
+            outcomes = await self._execute(frames)
+            if len(outcomes) != len(batch):
+                raise RuntimeError("batch result size mismatch")
+        except Exception as e:
+            outcomes = [e] * len(batch)
+        self.batches += 1
+        self.frames += len(batch)
+        for (_, future), outcome in zip(batch, outcomes):
+            if future.done():
+                continue
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self._pool.workers if self._pool is not None else 1)
+        while True:
+            # Only start collecting once a worker is free, so frames that
+            # arrive while the pool is busy are merged into the next batch.
+            await slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                slots.release()
+                raise
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._inflight.add(task)
+
+            def _done(t, slots=slots):
+                self._inflight.discard(t)
+                slots.release()
+
+            task.add_done_callback(_done)
+
+    async def close(self):
+        tasks = list(self._inflight)
+        if self._task is not None and not self._task.done():
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._inflight.clear()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "frames": self.frames,
+            "pending": self._queue.qsize() if self._queue is not None else 0,
+            "rejected": self.rejected,
+        }
+
+
+_batcher: Optional[PredictionBatcher] = None
+
+
+def get_prediction_batcher() -> PredictionBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = PredictionBatcher(predictImagesAreCrosswalk, pool=get_inference_pool())
+    return _batcher
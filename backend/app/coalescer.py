@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.notifications import EVALUATION_RETRY_S, handle_distance_based_notifications
+from app.prune import get_scheduler
+from app.state import CrosswalkView
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_COALESCE_TICK = float(os.getenv("NOTIFY_COALESCE_TICK", "0.25"))
+
+
+class _CrosswalkSlot:
+    __slots__ = ("dirty", "task", "view")
+
+    def __init__(self):
+        self.dirty = False
+        self.task: Optional[asyncio.Task] = None
+        self.view: Optional[CrosswalkView] = None
+
+
+class EvaluationCoalescer:
+    """
+    Runs at most one notification evaluation per crosswalk per `tick`.
+    The first change to an idle crosswalk is evaluated right away; changes
+    arriving while it runs, or within `tick` after it, only mark the
+    crosswalk dirty and are folded into one follow-up evaluation. Replaces
+    the Firestore `runtime` marker per event with in-process bookkeeping.
+    The newest view passed to `mark` is handed to that evaluation.
+    The deadline an evaluation returns (its oldest driver's expiry, or a
+    retry time when it could not complete) is passed to `reschedule`; an
+    evaluation that raises is rescheduled EVALUATION_RETRY_S later.
+    """
+
+    def __init__(
+        self,
+        evaluate: Callable[[int, Optional[CrosswalkView]], Awaitable],
+        tick: float = NOTIFY_COALESCE_TICK,
+        reschedule: Optional[Callable[[int, float], None]] = None,
+    ):
+        self._evaluate = evaluate
+        self._reschedule = reschedule
+        self.tick = tick
+        self._slots: Dict[int, _CrosswalkSlot] = {}
+        self.marked = 0
+        self.merged = 0
+        self.evaluations = 0
+        self.failed = 0
+
+    def mark(self, crosswalk_id: int, view: Optional[CrosswalkView] = None):
+        self.marked += 1
+        slot = self._slots.get(crosswalk_id)
+        if slot is None:
+            slot = self._slots[crosswalk_id] = _CrosswalkSlot()
+        elif slot.dirty:
+            self.merged += 1
+        slot.dirty = True
+        if view is not None:
+            slot.view = view
+        if slot.task is None:
+            slot.task = asyncio.get_running_loop().create_task(self._drain(crosswalk_id, slot))
+
+    async def _drain(self, crosswalk_id: int, slot: _CrosswalkSlot):
+        try:
+            while slot.dirty:
+                slot.dirty = False
+                view, slot.view = slot.view, None
+                try:
+                    deadline = await self._evaluate(crosswalk_id, view)
+                except Exception:
+                    logger.exception("Evaluation of crosswalk %s failed", crosswalk_id)
+                    deadline = time.time() + EVALUATION_RETRY_S
+                    self.failed += 1
+                self.evaluations += 1
+                if deadline is not None and self._reschedule is not None:
+                    self._reschedule(crosswalk_id, deadline)
+                # Marks during the evaluation or this pause merge into the next run
+                await asyncio.sleep(self.tick)
+        finally:
+            if self._slots.get(crosswalk_id) is slot:
+                del self._slots[crosswalk_id]
+
+    async def close(self):
+        tasks = [slot.task for slot in self._slots.values() if slot.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "crosswalks": len(self._slots),
+            "marked": self.marked,
+            "merged": self.merged,
+            "evaluations": self.evaluations,
+            "failed": self.failed,
+        }
+
+
+_coalescer: Optional[EvaluationCoalescer] = None
+
+
+def get_coalescer() -> EvaluationCoalescer:
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = EvaluationCoalescer(
+            handle_distance_based_notifications,
+            reschedule=lambda crosswalk_id, deadline: get_scheduler().schedule(crosswalk_id, deadline),
+        )
+    return _coalescer
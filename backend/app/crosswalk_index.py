@@ -0,0 +1,546 @@
+"""
+In-memory spatial index of OSM crosswalks for `nearby_crosswalks` queries.
+
+Loaded once from an offline Overpass JSON extract (`out geom` output) of
+`highway=crossing` nodes and `footway=crossing` ways, so clients no longer
+query Overpass themselves. Every crosswalk contributes one point (a node)
+or its geometry points (a way). Crosswalks are sorted by the fixed-size
+grid cell of their centroid, with their points stored contiguously, so a
+radius query is one binary search per grid row plus a vectorized haversine
+over the few candidates.
+
+For production the extract is prebuilt offline into a compact file that is
+memory-mapped at startup (no JSON parsing, one page-cache copy shared by
+all workers):
+
+    python -m app.crosswalk_index build crossings.json crossings.cwx
+    CROSSWALK_DATA_PATH=crossings.cwx uvicorn main:app --workers 4
+
+`python -m app.crosswalk_index query` benchmarks queries and
+`python -m app.crosswalk_index load` compares per-worker load time and
+memory of the JSON and compact formats.
+"""
+import argparse
+import json
+import math
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+CROSSWALK_DATA_PATH = os.getenv("CROSSWALK_DATA_PATH", "")
+CROSSWALK_INDEX_CELL_M = float(os.getenv("CROSSWALK_INDEX_CELL_M", "250"))
+CROSSWALK_MAX_RADIUS_M = float(os.getenv("CROSSWALK_MAX_RADIUS_M", "1000"))
+
+EARTH_RADIUS_M = 6_371_008.8
+M_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180
+KIND_NODE, KIND_WAY = 0, 1
+_COL_OFFSET = 1 << 31
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters; works on scalars and NumPy arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class NearbyCrosswalk(NamedTuple):
+    id: int
+    lat: float  # closest point of the crosswalk
+    lon: float
+    distance: float
+    kind: str  # "node" or "way"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+class CrosswalkIndex:
+    """
+    Grid index over crosswalks. `ids`, `kinds` and `keys` are per-crosswalk
+    columns ordered by the grid cell (`keys`) of each crosswalk's centroid;
+    the points of crosswalk i are `lats`/`lons[offsets[i]:offsets[i + 1]]`.
+    No point lies further than `extent_m` from its crosswalk's centroid, so
+    a query widened by `extent_m` finds every crosswalk by its cell.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        kinds: np.ndarray,
+        keys: np.ndarray,
+        offsets: np.ndarray,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        cell_m: float,
+        ref_lat: float,
+        extent_m: float,
+        buffer: Optional[mmap.mmap] = None,
+    ):
+        self.ids = ids
+        self.kinds = kinds
+        self.keys = keys
+        self.offsets = offsets
+        self.lats = lats
+        self.lons = lons
+        self.cell_m = cell_m
+        self.ref_lat = ref_lat
+        self.extent_m = extent_m
+        self.cell_lat, self.cell_lon = _cell_size(cell_m, ref_lat)
+        # Keeps the mapping alive for as long as the arrays are in use
+        self._buffer = buffer
+
+    @classmethod
+    def from_points(
+        cls,
+        ids,
+        lats,
+        lons,
+        kinds,
+        cell_m: float = CROSSWALK_INDEX_CELL_M,
+        ref_lat: Optional[float] = None,
+    ) -> "CrosswalkIndex":
+        """Builds the index from per-point columns; a way lists one entry per geometry point."""
+        ids = np.asarray(ids, dtype=np.int64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        kinds = np.asarray(kinds, dtype=np.int8)
+        if ref_lat is None:
+            ref_lat = float(np.mean(lats)) if len(lats) else 0.0
+
+        # Group points by crosswalk, keeping each crosswalk's point order
+        unique, first, owner = np.unique(ids, return_index=True, return_inverse=True)
+        grouped = np.argsort(owner, kind="stable")
+        owner, lats, lons = owner[grouped], lats[grouped], lons[grouped]
+        counts = np.bincount(owner, minlength=len(unique))
+        starts = np.cumsum(counts) - counts
+        center_lat = np.bincount(owner, lats, len(unique)) / np.maximum(counts, 1)
+        center_lon = np.bincount(owner, lons, len(unique)) / np.maximum(counts, 1)
+        extent_m = float(haversine_m(center_lat[owner], center_lon[owner], lats, lons).max()) if len(lats) else 0.0
+
+        cell_lat, cell_lon = _cell_size(cell_m, ref_lat)
+        keys = _grid_keys(center_lat, center_lon, cell_lat, cell_lon)
+        order = np.argsort(keys, kind="stable")
+        offsets = np.zeros(len(unique) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts[order])
+        points = _ranges(starts[order], counts[order])
+        return cls(
+            unique[order], kinds[first][order], keys[order], offsets,
+            lats[points], lons[points], cell_m, ref_lat, extent_m,
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def points(self) -> int:
+        return len(self.lats)
+
+    @property
+    def point_ids(self) -> np.ndarray:
+        return np.repeat(self.ids, np.diff(self.offsets))
+
+    def _candidates(self, lat: float, lon: float, radius_m: float) -> np.ndarray:
+        dlat = radius_m / M_PER_DEG_LAT
+        dlon = radius_m / (M_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        row0, row1 = np.floor(np.array([lat - dlat, lat + dlat]) / self.cell_lat).astype(np.int64)
+        col0, col1 = np.floor(np.array([lon - dlon, lon + dlon]) / self.cell_lon).astype(np.int64) + _COL_OFFSET
+        rows = np.arange(row0, row1 + 1, dtype=np.int64) * (1 << 32)
+        starts = np.searchsorted(self.keys, rows + col0, side="left")
+        ends = np.searchsorted(self.keys, rows + col1, side="right")
+        spans = [np.arange(s, e) for s, e in zip(starts, ends) if e > s]
+        return np.concatenate(spans) if spans else np.empty(0, dtype=np.int64)
+
+    def _candidates_many(self, lats: np.ndarray, lons: np.ndarray, radii: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """`_candidates` for many queries at once: (query index, crosswalk row) pairs."""
+        dlat = radii / M_PER_DEG_LAT
+        dlon = radii / (M_PER_DEG_LAT * np.maximum(np.cos(np.radians(lats)), 1e-6))
+        row0 = np.floor((lats - dlat) / self.cell_lat).astype(np.int64)
+        row1 = np.floor((lats + dlat) / self.cell_lat).astype(np.int64)
+        col0 = np.floor((lons - dlon) / self.cell_lon).astype(np.int64) + _COL_OFFSET
+        col1 = np.floor((lons + dlon) / self.cell_lon).astype(np.int64) + _COL_OFFSET
+        # One (query, grid row) span per row each query covers
+        rows_per_query = row1 - row0 + 1
+        span_query = np.repeat(np.arange(len(lats), dtype=np.int64), rows_per_query)
+        rows = row0[span_query] + _ranges(np.zeros(len(lats), dtype=np.int64), rows_per_query)
+        starts = np.searchsorted(self.keys, rows * (1 << 32) + col0[span_query], side="left")
+        ends = np.searchsorted(self.keys, rows * (1 << 32) + col1[span_query], side="right")
+        lengths = np.maximum(ends - starts, 0)
+        return np.repeat(span_query, lengths), _ranges(starts, lengths)
+
+    def query(self, lat: float, lon: float, radius_m: float, limit: Optional[int] = None) -> List[NearbyCrosswalk]:
+        """Crosswalks with any point within `radius_m` of (lat, lon), nearest first."""
+        radius_m = min(max(radius_m, 0.0), CROSSWALK_MAX_RADIUS_M)
+        cand = self._candidates(lat, lon, radius_m + self.extent_m)
+        if len(cand) == 0:
+            return []
+        counts = self.offsets[cand + 1] - self.offsets[cand]
+        idx = _ranges(self.offsets[cand], counts)
+        owner = np.repeat(np.arange(len(cand)), counts)
+        distance = haversine_m(lat, lon, self.lats[idx], self.lons[idx])
+        # Closest point per crosswalk: order by (crosswalk, distance), keep each crosswalk's first
+        order = np.lexsort((distance, owner))
+        idx, owner, distance = idx[order], owner[order], distance[order]
+        first = np.ones(len(idx), dtype=bool)
+        first[1:] = owner[1:] != owner[:-1]
+        idx, cand, distance = idx[first], cand[owner[first]], distance[first]
+        inside = distance <= radius_m
+        idx, cand, distance = idx[inside], cand[inside], distance[inside]
+        order = np.argsort(distance, kind="stable")[:limit]
+        return [
+            NearbyCrosswalk(
+                int(self.ids[c]),
+                float(self.lats[i]),
+                float(self.lons[i]),
+                float(d),
+                "way" if self.kinds[c] == KIND_WAY else "node",
+            )
+            for i, c, d in zip(idx[order], cand[order], distance[order])
+        ]
+
+    def nearest_points(
+        self, lats: Sequence[float], lons: Sequence[float], radii: Sequence[float]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Batched query: for every query i and every crosswalk with a point within
+        radii[i] of (lats[i], lons[i]), returns the query index, crosswalk row,
+        closest point row and distance, with one haversine pass over all queries.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        radii = np.minimum(np.maximum(np.asarray(radii, dtype=np.float64), 0.0), CROSSWALK_MAX_RADIUS_M)
+        query, cand = self._candidates_many(lats, lons, radii + self.extent_m)
+        if len(cand) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty, np.empty(0, dtype=np.float64)
+        counts = self.offsets[cand + 1] - self.offsets[cand]
+        idx = _ranges(self.offsets[cand], counts)
+        pair = np.repeat(np.arange(len(cand)), counts)
+        q_lats, q_lons = lats[query][pair], lons[query][pair]
+        distance = haversine_m(q_lats, q_lons, self.lats[idx], self.lons[idx])
+        inside = distance <= radii[query][pair]
+        idx, pair, distance = idx[inside], pair[inside], distance[inside]
+        # Closest point per (query, crosswalk) pair
+        order = np.lexsort((distance, pair))
+        idx, pair, distance = idx[order], pair[order], distance[order]
+        first = np.ones(len(idx), dtype=bool)
+        first[1:] = pair[1:] != pair[:-1]
+        return query[pair[first]], cand[pair[first]], idx[first], distance[first]
+
+
+def _cell_size(cell_m: float, ref_lat: float) -> Tuple[float, float]:
+    """Grid cell height and width in degrees; cells are `cell_m` square at `ref_lat`."""
+    return cell_m / M_PER_DEG_LAT, cell_m / (M_PER_DEG_LAT * max(math.cos(math.radians(ref_lat)), 1e-6))
+
+
+def _grid_keys(lats: np.ndarray, lons: np.ndarray, cell_lat: float, cell_lon: float) -> np.ndarray:
+    # Row-major: the cells of one grid row are one contiguous key range
+    rows = np.floor(lats / cell_lat).astype(np.int64)
+    cols = np.floor(lons / cell_lon).astype(np.int64) + _COL_OFFSET
+    return rows * (1 << 32) + cols
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of arange(start, start + count) for each pair."""
+    ends = np.cumsum(counts)
+    return np.repeat(starts - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def overpass_points(elements: Iterable[Dict[str, Any]]) -> Tuple[List[int], List[float], List[float], List[int]]:
+    """
+    Point columns for an Overpass `out geom` element list. Nodes that are part
+    of a crossing way are represented by the way, as in the frontend.
+    """
+    elements = list(elements)
+    in_way = set()
+    ids, lats, lons, kinds = [], [], [], []
+    for element in elements:
+        if element.get("type") == "way":
+            geometry = element.get("geometry") or []
+            in_way.update(element.get("nodes") or [])
+            for point in geometry:
+                ids.append(element["id"])
+                lats.append(point["lat"])
+                lons.append(point["lon"])
+                kinds.append(KIND_WAY)
+    for element in elements:
+        if element.get("type") == "node" and element["id"] not in in_way:
+            ids.append(element["id"])
+            lats.append(element["lat"])
+            lons.append(element["lon"])
+            kinds.append(KIND_NODE)
+    return ids, lats, lons, kinds
+
+
+def load_overpass(path: str, cell_m: float = CROSSWALK_INDEX_CELL_M) -> CrosswalkIndex:
+    with open(path, "r", encoding="utf-8") as f:
+        elements = json.load(f).get("elements", [])
+    return CrosswalkIndex.from_points(*overpass_points(elements), cell_m=cell_m)
+
+
+def pbf_points(path: str) -> Tuple[List[int], List[float], List[float], List[int]]:
+    """Point columns for the crossings of an OSM PBF extract (needs pyosmium)."""
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError("reading .pbf extracts needs the osmium package (pip install osmium)")
+
+    ids, lats, lons, kinds = [], [], [], []
+    in_way = set()
+    nodes = []
+    for obj in osmium.FileProcessor(path).with_locations():
+        if obj.is_way() and obj.tags.get("footway") == "crossing":
+            for node in obj.nodes:
+                if node.location.valid():
+                    in_way.add(node.ref)
+                    ids.append(obj.id)
+                    lats.append(node.lat)
+                    lons.append(node.lon)
+                    kinds.append(KIND_WAY)
+        elif obj.is_node() and obj.tags.get("highway") == "crossing":
+            nodes.append((obj.id, obj.location.lat, obj.location.lon))
+    for node_id, lat, lon in nodes:
+        if node_id not in in_way:
+            ids.append(node_id)
+            lats.append(lat)
+            lons.append(lon)
+            kinds.append(KIND_NODE)
+    return ids, lats, lons, kinds
+
+
+# Compact format: a fixed header, then the index columns as little-endian
+# arrays, each starting on a 64-byte boundary so they can be used in place
+CWX_MAGIC = b"CWX1"
+CWX_VERSION = 1
+_HEADER = struct.Struct("<4sIQQddd")  # magic, version, crosswalks, points, cell_m, ref_lat, extent_m
+_ALIGN = 64
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGN) * _ALIGN
+
+
+def _sections(crosswalks: int, points: int):
+    return (
+        ("keys", "<i8", crosswalks),
+        ("ids", "<i8", crosswalks),
+        ("offsets", "<i8", crosswalks + 1),
+        ("lats", "<f8", points),
+        ("lons", "<f8", points),
+        ("kinds", "<i1", crosswalks),
+    )
+
+
+def write_compact(index: CrosswalkIndex, path: str):
+    """Writes `index` in the compact format; replaces `path` atomically."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(CWX_MAGIC, CWX_VERSION, len(index), index.points, index.cell_m, index.ref_lat, index.extent_m))
+        for name, dtype, count in _sections(len(index), index.points):
+            f.write(b"\0" * (_align(f.tell()) - f.tell()))
+            f.write(np.ascontiguousarray(getattr(index, name), dtype=dtype).tobytes())
+    os.replace(tmp, path)
+
+
+def open_compact(path: str) -> CrosswalkIndex:
+    """
+    Maps a compact index file read-only. The arrays are views of the mapping,
+    so opening costs no parsing and every process shares the page cache copy.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, crosswalks, points, cell_m, ref_lat, extent_m = _HEADER.unpack_from(buffer, 0)
+    if magic != CWX_MAGIC or version != CWX_VERSION:
+        raise ValueError(f"{path} is not a version {CWX_VERSION} crosswalk index")
+    arrays = {}
+    offset = _HEADER.size
+    for name, dtype, count in _sections(crosswalks, points):
+        offset = _align(offset)
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        offset += arrays[name].nbytes
+    return CrosswalkIndex(**arrays, cell_m=cell_m, ref_lat=ref_lat, extent_m=extent_m, buffer=buffer)
+
+
+def build_compact(source: str, path: str, cell_m: float = CROSSWALK_INDEX_CELL_M) -> CrosswalkIndex:
+    """Offline build: Overpass JSON or OSM PBF extract -> compact index file."""
+    points = pbf_points(source) if source.endswith(".pbf") else None
+    index = CrosswalkIndex.from_points(*points, cell_m=cell_m) if points else load_overpass(source, cell_m)
+    write_compact(index, path)
+    return index
+
+
+def load_index(path: str) -> CrosswalkIndex:
+    return open_compact(path) if path.endswith(".cwx") else load_overpass(path)
+
+
+def empty_index() -> CrosswalkIndex:
+    return CrosswalkIndex.from_points([], [], [], [])
+
+
+_index: Optional[CrosswalkIndex] = None
+
+
+def get_crosswalk_index() -> CrosswalkIndex:
+    """The index from CROSSWALK_DATA_PATH (.cwx or Overpass JSON), or an empty one if unset."""
+    global _index
+    if _index is None:
+        _index = load_index(CROSSWALK_DATA_PATH) if CROSSWALK_DATA_PATH else empty_index()
+    return _index
+
+
+def nearby_crosswalks(lat: float, lon: float, radius: float, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError("lat/lon out of range")
+    return [cw.to_dict() for cw in get_crosswalk_index().query(lat, lon, radius, limit)]
+
+
+def random_index(n: int, lat: float, lon: float, spread_m: float, seed: int = 0, cell_m: float = CROSSWALK_INDEX_CELL_M):
+    """Synthetic index of `n` crosswalks scattered uniformly around (lat, lon)."""
+    rng = np.random.default_rng(seed)
+    dlat = spread_m / M_PER_DEG_LAT
+    dlon = spread_m / (M_PER_DEG_LAT * math.cos(math.radians(lat)))
+    lats = lat + rng.uniform(-dlat, dlat, n)
+    lons = lon + rng.uniform(-dlon, dlon, n)
+    return CrosswalkIndex.from_points(np.arange(n), lats, lons, np.zeros(n, dtype=np.int8), cell_m=cell_m)
+
+
+def synthetic_extract(n: int, lat: float, lon: float, spread_m: float, seed: int = 0) -> Dict[str, Any]:
+    """Overpass-style extract of `n` crossings, a third of them two-point ways."""
+    rng = np.random.default_rng(seed)
+    dlat = spread_m / M_PER_DEG_LAT
+    dlon = spread_m / (M_PER_DEG_LAT * math.cos(math.radians(lat)))
+    elements = []
+    for i in range(n):
+        p_lat, p_lon = lat + rng.uniform(-dlat, dlat), lon + rng.uniform(-dlon, dlon)
+        if i % 3:
+            elements.append({"type": "node", "id": i, "lat": p_lat, "lon": p_lon, "tags": {"highway": "crossing"}})
+        else:
+            geometry = [{"lat": p_lat, "lon": p_lon}, {"lat": p_lat + 1e-4, "lon": p_lon + 1e-4}]
+            elements.append({"type": "way", "id": i, "nodes": [], "geometry": geometry, "tags": {"footway": "crossing"}})
+    return {"elements": elements}
+
+
+def _memory_mb() -> Dict[str, float]:
+    fields = {}
+    for name in ("status", "smaps_rollup"):
+        try:
+            for line in open(f"/proc/self/{name}"):
+                key, _, value = line.partition(":")
+                if key in ("RssAnon", "RssFile", "Pss"):
+                    fields[key] = int(value.split()[0]) / 1024
+        except OSError:
+            pass
+    return fields
+
+
+def _measure_worker(path: str, queries: int):
+    """One simulated app worker: load, serve queries, then report memory once told to."""
+    before = _memory_mb()
+    start = time.perf_counter()
+    index = load_index(path)
+    load_s = time.perf_counter() - start
+    rng = np.random.default_rng(os.getpid())
+    lats, lons = index.lats, index.lons
+    for i in rng.integers(0, index.points, queries):
+        index.query(float(lats[i]), float(lons[i]), 200.0)
+    print("ready", flush=True)
+    sys.stdin.readline()  # all workers are loaded now, so shared pages are split between them
+    after = _memory_mb()
+    print(json.dumps({"load_s": load_s, **{k: after.get(k, 0.0) - before.get(k, 0.0) for k in after}}), flush=True)
+
+
+def _bench_load(path: str, workers: int, queries: int) -> Dict[str, float]:
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-m", "app.crosswalk_index", "measure", path, "--queries", str(queries)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        for _ in range(workers)
+    ]
+    for proc in procs:
+        proc.stdout.readline()
+    results = []
+    for proc in procs:
+        proc.stdin.write("\n")
+        proc.stdin.flush()
+        results.append(json.loads(proc.stdout.readline()))
+        proc.wait()
+    return {key: sum(r.get(key, 0.0) for r in results) / workers for key in ("load_s", "RssAnon", "RssFile", "Pss")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and benchmark the crosswalk index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="build a compact .cwx index from an extract")
+    build_parser.add_argument("source", help="Overpass JSON (out geom) or OSM .pbf extract")
+    build_parser.add_argument("output", help="index file, conventionally *.cwx")
+    build_parser.add_argument("--cell-m", type=float, default=CROSSWALK_INDEX_CELL_M)
+    query_parser = sub.add_parser("query", help="benchmark nearby-crosswalk queries")
+    query_parser.add_argument("--data", help="Overpass JSON or .cwx index (default: synthetic crosswalks)")
+    query_parser.add_argument("--crosswalks", type=int, default=200_000)
+    query_parser.add_argument("--spread-km", type=float, default=30.0)
+    query_parser.add_argument("--radius", type=float, default=200.0)
+    query_parser.add_argument("--queries", type=int, default=10_000)
+    load_parser = sub.add_parser("load", help="benchmark per-worker load time and memory, JSON vs compact")
+    load_parser.add_argument("--data", help="Overpass JSON extract (default: synthetic crosswalks)")
+    load_parser.add_argument("--crosswalks", type=int, default=200_000)
+    load_parser.add_argument("--workers", type=int, default=4)
+    load_parser.add_argument("--queries", type=int, default=1000, help="queries per worker before measuring")
+    measure_parser = sub.add_parser("measure")
+    measure_parser.add_argument("path")
+    measure_parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    center = (47.4979, 19.0402)
+    if args.command == "build":
+        start = time.perf_counter()
+        index = build_compact(args.source, args.output, args.cell_m)
+        print(f"wrote {len(index)} crosswalks / {index.points} points to {args.output} "
+              f"({os.path.getsize(args.output) / 1e6:.1f} MB) in {time.perf_counter() - start:.2f} s")
+
+    elif args.command == "measure":
+        _measure_worker(args.path, args.queries)
+
+    elif args.command == "load":
+        with tempfile.TemporaryDirectory() as tmp:
+            source = args.data
+            if not source:
+                source = os.path.join(tmp, "crossings.json")
+                with open(source, "w") as f:
+                    json.dump(synthetic_extract(args.crosswalks, *center, 30_000), f)
+            compact = os.path.join(tmp, "crossings.cwx")
+            build_compact(source, compact)
+            print(f"{args.workers} workers, extract {os.path.getsize(source) / 1e6:.1f} MB, "
+                  f"index {os.path.getsize(compact) / 1e6:.1f} MB")
+            for label, path in (("json", source), ("mmap", compact)):
+                r = _bench_load(path, args.workers, args.queries)
+                print(f"{label}: load {r['load_s'] * 1e3:8.1f} ms/worker, anon {r['RssAnon']:7.1f} MB, "
+                      f"file {r['RssFile']:6.1f} MB, pss {r['Pss']:7.1f} MB per worker")
+
+    else:
+        start = time.perf_counter()
+        if args.data:
+            index = load_index(args.data)
+            center = (index.ref_lat, float(np.mean(index.lons)))
+        else:
+            index = random_index(args.crosswalks, *center, args.spread_km * 1000)
+        print(f"built index of {len(index)} crosswalks / {index.points} points in {time.perf_counter() - start:.2f} s")
+
+        rng = np.random.default_rng(1)
+        spread = args.spread_km * 1000 / M_PER_DEG_LAT / 2
+        probes = [(center[0] + rng.uniform(-spread, spread), center[1] + rng.uniform(-spread, spread)) for _ in range(args.queries)]
+        found = 0
+        start = time.perf_counter()
+        for lat, lon in probes:
+            found += len(index.query(lat, lon, args.radius))
+        elapsed = time.perf_counter() - start
+        print(f"{args.queries} queries, radius {args.radius:.0f} m: {elapsed / args.queries * 1e6:.1f} us/query, "
+              f"{found / args.queries:.1f} crosswalks/query")
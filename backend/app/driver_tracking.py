@@ -0,0 +1,268 @@
+"""
+Server-side driver tracking from raw GPS fixes (the `driver_position` event).
+
+Instead of routing on the phone and sending one `driver_update` per
+crosswalk with a client-computed distance, a driver sends its lat/lon,
+speed and heading. Fixes are collected for DRIVER_FIX_TICK seconds (the
+newest fix per driver wins); each tick then
+  - computes every pending driver's distance to the crosswalks in reach and
+    ahead of it in one vectorized pass over the crosswalk index,
+  - diffs that against the crosswalks each driver was tracked at, and
+  - applies every enter/update/leave with `state.apply_driver_changes`
+    (one merge write per crosswalk) and schedules the affected crosswalks'
+    evaluations together.
+Distances are straight-line to the crosswalk's closest point.
+"""
+import asyncio
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import numpy as np
+
+from sockets import sio_server
+from app.coalescer import get_coalescer
+from app.crosswalk_index import CrosswalkIndex, get_crosswalk_index
+from app.notifications import drivers_room, leave_room
+from app.prune import get_scheduler
+from app.relevant_crosswalks import prefilter, reach_m
+from app.sharding import get_shard_router
+from app.state import DRIVER_PRESENCE_TTL, DriverFix, apply_driver_changes, get_client, set_role
+
+DRIVER_FIX_TICK = float(os.getenv("DRIVER_FIX_TICK", "0.05"))
+
+
+class DriverPosition(NamedTuple):
+    lat: float
+    lon: float
+    speed: float
+    heading: Optional[float] = None
+
+
+def locate(index: CrosswalkIndex, positions: List[DriverPosition]) -> List[Dict[int, float]]:
+    """Per position, {crosswalk id: distance} of the crosswalks in reach and ahead."""
+    if not positions:
+        return []
+    lats = np.array([p.lat for p in positions], dtype=np.float64)
+    lons = np.array([p.lon for p in positions], dtype=np.float64)
+    speeds = np.array([p.speed for p in positions], dtype=np.float64)
+    headings = np.array([np.nan if p.heading is None else p.heading for p in positions], dtype=np.float64)
+    query, rows, points, distance = index.nearest_points(lats, lons, reach_m(speeds))
+    keep = prefilter(
+        lats[query], lons[query], speeds[query], headings[query],
+        index.lats[points], index.lons[points], distance,
+    )
+    located: List[Dict[int, float]] = [{} for _ in positions]
+    for q, row, d in zip(query[keep], rows[keep], distance[keep]):
+        located[q][int(index.ids[row])] = float(d)
+    return located
+
+
+class DriverTracker:
+    """
+    Batches driver fixes per `tick` and keeps, per driver, the crosswalks it
+    is currently tracked at. `submit` resolves with the driver's
+    {crosswalk id: distance} once its tick has been applied.
+    """
+
+    def __init__(self, tick: float = DRIVER_FIX_TICK, index: Optional[CrosswalkIndex] = None):
+        self.tick = tick
+        self._index = index
+        self._pending: Dict[str, DriverPosition] = {}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._tracked: Dict[str, Dict[int, float]] = {}
+        # Sids forgotten while a tick is being applied (None between ticks)
+        self._forgotten: Optional[Set[str]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.fixes = 0
+        self.merged = 0
+        self.ticks = 0
+        self.entered = 0
+        self.updated = 0
+        self.left = 0
+        self.forwarded = 0
+        self.failed = 0
+
+    @property
+    def index(self) -> CrosswalkIndex:
+        return self._index if self._index is not None else get_crosswalk_index()
+
+    async def submit(self, sid: str, position: DriverPosition) -> Dict[int, float]:
+        self.fixes += 1
+        if sid in self._pending:
+            self.merged += 1
+        self._pending[sid] = position
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(sid, []).append(future)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return await future
+
+    async def _run(self):
+        try:
+            while self._pending:
+                # Fixes arriving during this pause join the batch
+                await asyncio.sleep(self.tick)
+                pending, self._pending = self._pending, {}
+                waiters, self._waiters = self._waiters, {}
+                try:
+                    located = await self._apply(pending)
+                except Exception as e:
+                    self.failed += len(pending)
+                    located, error = {}, e
+                else:
+                    error = None
+                self.ticks += 1
+                for sid, futures in waiters.items():
+                    for future in futures:
+                        if future.done():
+                            continue
+                        if error is not None:
+                            future.set_exception(error)
+                        else:
+                            future.set_result(located.get(sid, {}))
+        finally:
+            self._task = None
+
+    async def _apply(self, pending: Dict[str, DriverPosition]) -> Dict[str, Dict[int, float]]:
+        self._forgotten = set()
+        try:
+            return await self._apply_tick(pending)
+        finally:
+            self._forgotten = None
+
+    async def _apply_tick(self, pending: Dict[str, DriverPosition]) -> Dict[str, Dict[int, float]]:
+        sids = list(pending)
+        located = dict(zip(sids, locate(self.index, [pending[sid] for sid in sids])))
+        changes: Dict[int, Dict[str, Optional[DriverFix]]] = {}
+        new_drivers = []
+        for sid in sids:
+            before = self._tracked.get(sid)
+            if before is None:
+                new_drivers.append(sid)
+                before = {}
+            now_at = located[sid]
+            for crosswalk_id, distance in now_at.items():
+                joined = crosswalk_id not in before
+                changes.setdefault(crosswalk_id, {})[sid] = DriverFix(distance, pending[sid].speed, joined)
+                if joined:
+                    self.entered += 1
+                else:
+                    self.updated += 1
+            for crosswalk_id in before.keys() - now_at.keys():
+                changes.setdefault(crosswalk_id, {})[sid] = None
+                self.left += 1
+
+        changes = await self._forward_remote(changes)
+        db = await get_client()
+        changes = self._without_forgotten(located, changes)
+        for sid in new_drivers:
+            # Not joined anywhere yet (apply_driver_changes sets the role of those that are)
+            if sid not in self._forgotten and not any(sid in drivers for drivers in changes.values()):
+                await set_role(db, sid, "driver")
+        if changes:
+            await apply_driver_changes(db, changes)
+            # Drivers that disconnected during the write may have been re-added after their cleanup
+            undo = {
+                crosswalk_id: {sid: None for sid, fix in drivers.items() if fix is not None and sid in self._forgotten}
+                for crosswalk_id, drivers in changes.items()
+            }
+            undo = {crosswalk_id: drivers for crosswalk_id, drivers in undo.items() if drivers}
+            if undo:
+                await apply_driver_changes(db, undo)
+            changes = self._without_forgotten(located, changes)
+        # Only once written, so a failed tick is retried as a diff against the old state
+        self._tracked.update(located)
+
+        deadline = time.time() + DRIVER_PRESENCE_TTL
+        for crosswalk_id, drivers in changes.items():
+            for sid, fix in drivers.items():
+                if fix is None:
+                    await leave_room(sid, drivers_room(crosswalk_id))
+                elif fix.joined:
+                    await sio_server.enter_room(sid, drivers_room(crosswalk_id))
+            # Re-evaluate when these drivers would expire if they stop sending fixes
+            get_scheduler().schedule(crosswalk_id, deadline)
+            get_coalescer().mark(crosswalk_id)
+        return located
+
+    def _without_forgotten(self, located: Dict[str, Dict[int, float]], changes: Dict[int, Dict[str, Optional[DriverFix]]]):
+        """Drops the drivers forgotten so far this tick from `located` (in place) and `changes`."""
+        if not self._forgotten:
+            return changes
+        for sid in self._forgotten:
+            located.pop(sid, None)
+        changes = {
+            crosswalk_id: {sid: fix for sid, fix in drivers.items() if sid not in self._forgotten}
+            for crosswalk_id, drivers in changes.items()
+        }
+        return {crosswalk_id: drivers for crosswalk_id, drivers in changes.items() if drivers}
+
+    async def _forward_remote(self, changes: Dict[int, Dict[str, Optional[DriverFix]]]):
+        """
+        With sharding, hands changes at crosswalks owned by other nodes to
+        their owner as the equivalent per-crosswalk driver events; returns
+        the local ones.
+        """
+        router = get_shard_router()
+        if router is None:
+            return changes
+        local = {}
+        for crosswalk_id, drivers in changes.items():
+            owner = router.owner(crosswalk_id)
+            if owner is None or owner == router.node_id:
+                local[crosswalk_id] = drivers
+                continue
+            for sid, fix in drivers.items():
+                if fix is None:
+                    event, data = "driver_leave", {"crosswalk_id": crosswalk_id}
+                else:
+                    event = "driver_enter" if fix.joined else "driver_update"
+                    data = {"crosswalk_id": crosswalk_id, "distance": fix.distance, "speed": fix.speed}
+                await router.forward(event, crosswalk_id, sid, data)
+                self.forwarded += 1
+        return local
+
+    def forget(self, sid: str):
+        """
+        Drops a disconnected driver, including a fix still waiting for its
+        tick (applying it after the disconnect cleanup would re-add the
+        driver); its crosswalk entries are removed by disconnect cleanup. A
+        tick in flight drops the driver before updating its state, and
+        removes entries it wrote concurrently with the cleanup.
+        """
+        if self._forgotten is not None:
+            self._forgotten.add(sid)
+        self._tracked.pop(sid, None)
+        self._pending.pop(sid, None)
+        for future in self._waiters.pop(sid, []):
+            if not future.done():
+                future.set_result({})
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "drivers": len(self._tracked),
+            "fixes": self.fixes,
+            "merged": self.merged,
+            "ticks": self.ticks,
+            "entered": self.entered,
+            "updated": self.updated,
+            "left": self.left,
+            "forwarded": self.forwarded,
+            "failed": self.failed,
+        }
+
+
+_tracker: Optional[DriverTracker] = None
+
+
+def get_driver_tracker() -> DriverTracker:
+    global _tracker
+    if _tracker is None:
+        _tracker = DriverTracker()
+    return _tracker
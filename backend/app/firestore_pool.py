@@ -0,0 +1,181 @@
+"""
+Pool of Firestore AsyncClients, one gRPC channel each.
+
+A single AsyncClient multiplexes every read and write of the process over
+one channel, which caps the number of concurrent streams and becomes the
+serialization point under load. FirestorePool hands out the client with
+the fewest operations in flight; each client's document operations get a
+per-request timeout, an overall deadline (including retries and waiting
+for a free slot) and are recorded in per-operation latency histograms.
+
+Pointing the pool at the Firestore emulator only needs FIRESTORE_EMULATOR_HOST
+(honoured by the client library itself); STATE_BACKEND=memory replaces
+Firestore with the in-process MemoryClient altogether (see app.state).
+"""
+import asyncio
+import bisect
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from google.api_core.exceptions import DeadlineExceeded
+from google.cloud.firestore_v1 import AsyncClient
+from google.cloud.firestore_v1.async_document import AsyncDocumentReference
+
+FIRESTORE_POOL_SIZE = int(os.getenv("FIRESTORE_POOL_SIZE", "1"))
+# gRPC allows ~100 concurrent streams per connection by default
+FIRESTORE_MAX_INFLIGHT = int(os.getenv("FIRESTORE_MAX_INFLIGHT", "100"))
+FIRESTORE_REQUEST_TIMEOUT = float(os.getenv("FIRESTORE_REQUEST_TIMEOUT", "10"))
+FIRESTORE_DEADLINE = float(os.getenv("FIRESTORE_DEADLINE", "30"))
+# Per-operation overrides, e.g. "get=2,update=5"
+FIRESTORE_OP_DEADLINES = os.getenv("FIRESTORE_OP_DEADLINES", "")
+
+OPERATIONS = ("get", "set", "update", "create", "delete")
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def parse_deadlines(spec: str, default: float) -> Dict[str, float]:
+    deadlines = {op: default for op in OPERATIONS}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        op, _, value = item.partition("=")
+        if op.strip() not in deadlines:
+            raise ValueError(f"unknown Firestore operation: {op}")
+        deadlines[op.strip()] = float(value)
+    return deadlines
+
+
+class LatencyHistogram:
+    """Cumulative-bucket latency histogram (milliseconds) with error counts."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.errors = 0
+        self.timeouts = 0
+
+    def record(self, seconds: float):
+        ms = seconds * 1e3
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.total += ms
+
+    def stats(self) -> dict:
+        count = sum(self.counts)
+        labels = [f"le_{b}" for b in self.buckets] + ["inf"]
+        return {
+            "count": count,
+            "avg_ms": self.total / count if count else 0.0,
+            "buckets": dict(zip(labels, self.counts)),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
+
+
+class PooledDocumentReference(AsyncDocumentReference):
+    """Document reference whose operations go through its client's pool slot."""
+
+    async def get(self, *args, **kwargs):
+        return await self._client._pool_slot.call("get", super().get, args, kwargs)
+
+    async def set(self, *args, **kwargs):
+        return await self._client._pool_slot.call("set", super().set, args, kwargs)
+
+    async def update(self, *args, **kwargs):
+        return await self._client._pool_slot.call("update", super().update, args, kwargs)
+
+    async def create(self, *args, **kwargs):
+        return await self._client._pool_slot.call("create", super().create, args, kwargs)
+
+    async def delete(self, *args, **kwargs):
+        return await self._client._pool_slot.call("delete", super().delete, args, kwargs)
+
+
+class PooledAsyncClient(AsyncClient):
+    """AsyncClient whose document references are PooledDocumentReference."""
+
+    _pool_slot: "_ClientSlot"
+
+    def document(self, *document_path: str) -> PooledDocumentReference:
+        return PooledDocumentReference(*self._document_path_helper(*document_path), client=self)
+
+
+class _ClientSlot:
+    def __init__(self, pool: "FirestorePool", client: AsyncClient):
+        self.pool = pool
+        self.client = client
+        self.inflight = 0
+        self._slots = asyncio.Semaphore(pool.max_inflight)
+
+    async def call(self, op: str, method: Callable, args: tuple, kwargs: dict):
+        pool = self.pool
+        kwargs.setdefault("timeout", pool.request_timeout)
+        histogram = pool.histograms[op]
+        self.inflight += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self._run(method, args, kwargs), pool.deadlines[op])
+        except asyncio.TimeoutError:
+            histogram.timeouts += 1
+            raise DeadlineExceeded(f"Firestore {op} exceeded {pool.deadlines[op]}s")
+        except Exception:
+            histogram.errors += 1
+            raise
+        finally:
+            self.inflight -= 1
+            histogram.record(time.perf_counter() - start)
+
+    async def _run(self, method: Callable, args: tuple, kwargs: dict):
+        if self._slots.locked():
+            self.pool.saturated += 1
+        async with self._slots:
+            return await method(*args, **kwargs)
+
+
+class FirestorePool:
+    """
+    `size` AsyncClients (each with its own channel). `client()` returns the
+    one with the fewest operations in flight; at most `max_inflight`
+    operations run per client, further ones wait and count as saturation.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], AsyncClient],
+        size: int = FIRESTORE_POOL_SIZE,
+        max_inflight: int = FIRESTORE_MAX_INFLIGHT,
+        request_timeout: float = FIRESTORE_REQUEST_TIMEOUT,
+        deadlines: Optional[Dict[str, float]] = None,
+    ):
+        self.max_inflight = max(1, max_inflight)
+        self.request_timeout = request_timeout
+        self.deadlines = deadlines or parse_deadlines(FIRESTORE_OP_DEADLINES, FIRESTORE_DEADLINE)
+        self.histograms = {op: LatencyHistogram() for op in OPERATIONS}
+        self.saturated = 0
+        self._slots: List[_ClientSlot] = []
+        for _ in range(max(1, size)):
+            client = factory()
+            slot = _ClientSlot(self, client)
+            client._pool_slot = slot
+            self._slots.append(slot)
+        self._next = 0
+
+    def client(self) -> AsyncClient:
+        # Rotate the starting point so ties spread over the channels
+        self._next = (self._next + 1) % len(self._slots)
+        rotated = self._slots[self._next:] + self._slots[:self._next]
+        return min(rotated, key=lambda slot: slot.inflight).client
+
+    def stats(self) -> dict:
+        inflight = [slot.inflight for slot in self._slots]
+        return {
+            "clients": len(self._slots),
+            "inflight": inflight,
+            "utilization": sum(inflight) / (len(self._slots) * self.max_inflight),
+            "saturated": self.saturated,
+            "operations": {op: h.stats() for op, h in self.histograms.items()},
+        }
+
+
+def create_pool(database: str, **kwargs) -> FirestorePool:
+    """The pool of PooledAsyncClients for `database` behind the "firestore" state backend."""
+    return FirestorePool(lambda: PooledAsyncClient(database=database), **kwargs)
@@ -0,0 +1,77 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+PREDICT_CACHE_MAX_DISTANCE = int(os.getenv("PREDICT_CACHE_MAX_DISTANCE", "4"))  # Hamming bits out of 64
+PREDICT_CACHE_TTL = float(os.getenv("PREDICT_CACHE_TTL", "2.0"))
+PREDICT_CACHE_MAX_CLIENTS = int(os.getenv("PREDICT_CACHE_MAX_CLIENTS", "4096"))
+
+
+class PredictionCache:
+    """
+    Remembers the last classified frame of every client as (dhash, result, ts).
+    A new frame whose hash is within `max_distance` bits of that frame, and
+    arrives within `ttl` seconds of it, reuses the result instead of paying
+    for a forward pass. Clients are evicted least-recently-used beyond
+    `max_clients`.
+    """
+
+    def __init__(
+        self,
+        max_distance: int = PREDICT_CACHE_MAX_DISTANCE,
+        ttl: float = PREDICT_CACHE_TTL,
+        max_clients: int = PREDICT_CACHE_MAX_CLIENTS,
+    ):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_clients = max(1, max_clients)
+        self._entries: "OrderedDict[str, Tuple[int, Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: str, frame_hash: int, now: Optional[float] = None) -> Optional[Any]:
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(key)
+        if entry is not None:
+            cached_hash, result, ts = entry
+            if now - ts > self.ttl:
+                del self._entries[key]
+            elif (cached_hash ^ frame_hash).bit_count() <= self.max_distance:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def store(self, key: str, frame_hash: int, result: Any, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._entries[key] = (frame_hash, result, now)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_clients:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def forget(self, key: str):
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "clients": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_cache: Optional[PredictionCache] = None
+
+
+def get_prediction_cache() -> PredictionCache:
+    global _cache
+    if _cache is None:
+        _cache = PredictionCache()
+    return _cache
@@ -4,9 +4,11 @@ import asyncio
 import base64
 import os
 import re
+import threading
 import time
 import uuid
-from typing import Optional
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional
 import logging
 
 from google.cloud import storage
@@ -18,6 +20,13 @@ GCS_BUCKET = os.getenv("GCS_BUCKET", "")
 GCS_CROSSWALK_PREFIX = os.getenv("GCS_CROSSWALK_PREFIX", "crosswalk/")
 GCS_NO_CROSSWALK_PREFIX = os.getenv("GCS_NO_CROSSWALK_PREFIX", "no_crosswalk/")
 
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_MAX_QUEUED = int(os.getenv("UPLOAD_MAX_QUEUED", "64"))
+UPLOAD_PER_CLIENT_PER_MINUTE = int(os.getenv("UPLOAD_PER_CLIENT_PER_MINUTE", "6"))  # 0 disables the limit
+UPLOAD_DEDUP_DISTANCE = int(os.getenv("UPLOAD_DEDUP_DISTANCE", "6"))  # Hamming bits out of 64, -1 disables
+UPLOAD_MAX_CLIENTS = int(os.getenv("UPLOAD_MAX_CLIENTS", "4096"))
+GCS_POOL_SIZE = int(os.getenv("GCS_POOL_SIZE", str(UPLOAD_WORKERS)))
+
 _DATA_URL_RE = re.compile(r"^data:(?P<mime>[^;]+);base64,(?P<data>.+)$")
 
 
@@ -51,13 +60,55 @@ def _parse_data_url(data_url: str) -> tuple[bytes, str, str]:
     return raw, mime, ext
 
 
+def _sniff_image_bytes(raw: bytes) -> tuple[str, str]:
+    head = bytes(raw[:12])
+    if head.startswith(b"\x89PNG"):
+        return "image/png", "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    if head.startswith(b"GIF8"):
+        return "image/gif", "gif"
+    return "image/jpeg", "jpg"
+
+
+def _parse_frame(frame) -> tuple[bytes, str, str]:
+    """Accepts raw image bytes (binary Socket.IO attachment) or a data URL."""
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        mime, ext = _sniff_image_bytes(frame)
+        return frame, mime, ext
+    return _parse_data_url(frame)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client():
+    """
+    One storage client for every upload, its HTTP session sized so each
+    upload worker keeps a warm connection instead of a handshake per image.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                client = storage.Client()
+                http = getattr(client, "_http", None)
+                if hasattr(http, "mount"):
+                    from requests.adapters import HTTPAdapter
+
+                    size = max(1, GCS_POOL_SIZE)
+                    http.mount("https://", HTTPAdapter(pool_connections=size, pool_maxsize=size))
+                _client = client
+    return _client
+
+
 def _upload_bytes_to_gcs(raw: bytes, mime_type: str, is_crosswalk: bool) -> Optional[str]:
     try:
         if not GCS_BUCKET:
             logger.warning("GCS upload skipped: GCS_BUCKET env var is not set")
             return None
-        client = storage.Client()
-        bucket = client.bucket(GCS_BUCKET)
+        bucket = _get_client().bucket(GCS_BUCKET)
         prefix = GCS_CROSSWALK_PREFIX if is_crosswalk else GCS_NO_CROSSWALK_PREFIX
         # Normalize extension based on mime type (prefer jpg for JPEGs)
         if "/png" in mime_type:
@@ -80,6 +131,152 @@ def _upload_bytes_to_gcs(raw: bytes, mime_type: str, is_crosswalk: bool) -> Opti
         return None
 
 
-async def async_upload_image_base64_to_gcs(data_url: str, is_crosswalk: bool) -> Optional[str]:
-    raw, mime, _ = _parse_data_url(data_url)
+async def async_upload_image_to_gcs(frame, is_crosswalk: bool) -> Optional[str]:
+    raw, mime, _ = _parse_frame(frame)
     return await asyncio.to_thread(_upload_bytes_to_gcs, raw, mime, is_crosswalk)
+
+
+async def async_upload_image_base64_to_gcs(data_url: str, is_crosswalk: bool) -> Optional[str]:
+    return await async_upload_image_to_gcs(data_url, is_crosswalk)
+
+
+class _ClientHistory:
+    __slots__ = ("last_hash", "accepted")
+
+    def __init__(self):
+        self.last_hash: Optional[int] = None
+        self.accepted: Deque[float] = deque()
+
+
+class ImageUploader:
+    """
+    Background uploads of training frames through a queue of at most
+    `max_queued` frames drained by `workers` tasks. `offer` never blocks:
+    a frame is skipped when it is a near-duplicate (within `dedup_distance`
+    bits of dhash) of the client's last accepted frame, when the client
+    already had `per_minute` frames accepted in the last minute, or when
+    the queue is full.
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[Any, bool], Awaitable[Optional[str]]] = async_upload_image_to_gcs,
+        workers: int = UPLOAD_WORKERS,
+        max_queued: int = UPLOAD_MAX_QUEUED,
+        per_minute: int = UPLOAD_PER_CLIENT_PER_MINUTE,
+        dedup_distance: int = UPLOAD_DEDUP_DISTANCE,
+        max_clients: int = UPLOAD_MAX_CLIENTS,
+        window: float = 60.0,
+    ):
+        self._upload = upload
+        self.workers = max(1, workers)
+        self.max_queued = max(1, max_queued)
+        self.per_minute = per_minute
+        self.dedup_distance = dedup_distance
+        self.max_clients = max(1, max_clients)
+        self.window = window
+        self._clients: "OrderedDict[str, _ClientHistory]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._latency: Deque[float] = deque(maxlen=1024)
+        self.accepted = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self.duplicates = 0
+
+    def offer(self, key: str, frame: Any, is_crosswalk: bool, frame_hash: Optional[int] = None,
+              now: Optional[float] = None) -> bool:
+        """Queues `frame` of client `key` for upload; returns whether it was accepted."""
+        now = time.monotonic() if now is None else now
+        history = self._clients.get(key)
+        if history is None:
+            history = self._clients[key] = _ClientHistory()
+        self._clients.move_to_end(key)
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+
+        if (
+            frame_hash is not None
+            and history.last_hash is not None
+            and self.dedup_distance >= 0
+            and (history.last_hash ^ frame_hash).bit_count() <= self.dedup_distance
+        ):
+            self.duplicates += 1
+            return False
+        while history.accepted and now - history.accepted[0] >= self.window:
+            history.accepted.popleft()
+        if self.per_minute > 0 and len(history.accepted) >= self.per_minute:
+            self.rate_limited += 1
+            return False
+
+        self._start()
+        if self._queue.qsize() >= self.max_queued:
+            self.dropped += 1
+            return False
+        self._queue.put_nowait((frame, is_crosswalk))
+        history.accepted.append(now)
+        if frame_hash is not None:
+            history.last_hash = frame_hash
+        self.accepted += 1
+        return True
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            frame, is_crosswalk = await self._queue.get()
+            started = time.monotonic()
+            try:
+                uri = await self._upload(frame, is_crosswalk)
+            except Exception:
+                logger.exception("Image upload failed")
+                uri = None
+            self._latency.append(time.monotonic() - started)
+            if uri is None:
+                self.failed += 1
+            else:
+                self.uploaded += 1
+
+    def forget(self, key: str):
+        self._clients.pop(key, None)
+
+    async def close(self):
+        """Stops the workers; frames still queued are discarded."""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queue = None
+
+    def stats(self) -> dict:
+        latency = sorted(self._latency)
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queued": self.max_queued,
+            "workers": self.workers,
+            "accepted": self.accepted,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "rate_limited": self.rate_limited,
+            "duplicates": self.duplicates,
+            "upload_ms_p50": latency[len(latency) // 2] * 1000.0 if latency else None,
+            "upload_ms_p95": latency[int(len(latency) * 0.95)] * 1000.0 if latency else None,
+        }
+
+
+_uploader: Optional[ImageUploader] = None
+
+
+def get_image_uploader() -> ImageUploader:
+    global _uploader
+    if _uploader is None:
+        _uploader = ImageUploader()
+    return _uploader
@@ -1,9 +1,19 @@
+import asyncio
 import time
 from typing import Optional
 from sockets import sio_server
-from prediction import predictImageIsCrosswalk
-from app.notifications import handle_distance_based_notifications
-from app.gcs_upload import async_upload_image_base64_to_gcs
+from prediction import frame_dhash
+from app.admission import get_frame_admission
+from app.batching import get_prediction_batcher
+from app.frame_cache import get_prediction_cache
+from app.notifications import handle_distance_based_notifications, peds_room, drivers_room, leave_room
+from app.gcs_upload import get_image_uploader
+from app.prune import get_scheduler
+from app.coalescer import get_coalescer
+from app.sharding import sharded, sharded_batch, cluster_wide
+from app.crosswalk_index import nearby_crosswalks as query_nearby_crosswalks
+from app.relevant_crosswalks import relevant_crosswalks as search_relevant_crosswalks
+from app.driver_tracking import DriverPosition, get_driver_tracker
 from app.state import (
     get_client,
     set_role,
@@ -11,36 +21,70 @@ from app.state import (
     remove_ped,
     add_driver,
     update_driver,
+    apply_driver_changes,
+    DriverFix,
     remove_driver,
-    list_crosswalk_ids,
+    get_memberships,
     get_crosswalk,
-    add_running_task,
+    get_crosswalk_view,
+    crosswalk_generation,
+    CrosswalkView,
+    DRIVER_PRESENCE_TTL,
 )
 # If you still have per-crosswalk asyncio locks you can import them; otherwise omitted:
 # from app.locks import get_crosswalk_lock
 
+def _view_without(
+    crosswalk_id: int, cw: dict, generation: int, sid: str, writes: int, update_time=None
+) -> Optional[CrosswalkView]:
+    """
+    The crosswalk `cw`, read at `generation`, after this handler's `writes`
+    removals of sid, or None if anything else wrote to it in between.
+    `update_time` is the document's after the last removal, so the
+    evaluation's write is conditional on nothing else having changed it.
+    """
+    if crosswalk_generation(crosswalk_id) != generation + writes:
+        return None
+    last_broadcast = dict(cw.get("last_broadcast") or {})
+    last_broadcast["driver_critical_active"] = {
+        k: v for k, v in (last_broadcast.get("driver_critical_active") or {}).items() if k != sid
+    }
+    data = {
+        **cw,
+        "peds": [p for p in (cw.get("peds") or []) if p != sid],
+        "drivers": {k: v for k, v in (cw.get("drivers") or {}).items() if k != sid},
+        "last_broadcast": last_broadcast,
+    }
+    return CrosswalkView(data, generation + writes, time.time(), update_time)
+
+
 async def _cleanup_sid_membership(sid: str, role: Optional[str]):
     """
-    Naive cleanup: scan all crosswalks and remove sid from peds/drivers.
-    For large scale, maintain an inverse index (session doc listing memberships).
+    Removes sid from the peds/drivers of every crosswalk it joined, using the
+    session's inverse membership index (O(memberships), not O(crosswalks)).
     """
     db = await get_client()
     try:
-        ids = await list_crosswalk_ids(db)
+        ids = await get_memberships(db, sid)
         for crosswalk_id in ids:
+            generation = crosswalk_generation(crosswalk_id)
             cw = await get_crosswalk(db, crosswalk_id)
             if not cw:
                 continue
-            modified = False
+            writes = 0
+            update_time = None
             if role == "ped" and sid in cw.get("peds", []):
-                await remove_ped(db, crosswalk_id, sid)
-                modified = True
+                update_time = await remove_ped(db, crosswalk_id, sid)
+                writes += 1
+                await leave_room(sid, peds_room(crosswalk_id))
             elif role == "driver" and sid in cw.get("drivers", {}):
-                await remove_driver(db, crosswalk_id, sid)
-                modified = True
-            if modified:
+                update_time = await remove_driver(db, crosswalk_id, sid)
+                writes += 1
+                await leave_room(sid, drivers_room(crosswalk_id))
+            if writes:
                 # Trigger notification logic to reflect presence change
-                await handle_distance_based_notifications(crosswalk_id)
+                view = _view_without(crosswalk_id, cw, generation, sid, writes, update_time)
+                await handle_distance_based_notifications(crosswalk_id, view)
     except Exception:
         pass
 
@@ -52,58 +96,128 @@ async def connect(sid, environ):
 
 
 @sio_server.event
+@cluster_wide
 async def disconnect(sid):
     db = await get_client()
     try:
-        ids = await list_crosswalk_ids(db)
+        ids = await get_memberships(db, sid)
         for crosswalk_id in ids:
+            generation = crosswalk_generation(crosswalk_id)
             cw = await get_crosswalk(db, crosswalk_id)
             if not cw:
                 continue
-            modified = False
+            writes = 0
+            update_time = None
             if sid in (cw.get("peds") or []):
-                await remove_ped(db, crosswalk_id, sid)
-                modified = True
+                update_time = await remove_ped(db, crosswalk_id, sid)
+                writes += 1
             if sid in (cw.get("drivers") or {}):
-                await remove_driver(db, crosswalk_id, sid)
-                modified = True
-            if modified:
-                await handle_distance_based_notifications(crosswalk_id)
+                update_time = await remove_driver(db, crosswalk_id, sid)
+                writes += 1
+            if writes:
+                view = _view_without(crosswalk_id, cw, generation, sid, writes, update_time)
+                await handle_distance_based_notifications(crosswalk_id, view)
     except Exception:
         pass
+    get_prediction_cache().forget(sid)
+    get_driver_tracker().forget(sid)
+    get_image_uploader().forget(sid)
     await set_role(db, sid, None)
 
 
+async def _classify_frame(sid: str, image):
+    """
+    Reuses the client's last result when this frame is a near-duplicate of
+    the last classified one, otherwise classifies it through the batcher.
+    Returns (result, frame dhash or None).
+    """
+    cache = get_prediction_cache()
+    try:
+        frame_hash = await asyncio.to_thread(frame_dhash, image)
+    except Exception:
+        # Undecodable frames skip the cache; the batcher reports the error
+        frame_hash = None
+    if frame_hash is not None:
+        cached = cache.lookup(sid, frame_hash)
+        if cached is not None:
+            return cached, frame_hash
+    result = await get_prediction_batcher().submit(image)
+    if frame_hash is not None:
+        cache.store(sid, frame_hash, result)
+    return result, frame_hash
+
+
 @sio_server.event
-async def predict(sid, username, imageAsBase64, save: bool = False):
+async def predict(sid, username, image, save: bool = False):
+    """
+    `image` is either a base64 data URL string or the raw JPEG/WebP bytes sent
+    as a binary attachment; bytes are passed to inference and upload as-is.
+    """
     try:
-        result = predictImageIsCrosswalk(imageAsBase64)
+        # Only the newest frame per client is classified; superseded ones get no reply
+        served, classified = await get_frame_admission().run(
+            sid, lambda: _classify_frame(sid, image)
+        )
+        if not served:
+            return
+        result, frame_hash = classified
         await sio_server.emit("predict_result_" + username, result, to=sid)
 
         if save:
-            try:
-                sio_server.start_background_task(
-                    async_upload_image_base64_to_gcs,
-                    imageAsBase64,
-                    result,
-                )
-            except Exception:
-                pass
+            # Sampled, deduplicated and dropped when the upload queue is full
+            get_image_uploader().offer(sid, image, result, frame_hash)
     except Exception as e:
         await sio_server.emit("predict_error_" + username, str(e), to=sid)
 
 
 @sio_server.event
+async def nearby_crosswalks(sid, data):
+    """
+    Acknowledged with the crosswalks within data["radius"] meters of
+    (data["lat"], data["lon"]), nearest first, from the server-side index.
+    """
+    try:
+        crosswalks = query_nearby_crosswalks(
+            float(data["lat"]), float(data["lon"]), float(data.get("radius", 200.0)), data.get("limit")
+        )
+        return {"crosswalks": crosswalks}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@sio_server.event
+async def relevant_crosswalks(sid, data):
+    """
+    Acknowledged with the crosswalks a driver at (data["lat"], data["lon"]),
+    moving at data["speed"] m/s towards data["heading"] degrees, reaches
+    within the relevance horizon, soonest first.
+    """
+    try:
+        heading = data.get("heading")
+        crosswalks = await search_relevant_crosswalks(
+            float(data["lat"]),
+            float(data["lon"]),
+            float(data.get("speed") or 0.0),
+            float(heading) if heading is not None else None,
+        )
+        return {"crosswalks": crosswalks}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@sio_server.event
+@sharded
 async def ped_enter(sid, data):
     crosswalk_id = data["crosswalk_id"]
     db = await get_client()
     await set_role(db, sid, "ped")
     await add_ped(db, crosswalk_id, sid)
+    await sio_server.enter_room(sid, peds_room(crosswalk_id))
 
     # If there was an active ped critical alert, re-send it to this new ped
-    cw = await get_crosswalk(db, crosswalk_id)
-    if cw:
-        existing_alert = (cw.get("last_broadcast") or {}).get("ped_critical_min_distance")
+    view = await get_crosswalk_view(db, crosswalk_id)
+    if view:
+        existing_alert = (view.data.get("last_broadcast") or {}).get("ped_critical_min_distance")
         if existing_alert is not None:
             payload = {
                 "crosswalk_id": crosswalk_id,
@@ -112,20 +226,24 @@ async def ped_enter(sid, data):
             }
             await sio_server.emit("ped_critical", payload, to=sid)
 
-    await _ensure_background_task_running(crosswalk_id)
+    # The read above already reflects this ped; the evaluation can reuse it
+    _schedule_evaluation(crosswalk_id, view)
 
 
 @sio_server.event
+@sharded
 async def ped_leave(sid, data):
     crosswalk_id = data.get("crosswalk_id")
     if crosswalk_id is None:
         return
     db = await get_client()
     await remove_ped(db, crosswalk_id, sid)
-    await _ensure_background_task_running(crosswalk_id)
+    await leave_room(sid, peds_room(crosswalk_id))
+    _schedule_evaluation(crosswalk_id)
 
 
 @sio_server.event
+@sharded
 async def driver_enter(sid, data):
     crosswalk_id = data["crosswalk_id"]
     distance = data.get("distance")
@@ -133,37 +251,99 @@ async def driver_enter(sid, data):
     db = await get_client()
     await set_role(db, sid, "driver")
     await add_driver(db, crosswalk_id, sid, distance, speed=speed)
-    await _ensure_background_task_running(crosswalk_id)
+    await sio_server.enter_room(sid, drivers_room(crosswalk_id))
+    # Re-evaluate when this driver would expire if it stops sending updates
+    get_scheduler().schedule(crosswalk_id, time.time() + DRIVER_PRESENCE_TTL)
+    _schedule_evaluation(crosswalk_id)
 
 
 @sio_server.event
+@sharded
 async def driver_update(sid, data):
     crosswalk_id = data["crosswalk_id"]
     distance = data.get("distance")
     speed = data.get("speed")
     db = await get_client()
     await update_driver(db, crosswalk_id, sid, distance, speed=speed)
-    await _ensure_background_task_running(crosswalk_id)
+    # Re-evaluate when this driver would expire if it stops sending updates
+    get_scheduler().schedule(crosswalk_id, time.time() + DRIVER_PRESENCE_TTL)
+    _schedule_evaluation(crosswalk_id)
+
+
+@sio_server.event
+@sharded_batch
+async def driver_update_batch(sid, data):
+    """
+    One driver's updates for several crosswalks:
+    {"speed": s, "crosswalks": [{"crosswalk_id": id, "distance": d}, ...]}.
+    Applied as one batched write (joining crosswalks not joined yet) and the
+    crosswalks' evaluations are scheduled together.
+    """
+    speed = data.get("speed")
+    entries = [
+        entry for entry in data.get("crosswalks") or []
+        if isinstance(entry, dict) and entry.get("crosswalk_id") is not None
+    ]
+    if not entries:
+        return
+    db = await get_client()
+    # Only crosswalks not joined yet need the session's role and membership written
+    joined = set(await get_memberships(db, sid))
+    changes = {}
+    for entry in entries:
+        crosswalk_id = entry["crosswalk_id"]
+        changes[crosswalk_id] = {
+            sid: DriverFix(entry.get("distance"), entry.get("speed", speed), joined=crosswalk_id not in joined)
+        }
+    await apply_driver_changes(db, changes)
+    deadline = time.time() + DRIVER_PRESENCE_TTL
+    for crosswalk_id, drivers in changes.items():
+        if drivers[sid].joined:
+            await sio_server.enter_room(sid, drivers_room(crosswalk_id))
+        # Re-evaluate when this driver would expire if it stops sending updates
+        get_scheduler().schedule(crosswalk_id, deadline)
+        _schedule_evaluation(crosswalk_id)
 
 
 @sio_server.event
+async def driver_position(sid, data):
+    """
+    Raw GPS fix of a driver (data: lat, lon, speed, optional heading); the
+    server works out which crosswalks it is near and how far (see
+    app.driver_tracking), replacing per-crosswalk driver_enter/update/leave.
+    Acknowledged with the crosswalks it is tracked at, nearest first.
+    """
+    try:
+        lat, lon = float(data["lat"]), float(data["lon"])
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            raise ValueError("lat/lon out of range")
+        heading = data.get("heading")
+        position = DriverPosition(lat, lon, float(data.get("speed") or 0.0), float(heading) if heading is not None else None)
+        located = await get_driver_tracker().submit(sid, position)
+        return {
+            "crosswalks": [
+                {"crosswalk_id": crosswalk_id, "distance": distance}
+                for crosswalk_id, distance in sorted(located.items(), key=lambda item: item[1])
+            ]
+        }
+    except Exception as e:
+        return {"error": str(e)}
+
+
+@sio_server.event
+@sharded
 async def driver_leave(sid, data):
     crosswalk_id = data["crosswalk_id"]
     print(crosswalk_id)
     db = await get_client()
     await remove_driver(db, crosswalk_id, sid)
-    await _ensure_background_task_running(crosswalk_id)
+    await leave_room(sid, drivers_room(crosswalk_id))
+    _schedule_evaluation(crosswalk_id)
 
 
-async def _ensure_background_task_running(crosswalk_id: int):
+def _schedule_evaluation(crosswalk_id: int, view: Optional[CrosswalkView] = None):
     """
-    Uses Firestore-backed running_tasks to guarantee single task per crosswalk cluster-wide.
+    Marks the crosswalk for re-evaluation; bursts of updates are coalesced
+    into at most one evaluation per tick (see app.coalescer).
     """
-    db = await get_client()
-    try:
-        started = await add_running_task(db, crosswalk_id)
-        if started:
-            sio_server.start_background_task(handle_distance_based_notifications, crosswalk_id)
-    except Exception:
-        pass
-    
\ No newline at end of file
+    get_coalescer().mark(crosswalk_id, view)
@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Optional
+
+from prediction import init_worker
+
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "thread")  # "thread" or "process"
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_MAX_PENDING = int(os.getenv("INFERENCE_MAX_PENDING", "4"))
+
+
+class InferenceOverloaded(Exception):
+    """Raised instead of queueing work when the inference pool is saturated."""
+
+
+class InferencePool:
+    """
+    Runs blocking inference jobs in a dedicated thread or process pool so the
+    asyncio event loop (and with it driver_update / ped_critical traffic)
+    never waits on a forward pass. Each worker loads its own model through
+    `initializer` when it starts. At most `max_pending` jobs may be running
+    or queued; further submissions raise InferenceOverloaded.
+    """
+
+    def __init__(
+        self,
+        kind: str = INFERENCE_EXECUTOR,
+        workers: int = INFERENCE_WORKERS,
+        max_pending: int = INFERENCE_MAX_PENDING,
+        initializer: Optional[Callable[[], None]] = init_worker,
+    ):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"unknown inference executor: {kind}")
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        self._initializer = initializer
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self._initializer,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="inference",
+                    initializer=self._initializer,
+                )
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise InferenceOverloaded("inference queue is full")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), partial(fn, *args))
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+_pool: Optional[InferencePool] = None
+
+
+def get_inference_pool() -> InferencePool:
+    global _pool
+    if _pool is None:
+        _pool = InferencePool()
+    return _pool
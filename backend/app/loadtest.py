@@ -0,0 +1,477 @@
+"""
+End-to-end load harness. Runs the ASGI app from main.py in a child process
+on the in-process state backend (STATE_BACKEND=memory, the Firestore-compatible
+async fake from app.memory_store) and drives it over real Socket.IO
+connections with simulated pedestrians and drivers:
+
+    python -m app.loadtest run --peds 1000 --drivers 1000 --duration 60 --json after.json
+    python -m app.loadtest compare before.json after.json
+    python -m app.loadtest fanout --clients 500 --latency-ms 0.1
+
+Pedestrians join a crosswalk and send `predict` frames; drivers approach a
+crosswalk with pedestrians, sending `driver_update` every second, and
+measure the time from the update that puts them in the critical zone to
+the `driver_critical` they receive. The model is replaced by a fixed-time
+stub (--predict-ms) so the numbers reflect the serving path; batching,
+admission and the inference pool stay real. Client schedules are seeded,
+so runs with the same parameters are comparable across commits.
+
+Needs the asyncio Socket.IO client (aiohttp) in the harness process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+SOCKETIO_PATH = "ws/socket.io"
+LOADTEST_PREDICT_MS = float(os.getenv("LOADTEST_PREDICT_MS", "20"))
+
+
+def _raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# Server side
+
+def _stub_predict_batch(frames: List[Any]) -> List[bool]:
+    time.sleep(LOADTEST_PREDICT_MS / 1000.0)
+    return [False] * len(frames)
+
+
+def install_stub_model():
+    """
+    Replaces the prediction batcher and inference pool singletons with the
+    stub model. The pool has no worker initializer, so the real model (and
+    torch) is never loaded and runs measure the server path only.
+    """
+    from app import batching, inference_pool
+
+    inference_pool._pool = inference_pool.InferencePool(initializer=None)
+    batching._batcher = batching.PredictionBatcher(_stub_predict_batch, pool=inference_pool._pool)
+    return batching._batcher
+
+
+async def serve(host: str, port: int):
+    """Serves main.app with the stub model; prints the bound address once listening."""
+    import uvicorn
+    import main
+
+    install_stub_model()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    server = uvicorn.Server(uvicorn.Config(main.app, log_level="warning", backlog=4096))
+    print(f"listening on {host}:{sock.getsockname()[1]}", flush=True)
+    await server.serve(sockets=[sock])
+
+
+# Client side
+
+class Recorder:
+    def __init__(self):
+        self.sent: Counter = Counter()
+        self.received: Counter = Counter()
+        self.alert_latency: List[float] = []
+        self.predict_latency: List[float] = []
+        self.missed_alerts = 0
+        self.connected = 0
+        self.failed = 0
+        self.measuring = False
+
+    def on_sent(self, event: str):
+        if self.measuring:
+            self.sent[event] += 1
+
+    def on_received(self, event: str):
+        if self.measuring:
+            self.received[event] += 1
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    ms = np.asarray(samples) * 1e3
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return {"count": len(samples), "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(ms.max())}
+
+
+def expected_critical(distance: float, speed: float) -> bool:
+    """Whether the server's rule puts this driver in the critical zone of a crosswalk with peds."""
+    from app.alert_zones import evaluate_zones_scalar
+
+    now = time.time()
+    critical = evaluate_zones_scalar({"d": {"distance": distance, "speed": speed, "ts": now}}, {}, 1, now)[2]
+    return bool(critical)
+
+
+def sample_frame(seed: int) -> bytes:
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    ok, buf = cv2.imencode(".jpg", rng.integers(0, 255, (96, 96, 3), dtype=np.uint8))
+    return buf.tobytes()
+
+
+class SimClient:
+    def __init__(self, url: str, rec: Recorder, start: asyncio.Event, stop: asyncio.Event, connect_slots: asyncio.Semaphore):
+        self.url = url
+        self.rec = rec
+        self.start = start
+        self.stop = stop
+        self._connect_slots = connect_slots
+        self.sio = None
+
+    async def connect(self) -> bool:
+        import socketio
+
+        self.sio = socketio.AsyncClient(reconnection=False)
+
+        @self.sio.on("*")
+        async def any_event(event, *args):
+            self.rec.on_received(event)
+
+        async with self._connect_slots:
+            try:
+                await self.sio.connect(self.url, socketio_path=SOCKETIO_PATH, transports=["websocket"])
+            except Exception:
+                self.rec.failed += 1
+                return False
+        self.rec.connected += 1
+        return True
+
+    async def emit(self, event: str, *args):
+        await self.sio.emit(event, args[0] if len(args) == 1 else args)
+        self.rec.on_sent(event)
+
+    async def sleep(self, seconds: float) -> bool:
+        """Sleeps unless the run stops first; returns False once stopped."""
+        try:
+            await asyncio.wait_for(self.stop.wait(), seconds)
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+    async def close(self):
+        try:
+            await self.sio.disconnect()
+        except Exception:
+            pass
+
+
+async def run_ped(client: SimClient, index: int, crosswalk_id: int, fps: float, rng: random.Random):
+    username = f"ped{index}"
+    frame = sample_frame(index)
+    inflight_since: List[Optional[float]] = [None]
+
+    # Time from the oldest unanswered frame to a result (superseded frames get none)
+    @client.sio.on(f"predict_result_{username}")
+    async def on_result(result):
+        client.rec.on_received("predict_result")
+        if inflight_since[0] is not None and client.rec.measuring:
+            client.rec.predict_latency.append(time.perf_counter() - inflight_since[0])
+        inflight_since[0] = None
+
+    await client.start.wait()
+    await client.emit("ped_enter", {"crosswalk_id": crosswalk_id})
+    if fps <= 0:
+        await client.stop.wait()
+        return
+    period = 1.0 / fps
+    if not await client.sleep(rng.uniform(0, period)):
+        return
+    while True:
+        if inflight_since[0] is None:
+            inflight_since[0] = time.perf_counter()
+        await client.emit("predict", username, frame, False)
+        if not await client.sleep(period):
+            return
+
+
+async def run_driver(client: SimClient, crosswalk_id: int, interval: float, rng: random.Random):
+    state = {"pending": None, "alerted": False}
+
+    @client.sio.on("driver_critical")
+    async def on_critical(payload):
+        client.rec.on_received("driver_critical")
+        if state["pending"] is not None:
+            if client.rec.measuring:
+                client.rec.alert_latency.append(time.perf_counter() - state["pending"])
+            state["pending"] = None
+        state["alerted"] = True
+
+    await client.start.wait()
+    if not await client.sleep(rng.uniform(0, interval)):
+        return
+    while True:
+        distance, speed = rng.uniform(150, 400), rng.uniform(8, 15)
+        state.update(pending=None, alerted=False)
+        await client.emit("driver_enter", {"crosswalk_id": crosswalk_id, "distance": distance, "speed": speed})
+        while distance > 0:
+            if not await client.sleep(interval * rng.uniform(0.9, 1.1)):
+                return
+            distance = max(0.0, distance - speed * interval)
+            sent = time.perf_counter()
+            await client.emit("driver_update", {"crosswalk_id": crosswalk_id, "distance": distance, "speed": speed})
+            if not state["alerted"] and state["pending"] is None and expected_critical(distance, speed):
+                state["pending"] = sent
+        if state["pending"] is not None and client.rec.measuring:
+            client.rec.missed_alerts += 1
+        await client.emit("driver_leave", {"crosswalk_id": crosswalk_id})
+
+
+def _rss_mb(pid: int) -> Dict[str, Optional[float]]:
+    fields = {}
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                fields[key] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return {"rss": fields.get("VmRSS"), "peak": fields.get("VmHWM")}
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+async def _fetch_stats(url: str) -> Optional[Dict[str, Any]]:
+    import aiohttp
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{url}/stats") as resp:
+                return await resp.json()
+    except Exception:
+        return None
+
+
+async def run(args) -> Dict[str, Any]:
+    _raise_fd_limit()
+    env = {**os.environ, "STATE_BACKEND": "memory", "SHARD_BROKER_URL": "", "LOADTEST_PREDICT_MS": str(args.predict_ms)}
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "app.loadtest", "serve", "--port", "0",
+        cwd=str(BACKEND_DIR), env=env, stdout=asyncio.subprocess.PIPE,
+    )
+    try:
+        line = (await asyncio.wait_for(proc.stdout.readline(), 60)).decode()
+        url = "http://127.0.0.1:" + line.strip().rsplit(":", 1)[1]
+        rec = Recorder()
+        start, stop = asyncio.Event(), asyncio.Event()
+        slots = asyncio.Semaphore(args.connect_concurrency)
+
+        clients, runners = [], []
+        for i in range(args.peds):
+            client = SimClient(url, rec, start, stop, slots)
+            clients.append(client)
+            runners.append((client, "ped", i))
+        for i in range(args.drivers):
+            client = SimClient(url, rec, start, stop, slots)
+            clients.append(client)
+            runners.append((client, "driver", i))
+        connected = await asyncio.gather(*(c.connect() for c in clients))
+
+        # Drivers head for crosswalks that have pedestrians, so alerts can fire
+        ped_crosswalks = max(1, min(args.crosswalks, args.peds or args.crosswalks))
+        tasks = []
+        for (client, kind, i), ok in zip(runners, connected):
+            if not ok:
+                continue
+            rng = random.Random(f"{args.seed}:{kind}:{i}")
+            if kind == "ped":
+                coro = run_ped(client, i, 1 + i % args.crosswalks, args.predict_fps, rng)
+            else:
+                coro = run_driver(client, 1 + i % ped_crosswalks, args.update_interval, rng)
+            tasks.append(asyncio.create_task(coro))
+
+        start.set()
+        await asyncio.sleep(args.warmup)
+        rec.measuring = True
+        began = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        rec.measuring = False
+        elapsed = time.perf_counter() - began
+        server_stats = await _fetch_stats(url)
+        memory = _rss_mb(proc.pid)
+
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(c.close() for c in clients if c.sio is not None))
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+
+    return {
+        "commit": _commit(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("command", "json")},
+        "clients": {"connected": rec.connected, "failed": rec.failed},
+        "duration_s": elapsed,
+        "events": {
+            "sent": dict(rec.sent),
+            "received": dict(rec.received),
+            "sent_per_s": sum(rec.sent.values()) / elapsed,
+            "received_per_s": sum(rec.received.values()) / elapsed,
+        },
+        "alert_latency_ms": percentiles(rec.alert_latency),
+        "missed_alerts": rec.missed_alerts,
+        "predict_latency_ms": percentiles(rec.predict_latency),
+        "memory_mb": {
+            "server_rss": memory["rss"],
+            "server_peak": memory["peak"],
+            "harness_peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+        "server": server_stats,
+    }
+
+
+COMPARED = (
+    ("alert p50 ms", ("alert_latency_ms", "p50")),
+    ("alert p99 ms", ("alert_latency_ms", "p99")),
+    ("missed alerts", ("missed_alerts",)),
+    ("predict p50 ms", ("predict_latency_ms", "p50")),
+    ("predict p99 ms", ("predict_latency_ms", "p99")),
+    ("sent/s", ("events", "sent_per_s")),
+    ("received/s", ("events", "received_per_s")),
+    ("server peak MB", ("memory_mb", "server_peak")),
+)
+
+
+def _lookup(report: Dict[str, Any], path) -> Optional[float]:
+    value: Any = report
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(before: Dict[str, Any], after: Dict[str, Any]) -> List[str]:
+    lines = [f"{'':>16} {before.get('commit') or 'before':>12} {after.get('commit') or 'after':>12}   change"]
+    if before.get("params") != after.get("params"):
+        lines.append("warning: runs used different parameters")
+    for label, path in COMPARED:
+        a, b = _lookup(before, path), _lookup(after, path)
+        change = f"{(b - a) / a * 100:+7.1f}%" if a and b is not None else "      -"
+        fmt = lambda v: f"{v:12.2f}" if v is not None else f"{'-':>12}"
+        lines.append(f"{label:>16} {fmt(a)} {fmt(b)}   {change}")
+    return lines
+
+
+def summary(report: Dict[str, Any]) -> List[str]:
+    alert, predict, events = report["alert_latency_ms"], report["predict_latency_ms"], report["events"]
+    fmt = lambda s: "n/a" if not s["count"] else f"p50 {s['p50']:.1f}  p90 {s['p90']:.1f}  p99 {s['p99']:.1f}  max {s['max']:.1f} ms"
+    return [
+        f"clients: {report['clients']['connected']} connected, {report['clients']['failed']} failed",
+        f"events: {events['sent_per_s']:.0f} sent/s, {events['received_per_s']:.0f} received/s over {report['duration_s']:.1f} s",
+        f"driver_update -> driver_critical ({alert['count']}): {fmt(alert)}; missed {report['missed_alerts']}",
+        f"predict ({predict['count']}): {fmt(predict)}",
+        f"memory: server {report['memory_mb']['server_rss'] or 0:.0f} MB (peak {report['memory_mb']['server_peak'] or 0:.0f}), "
+        f"harness peak {report['memory_mb']['harness_peak']:.0f} MB",
+    ]
+
+
+# Presence fan-out strategies
+
+async def fanout_benchmark(clients: int, repeat: int, latency: float):
+    """
+    Fan-out latency of one presence broadcast to `clients` members on a
+    standalone server whose transport takes `latency` seconds per packet.
+    """
+    import socketio
+
+    server = socketio.AsyncServer(async_mode="asgi")
+    server.manager_initialized = True
+    server.manager.initialize()
+
+    async def send_packet(eio_sid, pkt):
+        await asyncio.sleep(latency)
+
+    server.eio.send_packet = send_packet
+    sids = []
+    for i in range(clients):
+        sid = await server.manager.connect(f"eio{i}", "/")
+        await server.enter_room(sid, "bench")
+        sids.append(sid)
+    payload = {"crosswalk_id": 1, "ped_count": clients, "driver_count": 0, "ts": 0}
+
+    async def serial():
+        for sid in sids:
+            await server.emit("presence", payload, to=sid)
+
+    async def concurrent():
+        await asyncio.gather(*(server.emit("presence", payload, to=sid) for sid in sids))
+
+    async def room():
+        await server.emit("presence", payload, room="bench")
+
+    for label, fanout in (("serial per-sid", serial), ("concurrent per-sid", concurrent), ("room", room)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await fanout()
+            best = min(best, time.perf_counter() - start)
+        print(f"{label:>20}: {best * 1e3:8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end load test against an in-memory state backend")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="start a server and drive it with simulated clients")
+    run_parser.add_argument("--peds", type=int, default=500)
+    run_parser.add_argument("--drivers", type=int, default=500)
+    run_parser.add_argument("--crosswalks", type=int, default=100)
+    run_parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    run_parser.add_argument("--warmup", type=float, default=5.0)
+    run_parser.add_argument("--predict-fps", type=float, default=1.0, help="frames per second per pedestrian")
+    run_parser.add_argument("--predict-ms", type=float, default=LOADTEST_PREDICT_MS, help="stub model time per batch")
+    run_parser.add_argument("--update-interval", type=float, default=1.0, help="seconds between driver updates")
+    run_parser.add_argument("--connect-concurrency", type=int, default=50)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--json", help="write the report to this file")
+    serve_parser = sub.add_parser("serve", help="run the app with the stub model (used by `run`)")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=0)
+    compare_parser = sub.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    fanout_parser = sub.add_parser("fanout", help="benchmark presence fan-out strategies")
+    fanout_parser.add_argument("--clients", type=int, default=500)
+    fanout_parser.add_argument("--repeat", type=int, default=5)
+    fanout_parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated send time per packet")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        _raise_fd_limit()
+        asyncio.run(serve(args.host, args.port))
+    elif args.command == "compare":
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        print("\n".join(compare(before, after)))
+    elif args.command == "fanout":
+        asyncio.run(fanout_benchmark(args.clients, args.repeat, args.latency_ms / 1e3))
+    else:
+        report = asyncio.run(run(args))
+        print("\n".join(summary(report)))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
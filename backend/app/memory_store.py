@@ -0,0 +1,472 @@
+"""
+In-process stand-in for the subset of the Firestore AsyncClient API used by
+app.state and app.notifications: documents, dotted-path updates with
+ArrayUnion / ArrayRemove / DELETE_FIELD, create/delete, `last_update_time`
+write preconditions, collection reads, write batches and transactions
+compatible with `async_transactional`.
+
+Used directly as the state backend for tests and single-node deployments,
+or with a FirestorePersister that mirrors changed documents to Firestore in
+the background (write-behind) while all reads stay in process.
+"""
+import asyncio
+import copy
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion, DELETE_FIELD
+
+logger = logging.getLogger(__name__)
+
+
+def _split_path(field_path: str) -> List[str]:
+    return field_path.split(".")
+
+
+def _apply_value(current: Any, value: Any) -> Any:
+    if isinstance(value, ArrayUnion):
+        arr = list(current) if isinstance(current, list) else []
+        for v in value.values:
+            if v not in arr:
+                arr.append(v)
+        return arr
+    if isinstance(value, ArrayRemove):
+        arr = list(current) if isinstance(current, list) else []
+        return [v for v in arr if v not in value.values]
+    return copy.deepcopy(value)
+
+
+def _apply_updates(doc: Dict[str, Any], updates: Dict[str, Any]):
+    for field_path, value in updates.items():
+        *parents, last = _split_path(field_path)
+        target: Optional[Dict[str, Any]] = doc
+        for part in parents:
+            child = target.get(part)
+            if not isinstance(child, dict):
+                if value is DELETE_FIELD:
+                    target = None
+                    break
+                child = target[part] = {}
+            target = child
+        if target is None:
+            continue
+        if value is DELETE_FIELD:
+            target.pop(last, None)
+        else:
+            target[last] = _apply_value(target.get(last), value)
+
+
+def _merge(target: Dict[str, Any], data: Dict[str, Any]):
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif isinstance(value, dict):
+            # New map: merge into an empty one so nested DELETE_FIELDs are dropped
+            child: Dict[str, Any] = {}
+            _merge(child, value)
+            if child or not value:
+                target[key] = child
+        else:
+            target[key] = _apply_value(target.get(key), value)
+
+
+class MemoryWriteOption:
+    """Precondition from `MemoryClient.write_option(last_update_time=...)`."""
+
+    def __init__(self, last_update_time: float):
+        self.last_update_time = last_update_time
+
+
+class MemoryWriteResult:
+    def __init__(self, update_time: Optional[float]):
+        self.update_time = update_time
+
+
+class MemorySnapshot:
+    def __init__(self, reference: "MemoryDocumentRef", data: Optional[Dict[str, Any]], update_time: Optional[float]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        value: Any = self._data
+        for part in _split_path(field_path):
+            if not isinstance(value, dict) or part not in value:
+                raise KeyError(field_path)
+            value = value[part]
+        return copy.deepcopy(value)
+
+
+class MemoryDocumentRef:
+    def __init__(self, client: "MemoryClient", collection: str, doc_id: str):
+        self._client = client
+        self._collection = collection
+        self.id = str(doc_id)
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection}/{self.id}"
+
+    def _snapshot(self) -> MemorySnapshot:
+        data, update_time = self._client._read(self._collection, self.id)
+        return MemorySnapshot(self, data, update_time)
+
+    async def get(self, field_paths=None, transaction=None) -> MemorySnapshot:
+        return self._snapshot()
+
+    def _set(self, data: Dict[str, Any], merge: bool = False):
+        current, _ = self._client._raw(self._collection, self.id)
+        doc = current if merge and current is not None else {}
+        _merge(doc, data)
+        self._client._write(self._collection, self.id, doc)
+
+    def _update(self, updates: Dict[str, Any], option: Optional[MemoryWriteOption] = None):
+        current, update_time = self._client._raw(self._collection, self.id)
+        if current is None:
+            raise NotFound(f"No document to update: {self.path}")
+        if option is not None and option.last_update_time != update_time:
+            raise FailedPrecondition(f"Document changed since {option.last_update_time}: {self.path}")
+        _apply_updates(current, updates)
+        return self._client._write(self._collection, self.id, current)
+
+    def _create(self, data: Dict[str, Any]):
+        current, _ = self._client._raw(self._collection, self.id)
+        if current is not None:
+            raise AlreadyExists(f"Document already exists: {self.path}")
+        self._set(data)
+
+    def _delete(self):
+        self._client._write(self._collection, self.id, None)
+
+    async def set(self, document_data: Dict[str, Any], merge: bool = False):
+        self._set(document_data, merge=merge)
+
+    async def update(self, field_updates: Dict[str, Any], option: Optional[MemoryWriteOption] = None):
+        return MemoryWriteResult(self._update(field_updates, option))
+
+    async def create(self, document_data: Dict[str, Any]):
+        self._create(document_data)
+
+    async def delete(self):
+        self._delete()
+
+
+class MemoryQuery:
+    def __init__(self, client: "MemoryClient", collection: str):
+        self._client = client
+        self._collection = collection
+
+    def select(self, field_paths: Iterable[str]) -> "MemoryQuery":
+        return self
+
+    def document(self, doc_id: str) -> MemoryDocumentRef:
+        return MemoryDocumentRef(self._client, self._collection, doc_id)
+
+    async def get(self, transaction=None) -> List[MemorySnapshot]:
+        return [self.document(doc_id)._snapshot() for doc_id in self._client.document_ids(self._collection)]
+
+    async def stream(self, transaction=None):
+        for snap in await self.get():
+            yield snap
+
+
+def _apply_writes(writes: List[Tuple[str, "MemoryDocumentRef", Any]]):
+    for op, ref, data in writes:
+        if op == "set":
+            ref._set(*data)
+        elif op == "update":
+            ref._update(data)
+        elif op == "create":
+            ref._create(data)
+        elif op == "delete":
+            ref._delete()
+
+
+class MemoryTransaction:
+    """
+    Buffers writes and applies them atomically on commit. Implements the
+    hooks `google.cloud.firestore_v1.async_transactional` drives, so state
+    helpers written against Firestore transactions run unchanged.
+    """
+
+    def __init__(self, client: "MemoryClient", max_attempts: int = 5, read_only: bool = False):
+        self._client = client
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id: Optional[bytes] = None
+        self._writes: List[Tuple[str, MemoryDocumentRef, Any]] = []
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    async def _begin(self, retry_id: Optional[bytes] = None):
+        self._id = str(time.monotonic_ns()).encode()
+
+    async def _rollback(self):
+        self._clean_up()
+
+    async def _commit(self) -> list:
+        writes, self._writes = self._writes, []
+        _apply_writes(writes)
+        self._id = None
+        return []
+
+    def set(self, reference: MemoryDocumentRef, document_data: Dict[str, Any], merge: bool = False):
+        self._writes.append(("set", reference, (document_data, merge)))
+
+    def update(self, reference: MemoryDocumentRef, field_updates: Dict[str, Any]):
+        self._writes.append(("update", reference, field_updates))
+
+    def create(self, reference: MemoryDocumentRef, document_data: Dict[str, Any]):
+        self._writes.append(("create", reference, document_data))
+
+    def delete(self, reference: MemoryDocumentRef):
+        self._writes.append(("delete", reference, None))
+
+    async def get(self, ref_or_query):
+        return await ref_or_query.get(transaction=self)
+
+
+class MemoryWriteBatch:
+    """Buffers writes and applies them together on `commit`, like AsyncWriteBatch."""
+
+    def __init__(self, client: "MemoryClient"):
+        self._client = client
+        self._writes: List[Tuple[str, MemoryDocumentRef, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def set(self, reference: MemoryDocumentRef, document_data: Dict[str, Any], merge: bool = False):
+        self._writes.append(("set", reference, (document_data, merge)))
+
+    def update(self, reference: MemoryDocumentRef, field_updates: Dict[str, Any]):
+        self._writes.append(("update", reference, field_updates))
+
+    def create(self, reference: MemoryDocumentRef, document_data: Dict[str, Any]):
+        self._writes.append(("create", reference, document_data))
+
+    def delete(self, reference: MemoryDocumentRef):
+        self._writes.append(("delete", reference, None))
+
+    async def commit(self) -> list:
+        writes, self._writes = self._writes, []
+        _apply_writes(writes)
+        return []
+
+
+class MemoryClient:
+    def __init__(self, persister: Optional["FirestorePersister"] = None):
+        self._collections: Dict[str, Dict[str, Tuple[Dict[str, Any], float]]] = {}
+        self._persister = persister
+        self._last_update_time = 0.0
+        if persister is not None:
+            persister.bind(self)
+
+    def collection(self, name: str) -> MemoryQuery:
+        return MemoryQuery(self, name)
+
+    def document(self, path: str) -> MemoryDocumentRef:
+        collection, doc_id = path.split("/", 1)
+        return MemoryDocumentRef(self, collection, doc_id)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> MemoryTransaction:
+        return MemoryTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def write_option(self, last_update_time: float) -> MemoryWriteOption:
+        return MemoryWriteOption(last_update_time)
+
+    def _raw(self, collection: str, doc_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        entry = self._collections.get(collection, {}).get(doc_id)
+        if entry is None:
+            return None, None
+        return copy.deepcopy(entry[0]), entry[1]
+
+    def _read(self, collection: str, doc_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        entry = self._collections.get(collection, {}).get(doc_id)
+        if entry is None:
+            return None, None
+        return entry[0], entry[1]
+
+    def _write(self, collection: str, doc_id: str, data: Optional[Dict[str, Any]]) -> Optional[float]:
+        """Stores (or deletes) the document; returns its new update time."""
+        docs = self._collections.setdefault(collection, {})
+        update_time = None
+        if data is None:
+            docs.pop(doc_id, None)
+        else:
+            # Strictly increasing, so every write is visible to a last_update_time precondition
+            self._last_update_time = max(time.time(), self._last_update_time + 1e-6)
+            docs[doc_id] = (data, self._last_update_time)
+            update_time = self._last_update_time
+        if self._persister is not None:
+            self._persister.mark(collection, doc_id)
+        return update_time
+
+    # Handoff between nodes (see app.sharding)
+
+    def document_ids(self, collection: str) -> List[str]:
+        return list(self._collections.get(collection, {}).keys())
+
+    def export_document(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        """A copy of the document's data, or None when it does not exist."""
+        data, _ = self._raw(collection, doc_id)
+        return data
+
+    def import_document(self, collection: str, doc_id: str, data: Dict[str, Any]) -> bool:
+        """Stores a document exported by another node unless one is already held; returns whether it was."""
+        if doc_id in self._collections.get(collection, {}):
+            return False
+        self._write(collection, doc_id, copy.deepcopy(data))
+        return True
+
+    def evict_document(self, collection: str, doc_id: str):
+        """Drops a document from this process only, e.g. after handing it to another node."""
+        self._collections.get(collection, {}).pop(doc_id, None)
+        if self._persister is not None:
+            self._persister.discard(collection, doc_id)
+
+    async def close(self):
+        if self._persister is not None:
+            await self._persister.close(self)
+
+
+class FirestorePersister:
+    """
+    Write-behind mirror of a MemoryClient into Firestore. Changed documents
+    are only marked dirty on the hot path, so any number of updates to one
+    document between flushes merge into a single write of its current
+    version. Every `interval` seconds, or as soon as `max_dirty` documents
+    are pending, the dirty documents are written with batched writes of up
+    to `batch_size` operations.
+    """
+
+    def __init__(
+        self,
+        firestore,
+        interval: float = 1.0,
+        collections: Iterable[str] = ("crosswalks", "sessions"),
+        max_dirty: int = 200,
+        batch_size: int = 500,
+    ):
+        self._firestore = firestore
+        self.interval = interval
+        self.collections: Set[str] = set(collections)
+        self.max_dirty = max(1, max_dirty)
+        self.batch_size = max(1, min(batch_size, 500))  # Firestore's per-batch limit
+        self._dirty: Set[Tuple[str, str]] = set()
+        self._source: Optional[MemoryClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._closing = False
+        self.buffered = 0
+        self.merged = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+
+    def mark(self, collection: str, doc_id: str):
+        if collection not in self.collections:
+            return
+        key = (collection, doc_id)
+        self.buffered += 1
+        if key in self._dirty:
+            self.merged += 1
+        else:
+            self._dirty.add(key)
+        if self._task is None or self._task.done():
+            try:
+                self._task = asyncio.get_running_loop().create_task(self._run())
+            except RuntimeError:
+                pass
+        if len(self._dirty) >= self.max_dirty and self._wake is not None:
+            self._wake.set()
+
+    def discard(self, collection: str, doc_id: str):
+        self._dirty.discard((collection, doc_id))
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        if len(self._dirty) >= self.max_dirty:
+            self._wake.set()
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush(self._source)
+
+    async def flush(self, source: Optional[MemoryClient]):
+        if source is None:
+            return
+        dirty, self._dirty = list(self._dirty), set()
+        for start in range(0, len(dirty), self.batch_size):
+            chunk = dirty[start:start + self.batch_size]
+            batch = self._firestore.batch()
+            for collection, doc_id in chunk:
+                data = source.export_document(collection, doc_id)
+                ref = self._firestore.collection(collection).document(doc_id)
+                if data is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, data)
+            try:
+                await batch.commit()
+                self.flushed += len(chunk)
+                self.batches += 1
+            except Exception:
+                # Keep them dirty so the next flush retries the latest versions
+                self.failed += len(chunk)
+                self._dirty.update(chunk)
+                logger.exception("Failed to persist a batch of %d documents", len(chunk))
+
+    def bind(self, source: MemoryClient):
+        self._source = source
+
+    async def close(self, source: MemoryClient):
+        """
+        Stops the flush loop and writes whatever is still dirty. A flush in
+        progress is awaited, not cancelled: the documents it took out of the
+        dirty set are only persisted once its commits complete.
+        """
+        if self._task is not None and not self._task.done():
+            self._closing = True
+            if self._wake is not None:
+                self._wake.set()
+            try:
+                await self._task
+            finally:
+                self._closing = False
+        self._task = None
+        await self.flush(source)
+
+    def stats(self) -> dict:
+        return {
+            "dirty": len(self._dirty),
+            "buffered": self.buffered,
+            "merged": self.merged,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
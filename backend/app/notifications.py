@@ -1,30 +1,163 @@
+import asyncio
+import logging
+import os
 import time
-from typing import List, Dict, Any
+import zlib
+from typing import List, Dict, Any, NamedTuple, Optional, Union
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1 import DELETE_FIELD
 from sockets import sio_server
 from app.state import (
     get_client,
-    get_crosswalk,
-    crosswalk_ref,
-    set_last_broadcast_value,
-    clear_last_broadcast_key,
-    remove_driver,
-    remove_running_task,
+    get_crosswalk_view,
+    update_crosswalk,
+    view_is_fresh,
+    CrosswalkView,
     DRIVER_PRESENCE_TTL,
     DEBOUNCE_MIN_DISTANCE_DELTA,
 )
+from app.alert_zones import evaluate_crosswalks
+
+logger = logging.getLogger(__name__)
+
+# Presence is only broadcast when the counts or the members change (a ped
+# replacing another in one evaluation window still needs its first presence);
+# a positive value also re-sends unchanged presence after this many seconds
+# as a keepalive.
+PRESENCE_KEEPALIVE_S = float(os.getenv("PRESENCE_KEEPALIVE_S", "0"))
+
+# Attempts at writing an evaluation's deltas before giving up on this run
+# (the write is conditional on the document not having changed since read).
+EVALUATION_MAX_ATTEMPTS = int(os.getenv("EVALUATION_MAX_ATTEMPTS", "3"))
+
+# An evaluation that could not complete (e.g. a Firestore error) asks to be
+# retried this many seconds later instead of dropping the crosswalk's deadline.
+EVALUATION_RETRY_S = float(os.getenv("EVALUATION_RETRY_S", "2.0"))
+
+
+
+def peds_room(crosswalk_id: int) -> str:
+    return f"cw:{crosswalk_id}:peds"
+
+
+def drivers_room(crosswalk_id: int) -> str:
+    return f"cw:{crosswalk_id}:drivers"
+
+
+class FanoutStats:
+    """Wall time of each fan-out (one room emit or one concurrent per-sid batch)."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.presence_suppressed = 0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def stats(self) -> dict:
+        return {
+            "fanouts": self.count,
+            "avg_ms": self.total / self.count * 1e3 if self.count else 0.0,
+            "max_ms": self.max * 1e3,
+            "presence_suppressed": self.presence_suppressed,
+        }
+
+
+_fanout_stats = FanoutStats()
+
+
+def get_fanout_stats() -> FanoutStats:
+    return _fanout_stats
+
+
+class ViewStats:
+    """How often an evaluation could use the view it was handed instead of reading."""
+
+    def __init__(self):
+        self.evaluations = 0
+        self.reads = 0
+        self.views_used = 0
+        self.views_stale = 0
+
+    def stats(self) -> dict:
+        return {
+            "evaluations": self.evaluations,
+            "reads": self.reads,
+            "views_used": self.views_used,
+            "views_stale": self.views_stale,
+            "reads_per_evaluation": self.reads / self.evaluations if self.evaluations else 0.0,
+        }
+
+
+_view_stats = ViewStats()
+
+
+def get_view_stats() -> ViewStats:
+    return _view_stats
+
+
+class WriteStats:
+    """Outcome of evaluation writes; `contention` is the share of attempts that conflicted."""
+
+    def __init__(self):
+        self.writes = 0
+        self.unchanged = 0
+        self.conflicts = 0
+        self.gave_up = 0
+
+    def stats(self) -> dict:
+        attempts = self.writes + self.conflicts
+        return {
+            "writes": self.writes,
+            "unchanged": self.unchanged,
+            "conflicts": self.conflicts,
+            "gave_up": self.gave_up,
+            "contention": self.conflicts / attempts if attempts else 0.0,
+        }
+
+
+_write_stats = WriteStats()
+
+
+def get_write_stats() -> WriteStats:
+    return _write_stats
+
+
+async def _emit_one(event: str, payload: dict, to: str):
+    try:
+        await sio_server.emit(event, payload, to=to)
+    except Exception:
+        pass
 
-MIN_ALERT_SPEED_MPS = 1.0
-DRIVER_REACTION_TIME_S = 1.5
-AVG_DECELERATION_MPS2 = 6.0
-SAFETY_BUFFER_M = 20
-OUTER_ALERT_TIME_FACTOR = 2.5
 
 async def emit_to_sids(sids: List[str], event: str, payload: dict):
-    for sid in sids:
-        try:
-            await sio_server.emit(event, payload, to=sid)
-        except Exception:
-            pass
+    """Per-sid emits, sent concurrently."""
+    if not sids:
+        return
+    start = time.perf_counter()
+    await asyncio.gather(*(_emit_one(event, payload, sid) for sid in sids))
+    _fanout_stats.record(time.perf_counter() - start)
+
+
+async def emit_to_room(room: Union[str, List[str]], event: str, payload: dict):
+    """One emit to a room (or several, each member once); the packet is encoded once."""
+    start = time.perf_counter()
+    try:
+        await sio_server.emit(event, payload, room=room)
+    except Exception:
+        pass
+    _fanout_stats.record(time.perf_counter() - start)
+
+
+async def leave_room(sid: str, room: str):
+    try:
+        await sio_server.leave_room(sid, room)
+    except Exception:
+        pass
 
 
 async def emit_presence(crosswalk_id: int, peds: List[str], drivers: List[str]):
@@ -34,124 +167,167 @@ async def emit_presence(crosswalk_id: int, peds: List[str], drivers: List[str]):
         "driver_count": len(drivers),
         "ts": int(time.time())
     }
-    await emit_to_sids(peds, "presence", payload)
-    await emit_to_sids(drivers, "presence", payload)
+    await emit_to_room([peds_room(crosswalk_id), drivers_room(crosswalk_id)], "presence", payload)
+
+async def _current_view(db, crosswalk_id: int, view: Optional[CrosswalkView]) -> Optional[CrosswalkView]:
+    """`view` if it is still fresh, otherwise the crosswalk as read now."""
+    if view is not None:
+        if view_is_fresh(view, crosswalk_id):
+            _view_stats.views_used += 1
+            return view
+        _view_stats.views_stale += 1
+    _view_stats.reads += 1
+    return await get_crosswalk_view(db, crosswalk_id)
+
+
+def _members_digest(peds: List[str], drivers: Dict[str, Any]) -> str:
+    """Short fingerprint of who is at the crosswalk, stored with the last presence sent."""
+    members = "\0".join(sorted(peds)) + "\1" + "\0".join(sorted(drivers))
+    return format(zlib.crc32(members.encode()), "08x")
 
-async def handle_distance_based_notifications(crosswalk_id: int, cw: Dict[str, Any] = None):
+
+class _Evaluation(NamedTuple):
+    updates: Dict[str, Any]
+    driver_events: Dict[str, List[str]]
+    ped_alert_payload: Optional[Dict[str, Any]]
+    ped_alert_end: bool
+    send_presence: bool
+    peds: List[str]
+    drivers: Dict[str, Dict[str, Any]]
+
+
+def _evaluate(crosswalk_id: int, cw: Dict[str, Any], now: float) -> _Evaluation:
     """
-    Reads crosswalk document, applies TTL pruning + critical distance logic,
-    updates last_broadcast fields, and emits events.
-    Persists driver critical state in last_broadcast.driver_critical_active (map sid -> last distance).
+    Applies TTL pruning + critical distance logic to one crosswalk document
+    and returns the field-level updates it implies along with what to emit.
     """
-    db = await get_client()
-    if cw is None:
-        cw = await get_crosswalk(db, crosswalk_id)
-    if not cw:
-        await remove_running_task(db, crosswalk_id)
-        return
-    try:
-        cw = await get_crosswalk(db, crosswalk_id)
-        if not cw:
-            await remove_running_task(db, crosswalk_id)
-            return
+    peds: List[str] = cw.get("peds", [])
+    drivers_map: Dict[str, Dict[str, Any]] = dict(cw.get("drivers", {}) or {})
+    last_broadcast: Dict[str, Any] = cw.get("last_broadcast", {}) or {}
+    driver_active_map: Dict[str, float] = last_broadcast.get("driver_critical_active", {}) or {}
 
-        now = time.time()
-        peds: List[str] = cw.get("peds", [])
-        drivers_map: Dict[str, Dict[str, Any]] = cw.get("drivers", {}) or {}
-        last_broadcast: Dict[str, Any] = cw.get("last_broadcast", {}) or {}
+    ped_count = len(peds)
+    prev_ped_critical = last_broadcast.get("ped_critical_min_distance")
 
-        driver_active_map: Dict[str, float] = last_broadcast.get("driver_critical_active", {}) or {}
+    updates: Dict[str, Any] = {}
+    ped_alert_end = False
+    ped_alert_payload = None
+    driver_events: Dict[str, List[str]] = {"driver_critical": [], "alert_end": []}
 
-        cutoff = now - DRIVER_PRESENCE_TTL
-        expired = [sid for sid, info in drivers_map.items() if info.get("ts", 0) < cutoff]
-        for sid in expired:
+    zones = evaluate_crosswalks([(drivers_map, driver_active_map, ped_count)], now)[0]
+    masks = zones.masks
+    for sid, expired, critical, ended in zip(zones.sids, masks.expired, masks.driver_critical, masks.alert_end):
+        active_key = f"last_broadcast.driver_critical_active.{sid}"
+        if expired:
             drivers_map.pop(sid, None)
-            driver_active_map.pop(sid, None)
-
-        ped_count = len(peds)
-        prev_ped_critical = last_broadcast.get("ped_critical_min_distance")
+            updates[f"drivers.{sid}"] = DELETE_FIELD
+            if sid in driver_active_map:
+                updates[active_key] = DELETE_FIELD
+        elif critical:
+            driver_events["driver_critical"].append(sid)
+            distance = drivers_map[sid]["distance"]
+            if driver_active_map.get(sid) != distance:
+                updates[active_key] = distance
+        elif ended:
+            driver_events["alert_end"].append(sid)
+            updates[active_key] = DELETE_FIELD
 
-        ped_alert_end_to_emit = False
-        ped_alert_payload = None
-        ped_alert_end_payload = None
+    if zones.nearest is None:
+        if prev_ped_critical is not None:
+            ped_alert_end = True
+            updates["last_broadcast.ped_critical_min_distance"] = DELETE_FIELD
+    else:
+        min_trigger = drivers_map[zones.nearest]["distance"]
+        if ped_count > 0 and (
+            prev_ped_critical is None or abs(prev_ped_critical - min_trigger) >= DEBOUNCE_MIN_DISTANCE_DELTA
+        ):
+            updates["last_broadcast.ped_critical_min_distance"] = min_trigger
+            ped_alert_payload = {
+                "crosswalk_id": crosswalk_id,
+                "min_distance": min_trigger,
+                "ts": int(now),
+            }
 
-        driver_events = []  # list[(event_type, sid)]
+    presence = {
+        "ped_count": len(peds),
+        "driver_count": len(drivers_map),
+        "members": _members_digest(peds, drivers_map),
+    }
+    prev_presence = last_broadcast.get("presence") or {}
+    send_presence = (
+        any(prev_presence.get(k) != v for k, v in presence.items())
+        or (PRESENCE_KEEPALIVE_S > 0 and now - prev_presence.get("ts", 0) >= PRESENCE_KEEPALIVE_S)
+    )
+    if send_presence:
+        updates["last_broadcast.presence"] = {**presence, "ts": now}
 
-        ped_triggering_distances = []  # distances of drivers that trigger outer zone
+    return _Evaluation(updates, driver_events, ped_alert_payload, ped_alert_end, send_presence, peds, drivers_map)
 
-        for sid, info in list(drivers_map.items()):
-            d = info.get("distance")
-            speed = info.get("speed")
-            if d is None:
-                continue
 
-            if speed is None or speed <= MIN_ALERT_SPEED_MPS:
+async def handle_distance_based_notifications(crosswalk_id: int, view: Optional[CrosswalkView] = None):
+    """
+    Evaluates the crosswalk, writes only the fields that changed (expired
+    drivers, active alert distances, last_broadcast entries) and emits events.
+    Callers that have just read or written the crosswalk pass that `view`;
+    the document is only read when no fresh view was given (see state.view_is_fresh).
+    The write is conditional on the document's update time when the view has
+    one; on a conflict the crosswalk is re-read and re-evaluated, at most
+    EVALUATION_MAX_ATTEMPTS times, and events are only emitted once it applied.
+    Persists driver critical state in last_broadcast.driver_critical_active (map sid -> last distance)
+    and the last presence counts sent in last_broadcast.presence.
+    Returns the time at which the oldest remaining driver expires, or None if no drivers remain;
+    when the evaluation failed or gave up, the time to retry it (EVALUATION_RETRY_S from now).
+    """
+    db = await get_client()
+    _view_stats.evaluations += 1
+    try:
+        for _ in range(EVALUATION_MAX_ATTEMPTS):
+            view = await _current_view(db, crosswalk_id, view)
+            if view is None:
+                return
+            now = time.time()
+            result = _evaluate(crosswalk_id, view.data, now)
+            if not result.updates:
+                _write_stats.unchanged += 1
+                break
+            try:
+                await update_crosswalk(db, crosswalk_id, result.updates, view.update_time)
+            except FailedPrecondition:
+                # Changed since it was read: start over from the current document
+                _write_stats.conflicts += 1
+                view = None
                 continue
-
-            reaction_dist = speed * DRIVER_REACTION_TIME_S
-            braking_dist = (speed * speed) / (2.0 * AVG_DECELERATION_MPS2)
-            inner_alert_distance = reaction_dist + braking_dist + SAFETY_BUFFER_M
-            outer_alert_distance = inner_alert_distance * OUTER_ALERT_TIME_FACTOR
-
-            if ped_count > 0 and d <= outer_alert_distance:
-                ped_triggering_distances.append(d)
-
-            prev_for_sid = driver_active_map.get(sid)
-            active_condition = (ped_count > 0 and d <= inner_alert_distance)
-            if active_condition:
-                if prev_for_sid is None or abs(prev_for_sid - d) >= DEBOUNCE_MIN_DISTANCE_DELTA:
-                    driver_events.append(("driver_critical", sid))
-                    driver_active_map[sid] = d
-            else:
-                if prev_for_sid is not None:
-                    driver_events.append(("alert_end", sid))
-                    driver_active_map.pop(sid, None)
-
-        if not ped_triggering_distances:
-            if prev_ped_critical is not None:
-                ped_alert_end_to_emit = True
-                last_broadcast.pop("ped_critical_min_distance", None)
+            _write_stats.writes += 1
+            break
         else:
-            min_trigger = min(ped_triggering_distances)
-            if ped_count > 0 and (
-                prev_ped_critical is None or abs(prev_ped_critical - min_trigger) >= DEBOUNCE_MIN_DISTANCE_DELTA
-            ):
-                last_broadcast["ped_critical_min_distance"] = min_trigger
-                ped_alert_payload = {
-                    "crosswalk_id": crosswalk_id,
-                    "min_distance": min_trigger,
-                    "ts": int(now),
-                }
-
-        last_broadcast["driver_critical_active"] = driver_active_map
-        await crosswalk_ref(db, crosswalk_id).update(
-            {
-                "drivers": drivers_map,
-                "last_broadcast": last_broadcast,
-            }
-        )
+            # Still contended: its drivers must expire all the same, so try again soon
+            _write_stats.gave_up += 1
+            return time.time() + EVALUATION_RETRY_S
 
-        if ped_alert_payload:
-            await emit_to_sids(peds, "ped_critical", ped_alert_payload)
+        if result.ped_alert_payload:
+            await emit_to_room(peds_room(crosswalk_id), "ped_critical", result.ped_alert_payload)
 
-        if ped_alert_end_to_emit:
+        if result.ped_alert_end:
             ped_alert_end_payload = {
                 "crosswalk_id": crosswalk_id,
                 "ts": int(now),
             }
-            await emit_to_sids(peds, "alert_end", ped_alert_end_payload)
+            await emit_to_room(peds_room(crosswalk_id), "alert_end", ped_alert_end_payload)
+
+        for evt, sids in result.driver_events.items():
+            if sids:
+                payload = {"crosswalk_id": crosswalk_id, "ts": int(now)}
+                await emit_to_sids(sids, evt, payload)
 
-        for evt, sid in driver_events:
-            payload = {"crosswalk_id": crosswalk_id, "ts": int(now)}
-            await emit_to_sids([sid], evt, payload)
+        if result.send_presence:
+            await emit_presence(crosswalk_id, result.peds, list(result.drivers.keys()))
+        else:
+            _fanout_stats.presence_suppressed += 1
 
-        await emit_presence(crosswalk_id, peds, list(drivers_map.keys()))
+        if result.drivers:
+            return min(info.get("ts", 0) for info in result.drivers.values()) + DRIVER_PRESENCE_TTL
+        return None
 
     except Exception:
-        pass
-    finally:
-        # Attempt to clear running task marker; ignore errors
-        try:
-            await remove_running_task(await get_client(), crosswalk_id)
-        except Exception:
-            pass
\ No newline at end of file
+        logger.exception("Evaluation of crosswalk %s failed", crosswalk_id)
+        return time.time() + EVALUATION_RETRY_S
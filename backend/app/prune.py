@@ -1,24 +1,162 @@
 import asyncio
+import heapq
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from app.state import (
-    PRUNE_LOOP_INTERVAL,
+    DRIVER_PRESENCE_TTL,
     get_client,
+    crosswalk_generations,
+    CrosswalkView,
 )
-from app.notifications import handle_distance_based_notifications
+from app.notifications import EVALUATION_RETRY_S, handle_distance_based_notifications
+
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "16"))
+
+
+class NotificationScheduler:
+    """
+    Re-evaluates crosswalks exactly when a driver's presence TTL runs out,
+    instead of scanning every crosswalk on a fixed interval.
+
+    Only crosswalks with drivers are tracked: each has one pending deadline
+    in a min-heap (stale heap entries are skipped lazily). Due crosswalks
+    are evaluated concurrently, at most `concurrency` at a time, and
+    rescheduled at the deadline the evaluation returns; an evaluation that
+    raises is retried `retry_interval` seconds later.
+    """
+
+    def __init__(
+        self,
+        evaluate: Callable[[int, Optional[CrosswalkView]], Awaitable[Optional[float]]],
+        concurrency: int = SCHEDULER_CONCURRENCY,
+        retry_interval: float = EVALUATION_RETRY_S,
+    ):
+        self._evaluate = evaluate
+        self.retry_interval = retry_interval
+        self._heap: List[Tuple[float, int]] = []
+        self._deadlines: Dict[int, float] = {}
+        self._views: Dict[int, CrosswalkView] = {}
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running: Set[asyncio.Task] = set()
+        self.evaluations = 0
+        self.retries = 0
+        self.max_lateness = 0.0
+
+    def schedule(self, crosswalk_id: int, deadline: float, view: Optional[CrosswalkView] = None):
+        """
+        Makes sure crosswalk_id is evaluated no later than `deadline`,
+        handing it `view` if that is still fresh by then.
+        """
+        if view is not None:
+            self._views[crosswalk_id] = view
+        current = self._deadlines.get(crosswalk_id)
+        if current is not None and current <= deadline:
+            return
+        self._deadlines[crosswalk_id] = deadline
+        heapq.heappush(self._heap, (deadline, crosswalk_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def discard(self, crosswalk_id: int):
+        self._deadlines.pop(crosswalk_id, None)
+        self._views.pop(crosswalk_id, None)
+
+    def _pop_due(self, now: float) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, crosswalk_id = heapq.heappop(self._heap)
+            if self._deadlines.get(crosswalk_id) != deadline:
+                continue
+            del self._deadlines[crosswalk_id]
+            self.max_lateness = max(self.max_lateness, now - deadline)
+            due.append(crosswalk_id)
+        return due
+
+    def _next_deadline(self) -> Optional[float]:
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def _run_one(self, crosswalk_id: int):
+        view = self._views.pop(crosswalk_id, None)
+        async with self._slots:
+            try:
+                next_deadline = await self._evaluate(crosswalk_id, view)
+            except Exception:
+                # Its drivers may still need pruning: try again shortly
+                next_deadline = time.time() + self.retry_interval
+                self.retries += 1
+            self.evaluations += 1
+        if next_deadline is not None:
+            self.schedule(crosswalk_id, next_deadline)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        while True:
+            for crosswalk_id in self._pop_due(time.time()):
+                task = loop.create_task(self._run_one(crosswalk_id))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            self._wakeup.clear()
+            next_deadline = self._next_deadline()
+            timeout = None if next_deadline is None else max(0.0, next_deadline - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self._deadlines),
+            "running": len(self._running),
+            "evaluations": self.evaluations,
+            "retries": self.retries,
+            "max_lateness": self.max_lateness,
+        }
+
+
+_scheduler: Optional[NotificationScheduler] = None
+
+
+def get_scheduler() -> NotificationScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = NotificationScheduler(handle_distance_based_notifications)
+    return _scheduler
+
+
+async def bootstrap_scheduler(scheduler: NotificationScheduler):
+    """
+    One scan at startup picks up drivers that were present before a restart.
+    The scanned documents are handed on with their update times, so
+    crosswalks that are already due are evaluated (and conditionally
+    written) without reading them again.
+    """
+    db = await get_client()
+    try:
+        generations = crosswalk_generations()
+        docs = await db.collection("crosswalks").get()
+        read_at = time.time()
+        for doc in docs:
+            cw = doc.to_dict() if doc.exists else None
+            drivers = (cw or {}).get("drivers") or {}
+            if drivers:
+                oldest = min(info.get("ts", 0) for info in drivers.values())
+                view = CrosswalkView(cw, generations.get(doc.id, 0), read_at, doc.update_time)
+                scheduler.schedule(int(doc.id), oldest + DRIVER_PRESENCE_TTL, view)
+    except Exception:
+        pass
 
 
 async def prune_loop():
-    while True:
-        db = await get_client()
-        try:
-            docs = await db.collection("crosswalks").get()
-            for doc in docs:
-                crosswalk_id = int(doc.id)
-                cw_data = doc.to_dict() if doc.exists else None
-                await handle_distance_based_notifications(crosswalk_id, cw_data)
-        except Exception:
-            pass
-        await asyncio.sleep(PRUNE_LOOP_INTERVAL)
+    scheduler = get_scheduler()
+    await bootstrap_scheduler(scheduler)
+    await scheduler.run()
 
 
 def register_prune(app):
-    asyncio.create_task(prune_loop())
\ No newline at end of file
+    asyncio.create_task(prune_loop())
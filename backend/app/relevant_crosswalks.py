@@ -0,0 +1,325 @@
+"""
+Server-side search for the crosswalks a driver can reach within
+RELEVANT_MAX_DURATION seconds (the frontend's useRelevantCrosswalkSearcher,
+which sends every crossing point around the driver to an OSRM /table call
+every 10 s).
+
+The pipeline is cheap to expensive:
+  1. the crosswalk index returns crosswalks within the reachable radius
+     (speed x max duration, at least RELEVANT_MIN_SPEED x max duration);
+  2. a vectorized bearing cone drops crosswalks behind the driver;
+  3. durations cached per (road segment, crosswalk) are reused, where the
+     road segment is the driver's position snapped to a ROUTE_SEGMENT_M grid
+     plus a heading bucket;
+  4. only the remaining crosswalks go to the router in one batched call.
+
+ROUTING_URL points at an OSRM table service (e.g. http://osrm:5000/table/v1/car);
+when unset, a straight-line stand-in estimates durations. Stand-in durations
+depend on the asking driver's speed, so they are never cached.
+
+Run `python -m app.relevant_crosswalks` from backend/ for a benchmark of
+routed destinations per search against the unfiltered frontend behaviour.
+"""
+import argparse
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.crosswalk_index import M_PER_DEG_LAT, CrosswalkIndex, get_crosswalk_index, haversine_m
+
+RELEVANT_MAX_DURATION = float(os.getenv("RELEVANT_MAX_DURATION", "25"))  # seconds
+# Lower bound for the reach, so slow or stopped drivers still see what is ahead (50 km/h)
+RELEVANT_MIN_SPEED = float(os.getenv("RELEVANT_MIN_SPEED", "13.9"))
+RELEVANT_BEARING_CONE = float(os.getenv("RELEVANT_BEARING_CONE", "60"))  # degrees either side of heading
+# Below this speed (m/s) the heading is not trusted and the cone is not applied
+RELEVANT_HEADING_MIN_SPEED = float(os.getenv("RELEVANT_HEADING_MIN_SPEED", "2"))
+# Crosswalks this close are kept whatever their bearing
+RELEVANT_NEAR_M = float(os.getenv("RELEVANT_NEAR_M", "30"))
+ROUTING_URL = os.getenv("ROUTING_URL", "")
+ROUTING_TIMEOUT = float(os.getenv("ROUTING_TIMEOUT", "2"))
+ROUTE_SEGMENT_M = float(os.getenv("ROUTE_SEGMENT_M", "25"))
+ROUTE_HEADING_BUCKET = float(os.getenv("ROUTE_HEADING_BUCKET", "45"))
+ROUTE_CACHE_TTL = float(os.getenv("ROUTE_CACHE_TTL", "300"))
+ROUTE_CACHE_MAX = int(os.getenv("ROUTE_CACHE_MAX", "100000"))
+# Stand-in router: road distance over straight-line distance
+ROUTE_DETOUR = float(os.getenv("ROUTE_DETOUR", "1.3"))
+
+
+def bearing_deg(lat1, lon1, lat2, lon2):
+    """Initial bearing from point 1 to point 2 in degrees [0, 360); works on NumPy arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+def reach_m(speed, max_duration: float = RELEVANT_MAX_DURATION):
+    """Reachable radius in meters; `speed` may be a scalar or a NumPy array."""
+    return np.maximum(speed, RELEVANT_MIN_SPEED) * max_duration
+
+
+def prefilter(lat, lon, speed, heading, lats: np.ndarray, lons: np.ndarray, distances: np.ndarray, cone: float = RELEVANT_BEARING_CONE) -> np.ndarray:
+    """
+    Mask of the crosswalks within reach and, when moving, inside the heading
+    cone. The driver arguments are scalars or per-crosswalk arrays; a None or
+    NaN heading means unknown.
+    """
+    speed = np.asarray(speed, dtype=np.float64)
+    heading = np.asarray(np.nan if heading is None else heading, dtype=np.float64)
+    keep = distances <= reach_m(speed)
+    trusted = ~np.isnan(heading) & (speed >= RELEVANT_HEADING_MIN_SPEED)
+    off = np.abs((bearing_deg(lat, lon, lats, lons) - np.nan_to_num(heading) + 180.0) % 360.0 - 180.0)
+    return keep & (~trusted | (off <= cone) | (distances <= RELEVANT_NEAR_M))
+
+
+def segment_key(lat: float, lon: float, heading: Optional[float]) -> Tuple[int, int, int]:
+    """Road segment stand-in: position snapped to a ROUTE_SEGMENT_M grid plus a heading bucket."""
+    row = math.floor(lat * M_PER_DEG_LAT / ROUTE_SEGMENT_M)
+    col = math.floor(lon * M_PER_DEG_LAT * math.cos(math.radians(lat)) / ROUTE_SEGMENT_M)
+    bucket = -1 if heading is None else int((heading % 360.0) // ROUTE_HEADING_BUCKET)
+    return row, col, bucket
+
+
+class RouteCache:
+    """LRU of (segment, crosswalk id) -> duration in seconds (None: unreachable), expiring after `ttl`."""
+
+    def __init__(self, ttl: float = ROUTE_CACHE_TTL, max_entries: int = ROUTE_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Tuple[Any, int], Tuple[Optional[float], float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: Tuple[Any, int], now: Optional[float] = None):
+        """(True, duration) on a hit, (False, None) on a miss."""
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(key)
+        if entry is not None:
+            duration, ts = entry
+            if now - ts <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, duration
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def store(self, key: Tuple[Any, int], duration: Optional[float], now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._entries[key] = (duration, now)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class StraightLineRouter:
+    """Routing stand-in: straight-line distance times ROUTE_DETOUR at the driver's speed."""
+
+    # Durations scale with the caller's speed, so another driver on the segment can't reuse them
+    cacheable = False
+
+    async def durations(self, lat: float, lon: float, speed: float, points: Sequence[Tuple[float, float]]) -> List[Optional[float]]:
+        if not points:
+            return []
+        lats, lons = np.array(points, dtype=np.float64).T
+        road_m = haversine_m(lat, lon, lats, lons) * ROUTE_DETOUR
+        return [float(d) for d in road_m / max(speed, RELEVANT_MIN_SPEED)]
+
+    async def close(self):
+        pass
+
+
+class OsrmRouter:
+    """One OSRM /table request per search: the driver as source, the crosswalks as destinations."""
+
+    cacheable = True
+
+    def __init__(self, base_url: str, timeout: float = ROUTING_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._session = None
+
+    async def durations(self, lat: float, lon: float, speed: float, points: Sequence[Tuple[float, float]]) -> List[Optional[float]]:
+        if not points:
+            return []
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        coords = ";".join(f"{p_lon:.6f},{p_lat:.6f}" for p_lat, p_lon in [(lat, lon), *points])
+        async with self._session.get(f"{self.base_url}/{coords}", params={"sources": "0"}) as resp:
+            resp.raise_for_status()
+            body = await resp.json()
+        return list(body["durations"][0][1:])
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class RelevantCrosswalkSearcher:
+    def __init__(self, index: Optional[CrosswalkIndex] = None, router=None, cache: Optional[RouteCache] = None):
+        self._index = index
+        self.router = router or (OsrmRouter(ROUTING_URL) if ROUTING_URL else StraightLineRouter())
+        self._fallback = StraightLineRouter()
+        self.cache = cache or RouteCache()
+        self.searches = 0
+        self.candidates = 0
+        self.prefiltered = 0
+        self.routed = 0
+        self.routing_calls = 0
+        self.routing_errors = 0
+
+    @property
+    def index(self) -> CrosswalkIndex:
+        return self._index if self._index is not None else get_crosswalk_index()
+
+    async def search(
+        self,
+        lat: float,
+        lon: float,
+        speed: float,
+        heading: Optional[float] = None,
+        max_duration: float = RELEVANT_MAX_DURATION,
+    ) -> List[Dict[str, Any]]:
+        """Crosswalks reachable within `max_duration` seconds, soonest first."""
+        self.searches += 1
+        speed = max(float(speed), 0.0)
+        found = self.index.query(lat, lon, float(reach_m(speed, max_duration)))
+        self.candidates += len(found)
+        if not found:
+            return []
+        lats = np.array([cw.lat for cw in found])
+        lons = np.array([cw.lon for cw in found])
+        distances = np.array([cw.distance for cw in found])
+        found = [cw for cw, keep in zip(found, prefilter(lat, lon, speed, heading, lats, lons, distances)) if keep]
+        self.prefiltered += len(found)
+
+        segment = segment_key(lat, lon, heading)
+        cacheable = getattr(self.router, "cacheable", True)
+        durations: Dict[int, Optional[float]] = {}
+        missing = []
+        for cw in found:
+            hit, duration = self.cache.lookup((segment, cw.id)) if cacheable else (False, None)
+            if hit:
+                durations[cw.id] = duration
+            else:
+                missing.append(cw)
+        if missing:
+            points = [(cw.lat, cw.lon) for cw in missing]
+            self.routed += len(missing)
+            self.routing_calls += 1
+            try:
+                routed = await self.router.durations(lat, lon, speed, points)
+                for cw, duration in zip(missing, routed):
+                    if cacheable:
+                        self.cache.store((segment, cw.id), duration)
+                    durations[cw.id] = duration
+            except Exception:
+                # Never drop crosswalks because the router is down; estimate and don't cache
+                self.routing_errors += 1
+                for cw, duration in zip(missing, await self._fallback.durations(lat, lon, speed, points)):
+                    durations[cw.id] = duration
+
+        relevant = [
+            {**cw.to_dict(), "duration": durations[cw.id]}
+            for cw in found
+            if durations.get(cw.id) is not None and durations[cw.id] <= max_duration
+        ]
+        return sorted(relevant, key=lambda cw: cw["duration"])
+
+    async def close(self):
+        await self.router.close()
+
+    def stats(self) -> dict:
+        return {
+            "searches": self.searches,
+            "candidates": self.candidates,
+            "prefiltered": self.prefiltered,
+            "routed": self.routed,
+            "routing_calls": self.routing_calls,
+            "routing_errors": self.routing_errors,
+            "routed_per_search": self.routed / self.searches if self.searches else 0.0,
+            "cache": self.cache.stats(),
+        }
+
+
+_searcher: Optional[RelevantCrosswalkSearcher] = None
+
+
+def get_crosswalk_searcher() -> RelevantCrosswalkSearcher:
+    global _searcher
+    if _searcher is None:
+        _searcher = RelevantCrosswalkSearcher()
+    return _searcher
+
+
+async def relevant_crosswalks(lat: float, lon: float, speed: float, heading: Optional[float] = None) -> List[Dict[str, Any]]:
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError("lat/lon out of range")
+    return await get_crosswalk_searcher().search(lat, lon, speed, heading)
+
+
+if __name__ == "__main__":
+    from app.crosswalk_index import random_index
+
+    parser = argparse.ArgumentParser(description="Benchmark routed destinations per relevant-crosswalk search")
+    parser.add_argument("--crosswalks", type=int, default=200_000)
+    parser.add_argument("--spread-km", type=float, default=30.0)
+    parser.add_argument("--drivers", type=int, default=200)
+    parser.add_argument("--searches", type=int, default=30, help="searches per driver, one every --interval s")
+    parser.add_argument("--interval", type=float, default=10.0)
+    parser.add_argument("--radius", type=float, default=200.0, help="radius of the unfiltered frontend search")
+    args = parser.parse_args()
+
+    center = (47.4979, 19.0402)
+    index = random_index(args.crosswalks, *center, args.spread_km * 1000)
+    searcher = RelevantCrosswalkSearcher(index=index)
+    rng = np.random.default_rng(3)
+    spread = args.spread_km * 1000 / M_PER_DEG_LAT / 2
+
+    async def bench():
+        naive, elapsed = 0, 0.0
+        # Drivers share a few arterial roads, so segments repeat across drivers
+        roads = [(center[0] + rng.uniform(-spread, spread), center[1] + rng.uniform(-spread, spread), rng.uniform(0, 360))
+                 for _ in range(max(1, args.drivers // 10))]
+        for d in range(args.drivers):
+            lat, lon, heading = roads[d % len(roads)]
+            speed = float(rng.uniform(8, 17))
+            for _ in range(args.searches):
+                naive += len(index.query(lat, lon, args.radius))
+                start = time.perf_counter()
+                await searcher.search(lat, lon, speed, heading)
+                elapsed += time.perf_counter() - start
+                step = speed * args.interval / M_PER_DEG_LAT
+                lat += step * math.cos(math.radians(heading))
+                lon += step * math.sin(math.radians(heading)) / math.cos(math.radians(lat))
+        return naive, elapsed
+
+    naive, elapsed = asyncio.run(bench())
+    stats = searcher.stats()
+    searches = stats["searches"]
+    print(f"{searches} searches in {elapsed:.2f} s ({elapsed / searches * 1e6:.0f} us/search)")
+    print(f"unfiltered ({args.radius:.0f} m, frontend): {naive / searches:.1f} destinations and 1 routing call/search")
+    print(f"pipeline: {stats['candidates'] / searches:.1f} in reach, {stats['prefiltered'] / searches:.1f} after cone, "
+          f"{stats['routed_per_search']:.1f} routed and {stats['routing_calls'] / searches:.2f} routing calls/search, "
+          f"cache hit rate {stats['cache']['hit_rate']:.2f}")
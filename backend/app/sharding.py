@@ -0,0 +1,637 @@
+"""
+Crosswalk sharding across backend nodes.
+
+Every node joins a consistent-hash ring (HashRing) through heartbeats on a
+shared broker. Crosswalk events are handled by the node that owns the
+crosswalk id: handlers decorated with @sharded forward the event to the
+owner when it is another node, and Socket.IO emits reach clients connected
+to any node through BrokerManager. When nodes join or leave, crosswalk
+documents held in an in-process state store are handed to their new owner.
+
+Sharding is enabled by SHARD_BROKER_URL:
+  local://             in-process broker (tests)
+  tcp://host:port      the stand-in broker below, for local multi-node runs
+  redis://host:port    Redis pub/sub (needs the `redis` package)
+
+Local cluster, from backend/:
+  python -m app.sharding broker --port 7001
+  SHARD_BROKER_URL=tcp://127.0.0.1:7001 SHARD_NODE_ID=a uvicorn main:app --port 8001
+  SHARD_BROKER_URL=tcp://127.0.0.1:7001 SHARD_NODE_ID=b uvicorn main:app --port 8002
+"""
+import argparse
+import asyncio
+import bisect
+import functools
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+from app.memory_store import MemoryClient
+from app.state import DRIVER_PRESENCE_TTL, forget_crosswalk, get_client, session_ref, touch_crosswalk
+
+logger = logging.getLogger(__name__)
+
+SHARD_BROKER_URL = os.getenv("SHARD_BROKER_URL", "")
+SHARD_NODE_ID = os.getenv("SHARD_NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+SHARD_HEARTBEAT_INTERVAL = float(os.getenv("SHARD_HEARTBEAT_INTERVAL", "2.0"))
+SHARD_NODE_TTL = float(os.getenv("SHARD_NODE_TTL", "6.0"))
+# TcpBroker reconnect delay, doubled per failed attempt up to the max (seconds)
+SHARD_RECONNECT_DELAY = float(os.getenv("SHARD_RECONNECT_DELAY", "0.2"))
+SHARD_RECONNECT_DELAY_MAX = float(os.getenv("SHARD_RECONNECT_DELAY_MAX", "5.0"))
+
+NODES_CHANNEL = "shard:nodes"
+ALL_CHANNEL = "shard:all"
+SOCKETIO_CHANNEL = "socketio"
+
+
+def node_channel(node_id: str) -> str:
+    return f"shard:node:{node_id}"
+
+
+class HashRing:
+    """Consistent hashing with `vnodes` points per node on a 64-bit ring."""
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = SHARD_VNODES):
+        self.vnodes = vnodes
+        self._nodes: Set[str] = set(nodes)
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._rebuild()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def _rebuild(self):
+        ring = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in self._nodes for i in range(self.vnodes)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    @property
+    def nodes(self) -> Set[str]:
+        return set(self._nodes)
+
+    def add(self, node: str) -> bool:
+        if node in self._nodes:
+            return False
+        self._nodes.add(node)
+        self._rebuild()
+        return True
+
+    def remove(self, node: str) -> bool:
+        if node not in self._nodes:
+            return False
+        self._nodes.discard(node)
+        self._rebuild()
+        return True
+
+    def owner(self, key: Any) -> Optional[str]:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._owners[i]
+
+
+class Subscription:
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def _deliver(self, message: Any):
+        self._queue.put_nowait(message)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        return await self._queue.get()
+
+
+class LocalBroker:
+    """In-process pub/sub; messages are JSON round-tripped as on a real wire."""
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Subscription]] = {}
+
+    async def subscribe(self, channel: str) -> Subscription:
+        sub = Subscription()
+        self._subscribers.setdefault(channel, []).append(sub)
+        return sub
+
+    async def publish(self, channel: str, message: Any):
+        for sub in self._subscribers.get(channel, []):
+            sub._deliver(json.loads(json.dumps(message)))
+
+    async def close(self):
+        self._subscribers.clear()
+
+
+class TcpBroker:
+    """
+    Client of the stand-in broker served by `serve_broker` (newline-delimited
+    JSON). A lost connection is re-opened with exponential backoff and the
+    active subscriptions are sent again; messages published meanwhile are lost.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        reconnect_delay: float = SHARD_RECONNECT_DELAY,
+        reconnect_delay_max: float = SHARD_RECONNECT_DELAY_MAX,
+    ):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_delay_max = reconnect_delay_max
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._subscribers: Dict[str, List[Subscription]] = {}
+        self._connect_lock = asyncio.Lock()
+        self.reconnects = 0
+
+    async def _connection(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is None:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                # The broker keeps subscriptions per connection
+                for channel in self._subscribers:
+                    writer.write(json.dumps({"op": "sub", "channel": channel}).encode() + b"\n")
+                await writer.drain()
+                self._writer = writer
+                self._reader_task = asyncio.get_running_loop().create_task(self._read(reader))
+        return self._writer
+
+    async def _read(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                line = b""
+            if not line:
+                logger.warning("Broker connection closed, reconnecting")
+                await self._reconnect()
+                return
+            frame = json.loads(line)
+            for sub in self._subscribers.get(frame["channel"], []):
+                sub._deliver(frame["data"])
+
+    async def _reconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        delay = self.reconnect_delay
+        while True:
+            try:
+                await self._connection()
+            except OSError as e:
+                logger.warning("Broker reconnect failed (%s), retrying in %.1f s", e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_delay_max)
+            else:
+                self.reconnects += 1
+                return
+
+    async def _send(self, frame: dict):
+        writer = await self._connection()
+        writer.write(json.dumps(frame).encode() + b"\n")
+        await writer.drain()
+
+    async def subscribe(self, channel: str) -> Subscription:
+        sub = Subscription()
+        self._subscribers.setdefault(channel, []).append(sub)
+        await self._send({"op": "sub", "channel": channel})
+        return sub
+
+    async def publish(self, channel: str, message: Any):
+        await self._send({"op": "pub", "channel": channel, "data": message})
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+
+
+class RedisBroker:
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(url)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def subscribe(self, channel: str) -> Subscription:
+        sub = Subscription()
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(channel)
+
+        async def pump():
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    sub._deliver(json.loads(message["data"]))
+
+        task = asyncio.get_running_loop().create_task(pump())
+        self._tasks.add(task)
+        return sub
+
+    async def publish(self, channel: str, message: Any):
+        await self._redis.publish(channel, json.dumps(message))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await self._redis.aclose()
+
+
+_local_broker: Optional[LocalBroker] = None
+
+
+def create_broker(url: str):
+    global _local_broker
+    if url.startswith("local://"):
+        if _local_broker is None:
+            _local_broker = LocalBroker()
+        return _local_broker
+    if url.startswith("tcp://"):
+        host, port = url[len("tcp://"):].rsplit(":", 1)
+        return TcpBroker(host, int(port))
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBroker(url)
+    raise ValueError(f"unknown shard broker url: {url}")
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = create_broker(SHARD_BROKER_URL)
+    return _broker
+
+
+async def serve_broker(host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+    """Minimal pub/sub server: fans every `pub` frame out to the channel's subscribers."""
+    subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                frame = json.loads(line)
+                if frame["op"] == "sub":
+                    subscribers.setdefault(frame["channel"], set()).add(writer)
+                elif frame["op"] == "pub":
+                    out = json.dumps({"channel": frame["channel"], "data": frame["data"]}).encode() + b"\n"
+                    for peer in list(subscribers.get(frame["channel"], ())):
+                        try:
+                            peer.write(out)
+                        except Exception:
+                            subscribers[frame["channel"]].discard(peer)
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            for peers in subscribers.values():
+                peers.discard(writer)
+            writer.close()
+
+    return await asyncio.start_server(client, host, port)
+
+
+class BrokerManager(AsyncPubSubManager):
+    """Socket.IO client manager that shares emits between nodes over the shard broker."""
+
+    name = "shardbroker"
+
+    def __init__(self, broker_factory: Callable[[], Any] = get_broker, channel: str = SOCKETIO_CHANNEL):
+        super().__init__(channel=channel)
+        self._broker_factory = broker_factory
+
+    async def _publish(self, data):
+        await self._broker_factory().publish(self.channel, data)
+
+    async def _listen(self):
+        sub = await self._broker_factory().subscribe(self.channel)
+        async for message in sub:
+            yield message
+
+
+# Event name -> local handler, run when another node forwards an event here
+_handlers: Dict[str, Callable[[str, Any], Awaitable]] = {}
+
+
+class ShardRouter:
+    """
+    This node's view of the cluster: ring membership from heartbeats,
+    forwarding of events to owners, and handoff of in-process crosswalk
+    state when ownership moves.
+    """
+
+    def __init__(
+        self,
+        broker,
+        node_id: str = SHARD_NODE_ID,
+        heartbeat_interval: float = SHARD_HEARTBEAT_INTERVAL,
+        node_ttl: float = SHARD_NODE_TTL,
+        vnodes: int = SHARD_VNODES,
+        state: Optional[Callable[[], Awaitable[Any]]] = None,
+    ):
+        self.broker = broker
+        self._state = state
+        self.node_id = node_id
+        self.heartbeat_interval = heartbeat_interval
+        self.node_ttl = node_ttl
+        self.ring = HashRing([node_id], vnodes=vnodes)
+        self._last_seen: Dict[str, float] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.forwarded = 0
+        self.received = 0
+        self.handed_off = 0
+        self.rebalances = 0
+
+    async def _state_client(self):
+        return await (self._state or get_client)()
+
+    def owner(self, crosswalk_id: Any) -> str:
+        return self.ring.owner(crosswalk_id)
+
+    def is_local(self, crosswalk_id: Any) -> bool:
+        return self.owner(crosswalk_id) == self.node_id
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def start(self):
+        nodes = await self.broker.subscribe(NODES_CHANNEL)
+        inbox = await self.broker.subscribe(node_channel(self.node_id))
+        everyone = await self.broker.subscribe(ALL_CHANNEL)
+        self._spawn(self._consume(nodes, self._on_node_message))
+        self._spawn(self._consume(inbox, self._on_inbox_message))
+        self._spawn(self._consume(everyone, self._on_broadcast_message))
+        self._spawn(self._heartbeat())
+
+    async def stop(self):
+        """Leaves the ring gracefully, handing this node's crosswalks to their next owner."""
+        self.ring.remove(self.node_id)
+        if self.ring.nodes:
+            await self._handoff()
+        await self.broker.publish(NODES_CHANNEL, {"node": self.node_id, "leaving": True})
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def forward(self, event: str, crosswalk_id: Any, sid: str, data: Any) -> bool:
+        """Sends the event to the crosswalk's owner; returns False when that is this node."""
+        owner = self.owner(crosswalk_id)
+        if owner is None or owner == self.node_id:
+            return False
+        await self.broker.publish(node_channel(owner), {"event": event, "sid": sid, "data": data})
+        self.forwarded += 1
+        return True
+
+    async def broadcast(self, event: str, sid: str, data: Any):
+        """Runs the event on every other node (the caller runs it locally)."""
+        await self.broker.publish(ALL_CHANNEL, {"event": event, "sid": sid, "data": data, "from": self.node_id})
+
+    async def _consume(self, sub: Subscription, handle: Callable[[dict], Awaitable]):
+        async for message in sub:
+            try:
+                await handle(message)
+            except Exception:
+                logger.exception("Failed to handle shard message")
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.broker.publish(NODES_CHANNEL, {"node": self.node_id})
+            except OSError:
+                # The broker is reconnecting; peers keep this node until SHARD_NODE_TTL
+                logger.warning("Heartbeat not published")
+            cutoff = time.monotonic() - self.node_ttl
+            stale = [node for node, seen in self._last_seen.items() if seen < cutoff]
+            for node in stale:
+                del self._last_seen[node]
+                self.ring.remove(node)
+            if stale:
+                await self._rebalance()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _on_node_message(self, message: dict):
+        node = message["node"]
+        if node == self.node_id:
+            return
+        if message.get("leaving"):
+            self._last_seen.pop(node, None)
+            changed = self.ring.remove(node)
+        else:
+            self._last_seen[node] = time.monotonic()
+            changed = self.ring.add(node)
+            if changed:
+                # Let the newcomer learn about this node without waiting a full interval
+                await self.broker.publish(NODES_CHANNEL, {"node": self.node_id})
+        if changed:
+            await self._rebalance()
+
+    async def _on_inbox_message(self, message: dict):
+        if "handoff" in message:
+            handoff = message["handoff"]
+            db = await self._state_client()
+            # A copy this node already holds is at least as recent as the handed-off one
+            if isinstance(db, MemoryClient) and handoff["data"] is not None and db.import_document(
+                handoff["collection"], handoff["id"], handoff["data"]
+            ):
+                touch_crosswalk(handoff["id"])
+                await self._adopt(db, int(handoff["id"]), handoff["data"] or {}, handoff.get("members") or {})
+            return
+        self.received += 1
+        self._spawn(self._run_local(message["event"], message["sid"], message["data"]))
+
+    async def _on_broadcast_message(self, message: dict):
+        if message.get("from") != self.node_id:
+            self._spawn(self._run_local(message["event"], message["sid"], message["data"]))
+
+    async def _run_local(self, event: str, sid: str, data: Any):
+        handler = _handlers.get(event)
+        if handler is None:
+            logger.warning("No handler for forwarded event %s", event)
+            return
+        await handler(sid, data)
+
+    async def _rebalance(self):
+        self.rebalances += 1
+        await self._handoff()
+
+    async def _handoff(self):
+        """
+        Moves crosswalk documents this node no longer owns to their owner.
+        Only needed for in-process state; Firestore-backed state is shared.
+        """
+        db = await self._state_client()
+        if not isinstance(db, MemoryClient):
+            return
+        for doc_id in db.document_ids("crosswalks"):
+            owner = self.owner(doc_id)
+            if owner is None or owner == self.node_id:
+                continue
+            data = db.export_document("crosswalks", doc_id)
+            # The members' inverse index entries move along, or their disconnect
+            # cleanup would look for the crosswalk on this node only
+            members = {}
+            for sid in list((data or {}).get("peds") or []) + list((data or {}).get("drivers") or {}):
+                session = (await session_ref(db, sid).get()).to_dict()
+                members[sid] = (session or {}).get("role")
+            await self.broker.publish(
+                node_channel(owner),
+                {"handoff": {"collection": "crosswalks", "id": doc_id, "data": data, "members": members}},
+            )
+            db.evict_document("crosswalks", doc_id)
+            forget_crosswalk(doc_id)
+            for sid in members:
+                await session_ref(db, sid).set({"subscriptions": ArrayRemove([int(doc_id)])}, merge=True)
+            self.handed_off += 1
+
+    async def _adopt(self, db: MemoryClient, crosswalk_id: int, data: dict, members: Dict[str, Optional[str]]):
+        """
+        Records a handed-off crosswalk's members in this node's sessions and
+        schedules the expiry of its drivers here.
+        """
+        for sid, role in members.items():
+            update: Dict[str, Any] = {"subscriptions": ArrayUnion([crosswalk_id])}
+            session = (await session_ref(db, sid).get()).to_dict()
+            if role and not (session or {}).get("role"):
+                update["role"] = role
+            await session_ref(db, sid).set(update, merge=True)
+        stamps = [info.get("ts") for info in (data.get("drivers") or {}).values() if isinstance(info, dict)]
+        stamps = [ts for ts in stamps if ts is not None]
+        if stamps:
+            # Imported here: app.prune imports sockets, which imports this module
+            from app.prune import get_scheduler
+
+            get_scheduler().schedule(crosswalk_id, min(stamps) + DRIVER_PRESENCE_TTL)
+
+    def stats(self) -> dict:
+        return {
+            "node": self.node_id,
+            "nodes": sorted(self.ring.nodes),
+            "forwarded": self.forwarded,
+            "received": self.received,
+            "handed_off": self.handed_off,
+            "rebalances": self.rebalances,
+        }
+
+
+_router: Optional[ShardRouter] = None
+
+
+def get_shard_router() -> Optional[ShardRouter]:
+    """The running router, or None when sharding is disabled."""
+    return _router
+
+
+async def start_sharding():
+    global _router
+    if SHARD_BROKER_URL and _router is None:
+        _router = ShardRouter(get_broker())
+        await _router.start()
+
+
+async def stop_sharding():
+    global _router
+    if _router is not None:
+        await _router.stop()
+        _router = None
+
+
+def sharded(handler):
+    """
+    Runs a `(sid, data)` event handler on the node that owns
+    data["crosswalk_id"], forwarding the event when that is another node.
+    """
+    _handlers[handler.__name__] = handler
+
+    @functools.wraps(handler)
+    async def route(sid, data):
+        router = get_shard_router()
+        crosswalk_id = data.get("crosswalk_id") if isinstance(data, dict) else None
+        if router is not None and crosswalk_id is not None:
+            if await router.forward(handler.__name__, crosswalk_id, sid, data):
+                return
+        await handler(sid, data)
+
+    return route
+
+
+def sharded_batch(handler):
+    """
+    Like `sharded`, for a `(sid, data)` handler whose data["crosswalks"] lists
+    entries for several crosswalks: every owning node gets one event carrying
+    only its own entries.
+    """
+    _handlers[handler.__name__] = handler
+
+    @functools.wraps(handler)
+    async def route(sid, data):
+        router = get_shard_router()
+        entries = data.get("crosswalks") if isinstance(data, dict) else None
+        if router is None or not entries:
+            return await handler(sid, data)
+        by_owner: Dict[str, list] = {}
+        for entry in entries:
+            crosswalk_id = entry.get("crosswalk_id") if isinstance(entry, dict) else None
+            owner = router.owner(crosswalk_id) if crosswalk_id is not None else None
+            by_owner.setdefault(owner or router.node_id, []).append(entry)
+        local = by_owner.pop(router.node_id, None)
+        for owner_entries in by_owner.values():
+            await router.forward(handler.__name__, owner_entries[0]["crosswalk_id"], sid, {**data, "crosswalks": owner_entries})
+        if local:
+            await handler(sid, {**data, "crosswalks": local})
+
+    return route
+
+
+def cluster_wide(handler):
+    """Runs a `(sid)` handler here and on every other node, e.g. disconnect cleanup."""
+
+    async def run_local(sid, data):
+        await handler(sid)
+
+    _handlers[handler.__name__] = run_local
+
+    @functools.wraps(handler)
+    async def run(sid):
+        router = get_shard_router()
+        if router is not None:
+            await router.broadcast(handler.__name__, sid, None)
+        await handler(sid)
+
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in pub/sub broker for local multi-node runs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    broker_cmd = sub.add_parser("broker")
+    broker_cmd.add_argument("--host", default="127.0.0.1")
+    broker_cmd.add_argument("--port", type=int, default=7001)
+    args = parser.parse_args()
+
+    async def main():
+        server = await serve_broker(args.host, args.port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f"broker listening on {host}:{port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
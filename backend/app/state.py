@@ -1,4 +1,4 @@
-from typing import Any, Dict, Optional, List, Set
+from typing import Any, Dict, NamedTuple, Optional, List, Set
 from google.cloud.firestore_v1 import (
     AsyncClient,
     AsyncTransaction,
@@ -9,7 +9,12 @@ from google.cloud.firestore_v1 import (
 )
 from google.api_core.exceptions import AlreadyExists, NotFound
 import asyncio
+import os
 import time
+from collections import OrderedDict
+from app.memory_store import FirestorePersister, MemoryClient
+from app.firestore_pool import FirestorePool, create_pool
+from app.update_buffer import FieldUpdateBuffer
 
 PED_CRITICAL_DISTANCE = 100.0
 DRIVER_CRITICAL_DISTANCE = 50.0
@@ -18,23 +23,145 @@ DRIVER_PRESENCE_TTL = 15.0
 PED_PRESENCE_TTL = 15.0
 PRUNE_LOOP_INTERVAL = 20.0
 
+# "firestore": every read/write goes to Firestore (multi-node safe), spread
+#              over a pool of clients (see app.firestore_pool). Driver and
+#              evaluation field updates are merged per crosswalk and written
+#              in batches every STATE_UPDATE_INTERVAL seconds, or sooner once
+#              STATE_UPDATE_MAX_PENDING documents are pending (app.update_buffer).
+# "memory": in-process store only (tests, single-node deployments).
+# "write_behind": in-process store, changed documents mirrored to Firestore
+#                 in batched writes every STATE_PERSIST_INTERVAL seconds,
+#                 or sooner once STATE_PERSIST_MAX_DIRTY documents are pending.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "firestore")
+STATE_PERSIST_INTERVAL = float(os.getenv("STATE_PERSIST_INTERVAL", "1.0"))
+STATE_PERSIST_MAX_DIRTY = int(os.getenv("STATE_PERSIST_MAX_DIRTY", "200"))
+STATE_UPDATE_INTERVAL = float(os.getenv("STATE_UPDATE_INTERVAL", "0.05"))
+STATE_UPDATE_MAX_PENDING = int(os.getenv("STATE_UPDATE_MAX_PENDING", "200"))
+STATE_BATCH_SIZE = 500  # Firestore's per-batch write limit
+
+# A crosswalk view handed to an evaluation is used instead of re-reading the
+# document while no write to that crosswalk went through this process since
+# it was read, and it is at most this many seconds old (the age bound covers
+# writes from other processes, which the in-process generation cannot see).
+CROSSWALK_VIEW_MAX_AGE = float(os.getenv("CROSSWALK_VIEW_MAX_AGE", "1.0"))
+# Generations are kept for at most this many crosswalks, least recently
+# written first out; an evicted one has not been written for far longer
+# than any view stays fresh.
+CROSSWALK_GENERATIONS_MAX = int(os.getenv("CROSSWALK_GENERATIONS_MAX", "100000"))
+FIRESTORE_DATABASE = "walkaware-db"
+
 # CROSSWALKS: dict[int, dict[str, Any]] = {}
 # SUBSCRIPTIONS: dict[str, Set[int]] = {}
 # ROLE: dict[str, str] = {}
 # RUNNING_TASKS = set()
 
-# Singleton Firestore client
-_client: Optional[AsyncClient] = None
+# Singleton state client (FirestorePool or MemoryClient, see STATE_BACKEND)
+_client: Optional[Any] = None
 _client_lock = asyncio.Lock()
+# Field-update buffer in front of the pool (firestore backend only)
+_update_buffer: Optional[FieldUpdateBuffer] = None
+
+def _create_client(backend: str = STATE_BACKEND):
+    if backend == "firestore":
+        return create_pool(FIRESTORE_DATABASE)
+    if backend == "memory":
+        return MemoryClient()
+    if backend == "write_behind":
+        persister = FirestorePersister(
+            AsyncClient(database=FIRESTORE_DATABASE),
+            interval=STATE_PERSIST_INTERVAL,
+            max_dirty=STATE_PERSIST_MAX_DIRTY,
+        )
+        return MemoryClient(persister=persister)
+    raise ValueError(f"unknown state backend: {backend}")
 
 async def get_client() -> AsyncClient:
-    global _client
+    global _client, _update_buffer
     if _client is None:
         async with _client_lock:
             if _client is None:
-                _client = AsyncClient(database="walkaware-db")
+                _client = _create_client()
+                if isinstance(_client, FirestorePool):
+                    _update_buffer = FieldUpdateBuffer(
+                        _client.client,
+                        interval=STATE_UPDATE_INTERVAL,
+                        max_pending=STATE_UPDATE_MAX_PENDING,
+                        batch_size=STATE_BATCH_SIZE,
+                    )
+    if isinstance(_client, FirestorePool):
+        return _client.client()
     return _client
 
+async def close_client():
+    """Flushes pending write-behind state and field updates; called on application shutdown."""
+    if isinstance(_client, MemoryClient):
+        await _client.close()
+    if _update_buffer is not None:
+        await _update_buffer.close()
+
+def pool_stats() -> Optional[Dict[str, Any]]:
+    """Firestore client pool metrics, or None when state is not Firestore-backed."""
+    if isinstance(_client, FirestorePool):
+        return _client.stats()
+    return None
+
+def update_buffer_stats() -> Optional[Dict[str, int]]:
+    """Field-update buffer metrics, or None when state is not Firestore-backed."""
+    if _update_buffer is not None and isinstance(_client, FirestorePool):
+        return _update_buffer.stats()
+    return None
+
+def persister_stats() -> Optional[Dict[str, int]]:
+    """Write-behind buffer metrics, or None when state is not write-behind."""
+    if isinstance(_client, MemoryClient) and _client._persister is not None:
+        return _client._persister.stats()
+    return None
+
+# Crosswalk views
+class CrosswalkView(NamedTuple):
+    """
+    A crosswalk document as read at `generation`, `read_at` seconds since the
+    epoch. `update_time` is the document's, when the view came from a read.
+    """
+    data: Dict[str, Any]
+    generation: int
+    read_at: float
+    update_time: Any = None
+
+_crosswalk_generations: "OrderedDict[str, int]" = OrderedDict()
+
+def crosswalk_generation(crosswalk_id: int) -> int:
+    return _crosswalk_generations.get(str(crosswalk_id), 0)
+
+def crosswalk_generations() -> Dict[str, int]:
+    """Copy of every crosswalk's generation, for views taken by a bulk read."""
+    return dict(_crosswalk_generations)
+
+def touch_crosswalk(crosswalk_id: int):
+    """Records a write to the crosswalk, invalidating views read before it."""
+    key = str(crosswalk_id)
+    _crosswalk_generations[key] = _crosswalk_generations.get(key, 0) + 1
+    _crosswalk_generations.move_to_end(key)
+    while len(_crosswalk_generations) > CROSSWALK_GENERATIONS_MAX:
+        _crosswalk_generations.popitem(last=False)
+
+def forget_crosswalk(crosswalk_id: int):
+    """Drops the generation of a crosswalk this process no longer holds (e.g. handed off)."""
+    _crosswalk_generations.pop(str(crosswalk_id), None)
+
+def view_is_fresh(view: CrosswalkView, crosswalk_id: int, now: Optional[float] = None) -> bool:
+    if view.generation != crosswalk_generation(crosswalk_id):
+        return False
+    return (time.time() if now is None else now) - view.read_at <= CROSSWALK_VIEW_MAX_AGE
+
+async def _update_fields(db: AsyncClient, ref, updates: Dict[str, Any], option: Any = None):
+    """`ref.update` through the field-update buffer when there is one."""
+    if _update_buffer is not None and isinstance(_client, FirestorePool):
+        return await _update_buffer.update(ref, updates, option)
+    if option is None:
+        return await ref.update(updates)
+    return await ref.update(updates, option=option)
+
 def crosswalk_ref(db: AsyncClient, crosswalk_id: int):
     return db.collection("crosswalks").document(str(crosswalk_id))
 
@@ -53,23 +180,32 @@ async def ensure_crosswalk(db: AsyncClient, crosswalk_id: int):
             "drivers": {},
             "last_broadcast": {}
         })
+        touch_crosswalk(crosswalk_id)
 
 async def add_ped(db: AsyncClient, crosswalk_id: int, sid: str):
     await ensure_crosswalk(db, crosswalk_id)
     await crosswalk_ref(db, crosswalk_id).update({
         "peds": ArrayUnion([sid])
     })
+    touch_crosswalk(crosswalk_id)
+    await add_membership(db, sid, crosswalk_id)
 
 async def remove_ped(db: AsyncClient, crosswalk_id: int, sid: str):
-    await crosswalk_ref(db, crosswalk_id).update({
+    """Returns the crosswalk's update time after the removal."""
+    result = await crosswalk_ref(db, crosswalk_id).update({
         "peds": ArrayRemove([sid])
     })
+    touch_crosswalk(crosswalk_id)
+    await remove_membership(db, sid, crosswalk_id)
+    return getattr(result, "update_time", None)
 
 async def add_driver(db: AsyncClient, crosswalk_id: int, sid: str, distance: Optional[float], speed: Optional[float] = None):
     await ensure_crosswalk(db, crosswalk_id)
     await crosswalk_ref(db, crosswalk_id).update({
         f"drivers.{sid}": {"distance": distance, "speed": speed if speed is not None else None, "ts": time.time()}
     })
+    touch_crosswalk(crosswalk_id)
+    await add_membership(db, sid, crosswalk_id)
 
 async def update_driver(db: AsyncClient, crosswalk_id: int, sid: str, distance: Optional[float], speed: Optional[float] = None):
     updates = {
@@ -81,24 +217,92 @@ async def update_driver(db: AsyncClient, crosswalk_id: int, sid: str, distance:
     else:
         updates.setdefault(f"drivers.{sid}.speed", None)
 
-    await crosswalk_ref(db, crosswalk_id).update(updates)
+    await _update_fields(db, crosswalk_ref(db, crosswalk_id), updates)
+    touch_crosswalk(crosswalk_id)
 
 async def remove_driver(db: AsyncClient, crosswalk_id: int, sid: str):
+    """Returns the crosswalk's update time after the removal."""
     cw_ref = crosswalk_ref(db, crosswalk_id)
-    await cw_ref.update({
+    result = await cw_ref.update({
         f"drivers.{sid}": DELETE_FIELD,
         f"last_broadcast.driver_critical_active.{sid}": DELETE_FIELD
     })
+    touch_crosswalk(crosswalk_id)
+    await remove_membership(db, sid, crosswalk_id)
+    return getattr(result, "update_time", None)
     
 
+class DriverFix(NamedTuple):
+    distance: Optional[float]
+    speed: Optional[float] = None
+    joined: bool = False  # first fix at this crosswalk: also records the membership
+
+async def apply_driver_changes(db: AsyncClient, changes: Dict[int, Dict[str, Optional[DriverFix]]]):
+    """
+    Applies many drivers' changes at many crosswalks as batched writes: one
+    merge write per crosswalk (created if missing) instead of one update per
+    driver and crosswalk. `changes[crosswalk_id][sid]` is the driver's new
+    fix, or None to remove the driver there. Sessions that join a crosswalk
+    get the driver role and the membership in the same batch.
+    """
+    now = time.time()
+    writes = []
+    joined: Dict[str, List[int]] = {}
+    left: Dict[str, List[int]] = {}
+    for crosswalk_id, drivers in changes.items():
+        fields: Dict[str, Any] = {}
+        critical_cleared: Dict[str, Any] = {}
+        for sid, fix in drivers.items():
+            if fix is None:
+                fields[sid] = DELETE_FIELD
+                critical_cleared[sid] = DELETE_FIELD
+                left.setdefault(sid, []).append(crosswalk_id)
+            else:
+                fields[sid] = {"distance": fix.distance, "speed": fix.speed, "ts": now}
+                if fix.joined:
+                    joined.setdefault(sid, []).append(crosswalk_id)
+        data: Dict[str, Any] = {"drivers": fields}
+        if critical_cleared:
+            data["last_broadcast"] = {"driver_critical_active": critical_cleared}
+        writes.append((crosswalk_ref(db, crosswalk_id), data))
+    for sid, ids in joined.items():
+        writes.append((session_ref(db, sid), {"role": "driver", "subscriptions": ArrayUnion(ids)}))
+    for sid, ids in left.items():
+        writes.append((session_ref(db, sid), {"subscriptions": ArrayRemove(ids)}))
+
+    for start in range(0, len(writes), STATE_BATCH_SIZE):
+        batch = db.batch()
+        for ref, data in writes[start:start + STATE_BATCH_SIZE]:
+            batch.set(ref, data, merge=True)
+        await batch.commit()
+    for crosswalk_id in changes:
+        touch_crosswalk(crosswalk_id)
+
 async def get_crosswalk(db: AsyncClient, crosswalk_id: int) -> Optional[Dict[str, Any]]:
     snap = await crosswalk_ref(db, crosswalk_id).get()
     return snap.to_dict() if snap.exists else None
 
+async def get_crosswalk_view(db: AsyncClient, crosswalk_id: int) -> Optional[CrosswalkView]:
+    generation = crosswalk_generation(crosswalk_id)
+    snap = await crosswalk_ref(db, crosswalk_id).get()
+    if not snap.exists:
+        return None
+    return CrosswalkView(snap.to_dict(), generation, time.time(), snap.update_time)
+
+async def update_crosswalk(db: AsyncClient, crosswalk_id: int, updates: Dict[str, Any], last_update_time: Any = None):
+    """
+    Field-level update. With `last_update_time` it only applies if the document
+    was not written since then, and raises FailedPrecondition otherwise.
+    """
+    option = None if last_update_time is None else db.write_option(last_update_time=last_update_time)
+    await _update_fields(db, crosswalk_ref(db, crosswalk_id), updates, option)
+    touch_crosswalk(crosswalk_id)
+
 async def set_last_broadcast_value(db: AsyncClient, crosswalk_id: int, key: str, value: Any):
     await crosswalk_ref(db, crosswalk_id).update({
         f"last_broadcast.{key}": value
     })
+    touch_crosswalk(crosswalk_id)
 
 async def clear_last_broadcast_key(db: AsyncClient, crosswalk_id: int, key: str):
     cw_ref = crosswalk_ref(db, crosswalk_id)
@@ -115,10 +319,26 @@ async def clear_last_broadcast_key(db: AsyncClient, crosswalk_id: int, key: str)
             transaction.update(cw_ref, {"last_broadcast": lb})
 
     await txn(db.transaction())
+    touch_crosswalk(crosswalk_id)
 
 # Session / role
 async def set_role(db: AsyncClient, sid: str, role: Optional[str]):
-    await session_ref(db, sid).set({"role": role, "subscriptions": []}, merge=True)
+    await session_ref(db, sid).set({"role": role}, merge=True)
+
+# Inverse membership index: sessions/{sid}.subscriptions lists the crosswalk
+# ids the sid joined, so disconnect cleanup only touches those crosswalks.
+# It may over-approximate (e.g. after a TTL prune) but never misses one.
+async def add_membership(db: AsyncClient, sid: str, crosswalk_id: int):
+    await session_ref(db, sid).set({"subscriptions": ArrayUnion([crosswalk_id])}, merge=True)
+
+async def remove_membership(db: AsyncClient, sid: str, crosswalk_id: int):
+    await session_ref(db, sid).set({"subscriptions": ArrayRemove([crosswalk_id])}, merge=True)
+
+async def get_memberships(db: AsyncClient, sid: str) -> List[int]:
+    snap = await session_ref(db, sid).get()
+    if not snap.exists:
+        return []
+    return list((snap.to_dict() or {}).get("subscriptions") or [])
 
 async def remove_session(db: AsyncClient, sid: str):
     await session_ref(db, sid).delete()
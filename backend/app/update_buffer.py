@@ -0,0 +1,210 @@
+"""
+Merging field-update buffer in front of Firestore (the "firestore" state backend).
+
+Driver updates arrive several times a second per driver, and every one of
+them used to be its own `update` of the crosswalk document. FieldUpdateBuffer
+collects field-path updates (`drivers.{sid}.distance`, `last_broadcast.*`, ...)
+per document, merging later values of a path over earlier ones, and writes
+each document's merged fields with one `WriteBatch.update` every `interval`
+seconds, or as soon as `max_pending` documents are pending.
+
+`update` resolves once the write that carries it has committed, so callers
+still see their own writes when they read afterwards, and errors reach them.
+Conditional updates (with a `last_update_time` option) are not merged: each
+is committed on its own, ahead of the merged writes of the same flush, so
+its precondition is checked against the document its caller read.
+"""
+import asyncio
+import copy
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+logger = logging.getLogger(__name__)
+
+
+def merge_field(fields: Dict[str, Any], path: str, value: Any):
+    """
+    Merges a field-path update into pending ones, as if applied after them.
+    Firestore rejects an update holding both a path and one of its
+    ancestors, so a pending ancestor absorbs the value and pending
+    descendants are superseded by it.
+    """
+    parts = path.split(".")
+    for i in range(1, len(parts)):
+        ancestor = ".".join(parts[:i])
+        if ancestor in fields:
+            base = fields[ancestor]
+            # Writing below a deleted (or non-map) field recreates it as a map
+            base = copy.deepcopy(base) if isinstance(base, dict) else {}
+            node = base
+            for key in parts[i:-1]:
+                if not isinstance(node.get(key), dict):
+                    node[key] = {}
+                node = node[key]
+            if value is DELETE_FIELD:
+                node.pop(parts[-1], None)
+            else:
+                node[parts[-1]] = value
+            fields[ancestor] = base
+            return
+    prefix = path + "."
+    for pending in [p for p in fields if p.startswith(prefix)]:
+        del fields[pending]
+    fields[path] = value
+
+
+class _PendingDocument:
+    def __init__(self, reference):
+        self.reference = reference
+        self.fields: Dict[str, Any] = {}
+        self.waiters: List[asyncio.Future] = []
+
+
+class FieldUpdateBuffer:
+    """
+    `client` returns the Firestore client to create batches on (e.g. the
+    pool's least busy one). `batch_size` caps the writes per batch.
+    """
+
+    def __init__(
+        self,
+        client: Callable[[], Any],
+        interval: float = 0.05,
+        max_pending: int = 200,
+        batch_size: int = 500,
+    ):
+        self._client = client
+        self.interval = interval
+        self.max_pending = max(1, max_pending)
+        self.batch_size = max(1, min(batch_size, 500))  # Firestore's per-batch limit
+        self._pending: Dict[str, _PendingDocument] = {}
+        self._conditional: List[Tuple[Any, Dict[str, Any], Any, asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._closing = False
+        self.buffered = 0
+        self.merged = 0
+        self.conditional = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+
+    async def update(self, reference, updates: Dict[str, Any], option: Any = None):
+        """Queues a field-path update of `reference`; returns its write result once committed."""
+        future = asyncio.get_running_loop().create_future()
+        self.buffered += 1
+        if option is not None:
+            self.conditional += 1
+            self._conditional.append((reference, dict(updates), option, future))
+        else:
+            pending = self._pending.get(reference.path)
+            if pending is None:
+                pending = self._pending[reference.path] = _PendingDocument(reference)
+            else:
+                self.merged += 1
+            for path, value in updates.items():
+                merge_field(pending.fields, path, value)
+            pending.waiters.append(future)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._pending) + len(self._conditional) >= self.max_pending and self._wake is not None:
+            self._wake.set()
+        return await future
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        if len(self._pending) + len(self._conditional) >= self.max_pending:
+            self._wake.set()
+        try:
+            while self._pending or self._conditional:
+                if not self._closing:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), self.interval)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wake.clear()
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def flush(self):
+        conditional, self._conditional = self._conditional, []
+        pending, self._pending = list(self._pending.values()), {}
+        if conditional:
+            results = await asyncio.gather(
+                *(reference.update(updates, option=option) for reference, updates, option, _ in conditional),
+                return_exceptions=True,
+            )
+            for (_, _, _, future), result in zip(conditional, results):
+                if isinstance(result, BaseException):
+                    self.failed += 1
+                    _settle([future], error=result)
+                else:
+                    self.flushed += 1
+                    _settle([future], result=result)
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            batch = self._client().batch()
+            for doc in chunk:
+                batch.update(doc.reference, doc.fields)
+            try:
+                results = await batch.commit()
+            except Exception:
+                # A batch is all or nothing; write its documents one by one so
+                # only the updates that fail themselves (e.g. NotFound) report it
+                logger.warning("Batch of %d field updates failed, writing them one by one", len(chunk), exc_info=True)
+                await self._write_each(chunk)
+                continue
+            self.flushed += len(chunk)
+            self.batches += 1
+            results = list(results or [])
+            for i, doc in enumerate(chunk):
+                _settle(doc.waiters, result=results[i] if i < len(results) else None)
+
+    async def _write_each(self, docs: List[_PendingDocument]):
+        results = await asyncio.gather(*(doc.reference.update(doc.fields) for doc in docs), return_exceptions=True)
+        for doc, result in zip(docs, results):
+            if isinstance(result, BaseException):
+                self.failed += 1
+                _settle(doc.waiters, error=result)
+            else:
+                self.flushed += 1
+                _settle(doc.waiters, result=result)
+
+    async def close(self):
+        """
+        Writes whatever is pending without waiting for the timer. A flush in
+        progress is awaited, not cancelled, so every queued update settles.
+        """
+        self._closing = True
+        try:
+            if self._task is not None:
+                if self._wake is not None:
+                    self._wake.set()
+                await self._task
+        finally:
+            self._closing = False
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending) + len(self._conditional),
+            "buffered": self.buffered,
+            "merged": self.merged,
+            "conditional": self.conditional,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
+
+
+def _settle(futures: List[asyncio.Future], result: Any = None, error: Optional[BaseException] = None):
+    for future in futures:
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
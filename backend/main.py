@@ -1,15 +1,37 @@
-from fastapi import FastAPI
+from typing import Optional
+from fastapi import FastAPI, Query
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from app.prune import register_prune
+from app.prune import register_prune, get_scheduler
+from app.coalescer import get_coalescer
+from app.sharding import start_sharding, stop_sharding, get_shard_router
+from app.state import close_client, persister_stats, pool_stats, update_buffer_stats
+from app.notifications import get_fanout_stats, get_view_stats, get_write_stats
+from app.admission import get_frame_admission
+from app.batching import get_prediction_batcher
+from app.frame_cache import get_prediction_cache
+from app.inference_pool import get_inference_pool
+from app.crosswalk_index import nearby_crosswalks
+from app.relevant_crosswalks import get_crosswalk_searcher, relevant_crosswalks
+from app.driver_tracking import get_driver_tracker
+from app.gcs_upload import get_image_uploader
 from sockets import sio_app
 import app.handlers
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await start_sharding()
     register_prune(app)
     yield
+    await stop_sharding()
+    await get_driver_tracker().close()
+    await get_coalescer().close()
+    await get_prediction_batcher().close()
+    await get_crosswalk_searcher().close()
+    await get_image_uploader().close()
+    get_inference_pool().shutdown()
+    await close_client()
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -24,4 +46,50 @@ app.add_middleware(
 async def get_test():
     return FileResponse("test_handlers.html")
 
+@app.get("/crosswalks/nearby")
+async def get_nearby_crosswalks(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    radius: float = Query(200.0, gt=0),
+    limit: Optional[int] = Query(None, gt=0),
+):
+    return {"crosswalks": nearby_crosswalks(lat, lon, radius, limit)}
+
+@app.get("/crosswalks/relevant")
+async def get_relevant_crosswalks(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    speed: float = Query(0.0, ge=0),
+    heading: Optional[float] = Query(None, ge=0, lt=360),
+):
+    return {"crosswalks": await relevant_crosswalks(lat, lon, speed, heading)}
+
+@app.get("/stats")
+async def get_stats():
+    router = get_shard_router()
+    return {
+        "shard": router.stats() if router is not None else None,
+        "state": {
+            "write_behind": persister_stats(),
+            "firestore_pool": pool_stats(),
+            "update_buffer": update_buffer_stats(),
+        },
+        "predict": {
+            "admission": get_frame_admission().stats(),
+            "cache": get_prediction_cache().stats(),
+            "batcher": get_prediction_batcher().stats(),
+            "pool": get_inference_pool().stats(),
+            "uploads": get_image_uploader().stats(),
+        },
+        "notifications": {
+            "scheduler": get_scheduler().stats(),
+            "coalescer": get_coalescer().stats(),
+            "fanout": get_fanout_stats().stats(),
+            "views": get_view_stats().stats(),
+            "writes": get_write_stats().stats(),
+        },
+        "drivers": get_driver_tracker().stats(),
+        "routing": get_crosswalk_searcher().stats(),
+    }
+
 app.mount('/', app=sio_app)
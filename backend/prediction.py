@@ -1,35 +1,324 @@
-import base64
+import argparse
+import binascii
+import os
+import threading
 import numpy as np
 import cv2
 from pathlib import Path
 
-from ultralytics import YOLO
+# ultralytics (and with it torch) is imported on first use, so workers
+# running the onnx backend never pay for loading the PyTorch stack.
+YOLO = None
+
+PREDICTION_BACKEND = os.getenv("PREDICTION_BACKEND", "torch")  # "torch" or "onnx"
+PREDICTION_ONNX_INT8 = os.getenv("PREDICTION_ONNX_INT8", "0") == "1"
+PREDICTION_IMGSZ = 224
+CROSSWALK_CLASS = 0
+CROSSWALK_MIN_CONFIDENCE = 0.9
 
 _model = None
+_backend = None
+_worker = threading.local()
+
+
+def _weights_path():
+    return Path(__file__).with_name("best.pt")
+
+
+def _load_model():
+    global YOLO
+    if YOLO is None:
+        from ultralytics import YOLO
+    return YOLO(str(_weights_path()))
 
 
 def get_model():
     global _model
     if _model is None:
-        model_path = Path(__file__).with_name("best.pt")
-        _model = YOLO(str(model_path))
+        _model = _load_model()
     return _model
 
 
+def jpeg_size(buf):
+    """
+    Reads (width, height) from the SOF segment of a JPEG without decoding it.
+    Returns None for anything that is not a well-formed JPEG header.
+    """
+    n = len(buf)
+    if n < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < n:
+        if buf[i] != 0xFF:
+            return None
+        marker = buf[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            i += 2
+            continue
+        length = (buf[i + 2] << 8) | buf[i + 3]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (buf[i + 5] << 8) | buf[i + 6]
+            width = (buf[i + 7] << 8) | buf[i + 8]
+            return width, height
+        i += 2 + length
+    return None
+
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _decode_flag(buf, size=PREDICTION_IMGSZ):
+    """Largest libjpeg DCT downscale that still leaves the shorter edge >= size."""
+    dims = jpeg_size(buf)
+    if dims is not None:
+        shorter = min(dims)
+        for factor, flag in _REDUCED_FLAGS:
+            if shorter // factor >= size:
+                return flag
+    return cv2.IMREAD_COLOR
+
+
+def _frame_bytes(frame):
+    if isinstance(frame, (bytes, bytearray, memoryview)):
+        return frame
+    comma = frame.find(",")
+    return binascii.a2b_base64(frame[comma + 1:] if comma >= 0 else frame)
+
+
+def decode_frame(frame):
+    """
+    Decodes a frame into a BGR image, letting libjpeg scale large frames
+    down during decoding instead of decoding at camera resolution and
+    resizing afterwards. `frame` is either the raw encoded image bytes of a
+    binary Socket.IO attachment or a data URL (or bare base64 string).
+    """
+    raw = _frame_bytes(frame)
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    return cv2.imdecode(buf, _decode_flag(raw))
+
+
+def frame_dhash(frame):
+    """
+    64-bit difference hash of a frame: a 9x8 grayscale thumbnail (decoded at
+    1/8 scale when possible) where each bit says whether a pixel is brighter
+    than its left neighbour. Nearly identical frames differ in few bits.
+    """
+    raw = _frame_bytes(frame)
+    dims = jpeg_size(raw)
+    flag = cv2.IMREAD_REDUCED_GRAYSCALE_8 if dims is not None and min(dims) >= 72 else cv2.IMREAD_GRAYSCALE
+    gray = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), flag)
+    if gray is None:
+        raise ValueError("could not decode image")
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class FrameBuffer:
+    """
+    Reusable input memory for one inference worker: a growing NCHW float32
+    batch plus the uint8 scratch images the preprocessing writes into, so a
+    steady stream of batches does not allocate per frame.
+    """
+
+    def __init__(self, size=PREDICTION_IMGSZ):
+        self.size = size
+        self._batch = np.empty((0, 3, size, size), dtype=np.float32)
+        self._bgr = np.empty((size, size, 3), dtype=np.uint8)
+        self._rgb = np.empty((size, size, 3), dtype=np.uint8)
+
+    def load(self, images):
+        if self._batch.shape[0] < len(images):
+            self._batch = np.empty((len(images), 3, self.size, self.size), dtype=np.float32)
+        batch = self._batch[:len(images)]
+        for img, out in zip(images, batch):
+            preprocess_image(img, self.size, out=out, scratch=(self._bgr, self._rgb))
+        return batch
+
+
+def get_frame_buffer():
+    buffer = getattr(_worker, "frame_buffer", None)
+    if buffer is None:
+        buffer = _worker.frame_buffer = FrameBuffer()
+    return buffer
+
+
+def preprocess_image(img, size=PREDICTION_IMGSZ, out=None, scratch=None):
+    """
+    Mirrors the ultralytics classify transforms the model was trained with
+    (shorter edge to `size`, center crop, BGR->RGB, scale to [0, 1]) by
+    resizing the centered square ROI straight to size x size.
+    Writes a CHW float32 array into `out` (allocated when None) and returns it.
+    """
+    h, w = img.shape[:2]
+    side = min(h, w)
+    top, left = (h - side) // 2, (w - side) // 2
+    roi = img[top:top + side, left:left + side]
+    if scratch is None:
+        scratch = (np.empty((size, size, 3), dtype=np.uint8), np.empty((size, size, 3), dtype=np.uint8))
+    bgr, rgb = scratch
+    interpolation = cv2.INTER_AREA if side > size else cv2.INTER_LINEAR
+    cv2.resize(roi, (size, size), dst=bgr, interpolation=interpolation)
+    cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=rgb)
+    if out is None:
+        out = np.empty((3, size, size), dtype=np.float32)
+    np.multiply(rgb.transpose(2, 0, 1), 1.0 / 255.0, out=out, casting="unsafe")
+    return out
+
+
+class TorchBackend:
+    """Runs the ultralytics/PyTorch model; classify() returns (top1, top1conf) per image."""
+
+    name = "torch"
+
+    def __init__(self, model=None):
+        self._model = model
+
+    def classify(self, images):
+        import torch
+
+        batch = torch.from_numpy(get_frame_buffer().load(images))
+        model = self._model if self._model is not None else get_model()
+        results = model.predict(source=batch, imgsz=PREDICTION_IMGSZ, verbose=False)
+        return [(int(r.probs.top1), float(r.probs.top1conf)) for r in results]
+
+
+class OnnxBackend:
+    """Runs the exported classifier with ONNX Runtime on the CPU."""
+
+    name = "onnx"
+
+    def __init__(self, model_path):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(
+            str(model_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self._input_name = self._session.get_inputs()[0].name
+
+    def classify(self, images):
+        batch = get_frame_buffer().load(images)
+        probs = self._session.run(None, {self._input_name: batch})[0]
+        top1 = probs.argmax(axis=1)
+        return [(int(t), float(p[t])) for t, p in zip(top1, probs)]
+
+
+def onnx_model_path(weights=None, int8=False):
+    weights = Path(weights) if weights is not None else _weights_path()
+    return weights.with_suffix(".int8.onnx" if int8 else ".onnx")
+
+
+def export_onnx(weights=None, int8=False):
+    """
+    Exports best.pt to best.onnx next to it (and best.int8.onnx when `int8`)
+    and returns the path of the requested model. Needs the ultralytics
+    export extras (onnx, onnxslim) only at export time. Run offline, once
+    (`python prediction.py [--int8]`), not from the inference workers.
+    """
+    global YOLO
+    if YOLO is None:
+        from ultralytics import YOLO
+    weights = Path(weights) if weights is not None else _weights_path()
+    onnx_path = onnx_model_path(weights)
+    if not onnx_path.exists():
+        YOLO(str(weights)).export(format="onnx", imgsz=PREDICTION_IMGSZ, dynamic=True)
+    if not int8:
+        return onnx_path
+    int8_path = onnx_model_path(weights, int8=True)
+    if not int8_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        # Written aside and renamed, so a reader never sees a partial model
+        tmp_path = int8_path.with_name(f"{int8_path.stem}.{os.getpid()}.tmp.onnx")
+        quantize_dynamic(str(onnx_path), str(tmp_path), weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path
+
+
+def _load_backend(name=PREDICTION_BACKEND):
+    if name == "torch":
+        return TorchBackend(_load_model())
+    if name == "onnx":
+        # Every worker loads the model; exporting here would race between them
+        path = onnx_model_path(int8=PREDICTION_ONNX_INT8)
+        if not path.exists():
+            flag = " --int8" if PREDICTION_ONNX_INT8 else ""
+            raise FileNotFoundError(f"{path} not found; export it first with `python prediction.py{flag}`")
+        return OnnxBackend(path)
+    raise ValueError(f"unknown prediction backend: {name}")
+
+
+def init_worker():
+    """
+    Inference pool initializer: gives the calling worker thread (or process)
+    its own backend and model instance, loaded once when the worker starts.
+    """
+    _worker.backend = _load_backend()
+
+
+def get_backend():
+    global _backend
+    backend = getattr(_worker, "backend", None)
+    if backend is not None:
+        return backend
+    if _backend is None:
+        _backend = TorchBackend() if PREDICTION_BACKEND == "torch" else _load_backend()
+    return _backend
+
+
 def base64_to_image(base64_string):
-    base = base64_string.split(",")[1]
-    img_bytes = base64.b64decode(base)
-    img_array = np.frombuffer(img_bytes, dtype=np.uint8)
-    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-    return img
+    return decode_frame(base64_string)
+
+
+def isCrosswalk(top1, top1conf):
+    return top1 == CROSSWALK_CLASS and top1conf > CROSSWALK_MIN_CONFIDENCE
 
 
 def predictImageIsCrosswalk(base64_string):
     img = base64_to_image(base64_string)
-    model = get_model()
-    results = model.predict(source=img, imgsz=224)
-    if (results[0].probs.top1 == 0 and results[0].probs.top1conf > 0.9):
-        return True
-    else:
-        return False
-        
+    (top1, top1conf), = get_backend().classify([img])
+    return isCrosswalk(top1, top1conf)
+
+
+def predictImagesAreCrosswalk(frames):
+    """
+    Batched variant of predictImageIsCrosswalk: one forward pass for all frames
+    (data URLs or raw image bytes, see decode_frame).
+    Returns one entry per input, either a bool or the Exception raised while
+    decoding that frame, so a single corrupt frame does not fail the batch.
+    """
+    outcomes = [None] * len(frames)
+    images = []
+    positions = []
+    for i, frame in enumerate(frames):
+        try:
+            img = base64_to_image(frame)
+            if img is None:
+                raise ValueError("could not decode image")
+        except Exception as e:
+            outcomes[i] = e
+            continue
+        images.append(img)
+        positions.append(i)
+
+    if images:
+        for i, (top1, top1conf) in zip(positions, get_backend().classify(images)):
+            outcomes[i] = isCrosswalk(top1, top1conf)
+    return outcomes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the crosswalk classifier to ONNX")
+    parser.add_argument("--weights", default=None, help="path to the .pt weights (default: best.pt)")
+    parser.add_argument("--int8", action="store_true", help="also write a dynamically quantized INT8 model")
+    args = parser.parse_args()
+    print(export_onnx(args.weights, int8=args.int8))
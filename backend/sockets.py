@@ -1,5 +1,8 @@
 import socketio
+from app.sharding import SHARD_BROKER_URL, BrokerManager
 
+# With sharding enabled, emits reach clients connected to any node
+client_manager = BrokerManager() if SHARD_BROKER_URL else None
 
-sio_server = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+sio_server = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', client_manager=client_manager)
 sio_app = socketio.ASGIApp(socketio_server=sio_server, socketio_path='ws/socket.io')
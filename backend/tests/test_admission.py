@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+
+import backend.app.admission as admission
+
+
+@pytest.mark.asyncio
+async def test_single_frame_is_served():
+    gate = admission.FrameAdmission()
+
+    async def work():
+        return "ok"
+
+    assert await gate.run("sid", work) == (True, "ok")
+    assert gate.stats() == {"clients": 0, "served": 1, "queued": 0, "dropped": 0}
+
+
+@pytest.mark.asyncio
+async def test_only_newest_pending_frame_survives():
+    gate = admission.FrameAdmission()
+    release = asyncio.Event()
+    seen = []
+
+    def work_for(frame):
+        async def work():
+            seen.append(frame)
+            if frame == 1:
+                await release.wait()
+            return frame
+        return work
+
+    first = asyncio.ensure_future(gate.run("sid", work_for(1)))
+    await asyncio.sleep(0)
+    second = asyncio.ensure_future(gate.run("sid", work_for(2)))
+    await asyncio.sleep(0)
+    third = asyncio.ensure_future(gate.run("sid", work_for(3)))
+    await asyncio.sleep(0)
+
+    # Frame 2 is superseded by frame 3 while frame 1 is still in flight
+    assert await second == (False, None)
+    release.set()
+
+    assert await first == (True, 1)
+    assert await third == (True, 3)
+    assert seen == [1, 3]
+    assert gate.stats() == {"clients": 0, "served": 2, "queued": 2, "dropped": 1}
+
+
+@pytest.mark.asyncio
+async def test_clients_are_independent():
+    gate = admission.FrameAdmission()
+    release = asyncio.Event()
+
+    async def slow():
+        await release.wait()
+        return "a"
+
+    async def fast():
+        return "b"
+
+    a = asyncio.ensure_future(gate.run("a", slow))
+    await asyncio.sleep(0)
+    assert await gate.run("b", fast) == (True, "b")
+    release.set()
+    assert await a == (True, "a")
+
+
+@pytest.mark.asyncio
+async def test_failed_work_releases_slot():
+    gate = admission.FrameAdmission()
+
+    async def boom():
+        raise RuntimeError("fail")
+
+    with pytest.raises(RuntimeError):
+        await gate.run("sid", boom)
+
+    async def ok():
+        return 1
+
+    assert await gate.run("sid", ok) == (True, 1)
@@ -0,0 +1,77 @@
+import time
+
+import numpy as np
+
+import backend.app.alert_zones as alert_zones
+
+
+def _sids(zones, mask):
+    return [sid for sid, hit in zip(zones.sids, mask) if hit]
+
+
+def test_vectorized_matches_scalar_rule():
+    now = time.time()
+    crosswalks = alert_zones.random_crosswalks(40, 60, now, seed=7)
+    batched = alert_zones.evaluate_crosswalks(crosswalks, now)
+
+    for (drivers, active, peds), zones in zip(crosswalks, batched):
+        expired, outer, critical, ended, nearest = alert_zones.evaluate_zones_scalar(drivers, active, peds, now)
+        assert _sids(zones, zones.masks.expired) == expired
+        assert _sids(zones, zones.masks.outer_trigger) == outer
+        assert _sids(zones, zones.masks.driver_critical) == critical
+        assert _sids(zones, zones.masks.alert_end) == ended
+        assert zones.nearest == nearest
+
+
+def test_batched_matches_one_crosswalk_at_a_time():
+    now = time.time()
+    crosswalks = alert_zones.random_crosswalks(5, 20, now, seed=3)
+    crosswalks.insert(2, ({}, {}, 1))
+    batched = alert_zones.evaluate_crosswalks(crosswalks, now)
+
+    for cw, zones in zip(crosswalks, batched):
+        single, = alert_zones.evaluate_crosswalks([cw], now)
+        assert single.sids == zones.sids
+        assert single.nearest == zones.nearest
+        for a, b in zip(single.masks, zones.masks):
+            assert np.array_equal(a, b)
+
+
+def test_zone_masks_for_known_drivers():
+    now = 1000.0
+    drivers = {
+        "inner": {"distance": 10.0, "speed": 2.0, "ts": now},
+        "outer": {"distance": 50.0, "speed": 2.0, "ts": now},
+        "debounced": {"distance": 10.0, "speed": 2.0, "ts": now},
+        "left": {"distance": 200.0, "speed": 2.0, "ts": now},
+        "parked": {"distance": 5.0, "speed": 0.5, "ts": now},
+        "no_distance": {"distance": None, "speed": 5.0, "ts": now},
+        "gone": {"distance": 5.0, "speed": 5.0, "ts": now - 10_000},
+    }
+    active = {"debounced": 11.0, "left": 15.0, "parked": 5.0}
+
+    zones, = alert_zones.evaluate_crosswalks([(drivers, active, 1)], now)
+
+    assert _sids(zones, zones.masks.expired) == ["gone"]
+    assert _sids(zones, zones.masks.outer_trigger) == ["inner", "outer", "debounced"]
+    assert _sids(zones, zones.masks.driver_critical) == ["inner"]
+    assert _sids(zones, zones.masks.alert_end) == ["left"]
+    assert zones.nearest == "inner"
+
+
+def test_no_peds_ends_active_alerts():
+    now = 1000.0
+    drivers = {"a": {"distance": 10.0, "speed": 2.0, "ts": now}}
+
+    zones, = alert_zones.evaluate_crosswalks([(drivers, {"a": 10.0}, 0)], now)
+
+    assert not zones.masks.outer_trigger.any()
+    assert not zones.masks.driver_critical.any()
+    assert _sids(zones, zones.masks.alert_end) == ["a"]
+    assert zones.nearest is None
+
+
+def test_empty_input():
+    assert alert_zones.evaluate_crosswalks([], 0.0) == []
+    zones, = alert_zones.evaluate_crosswalks([({}, {}, 2)], 0.0)
+    assert zones.sids == [] and zones.nearest is None
@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+
+import backend.app.batching as batching
+
+
+@pytest.mark.asyncio
+async def test_concurrent_frames_share_one_batch():
+    calls = []
+
+    def predict_batch(frames):
+        calls.append(list(frames))
+        return [frame == "cw" for frame in frames]
+
+    batcher = batching.PredictionBatcher(predict_batch, max_batch_size=8, max_wait=0.05)
+    results = await asyncio.gather(
+        batcher.submit("cw"),
+        batcher.submit("road"),
+        batcher.submit("cw"),
+    )
+
+    assert results == [True, False, True]
+    assert calls == [["cw", "road", "cw"]]
+    assert batcher.stats()["batches"] == 1 and batcher.stats()["frames"] == 3
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_max_batch_size_splits_batches():
+    sizes = []
+
+    def predict_batch(frames):
+        sizes.append(len(frames))
+        return [True] * len(frames)
+
+    batcher = batching.PredictionBatcher(predict_batch, max_batch_size=2, max_wait=0.05)
+    results = await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+
+    assert results == [True] * 5
+    assert sizes == [2, 2, 1]
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_per_frame_error_only_fails_its_caller():
+    def predict_batch(frames):
+        return [ValueError("bad frame") if frame == "bad" else True for frame in frames]
+
+    batcher = batching.PredictionBatcher(predict_batch, max_batch_size=4, max_wait=0.05)
+    ok, bad = await asyncio.gather(
+        batcher.submit("good"),
+        batcher.submit("bad"),
+        return_exceptions=True,
+    )
+
+    assert ok is True
+    assert isinstance(bad, ValueError)
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_batch_failure_propagates_to_all_callers():
+    def predict_batch(frames):
+        raise RuntimeError("model down")
+
+    batcher = batching.PredictionBatcher(predict_batch, max_batch_size=4, max_wait=0.01)
+    results = await asyncio.gather(
+        batcher.submit("a"),
+        batcher.submit("b"),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+    # The batching loop survives a failed batch
+    def recovered(frames):
+        return [True] * len(frames)
+
+    batcher._predict_batch = recovered
+    assert await batcher.submit("c") is True
+    await batcher.close()
+
+
+@pytest.mark.asyncio
+async def test_batches_run_on_pool_and_overload_is_rejected():
+    pool = batching.InferencePool(kind="thread", workers=1, max_pending=1, initializer=None)
+
+    def predict_batch(frames):
+        return [True] * len(frames)
+
+    batcher = batching.PredictionBatcher(predict_batch, pool=pool, max_batch_size=4, max_wait=0.01, max_queued=2)
+    try:
+        results = await asyncio.gather(
+            *(batcher.submit(i) for i in range(4)),
+            return_exceptions=True,
+        )
+    finally:
+        await batcher.close()
+        pool.shutdown()
+
+    assert results[:2] == [True, True]
+    assert all(isinstance(r, batching.InferenceOverloaded) for r in results[2:])
+    assert batcher.stats()["rejected"] == 2
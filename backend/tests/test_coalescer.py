@@ -0,0 +1,112 @@
+import asyncio
+import time
+import pytest
+
+import backend.app.coalescer as coalescer_mod
+
+
+@pytest.mark.asyncio
+async def test_first_mark_evaluates_immediately():
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(cid)
+
+    coalescer = coalescer_mod.EvaluationCoalescer(evaluate, tick=0.05)
+    coalescer.mark(3)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    assert calls == [3]
+    await coalescer.close()
+
+
+@pytest.mark.asyncio
+async def test_burst_is_merged_into_one_follow_up_evaluation():
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(cid)
+
+    coalescer = coalescer_mod.EvaluationCoalescer(evaluate, tick=0.02)
+    for _ in range(50):
+        coalescer.mark(1)
+    await asyncio.sleep(0.005)
+    for _ in range(50):
+        coalescer.mark(1)
+    await asyncio.sleep(0.1)
+
+    assert calls == [1, 1]
+    stats = coalescer.stats()
+    assert stats["marked"] == 100
+    assert stats["evaluations"] == 2
+    assert stats["crosswalks"] == 0
+
+
+@pytest.mark.asyncio
+async def test_marks_during_evaluation_trigger_rerun_after_tick():
+    calls = []
+    release = asyncio.Event()
+
+    async def evaluate(cid, view=None):
+        calls.append((cid, asyncio.get_running_loop().time()))
+        if len(calls) == 1:
+            await release.wait()
+
+    coalescer = coalescer_mod.EvaluationCoalescer(evaluate, tick=0.03)
+    coalescer.mark(5)
+    await asyncio.sleep(0)
+    coalescer.mark(5)
+    release.set()
+    first_done = asyncio.get_running_loop().time()
+    await asyncio.sleep(0.1)
+
+    assert [cid for cid, _ in calls] == [5, 5]
+    assert calls[1][1] - first_done >= 0.025
+
+
+@pytest.mark.asyncio
+async def test_crosswalks_are_independent_and_errors_are_rescheduled():
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(cid)
+        if cid == 1:
+            raise RuntimeError("boom")
+        return 1234.0 if cid == 2 else None
+
+    rescheduled = {}
+    coalescer = coalescer_mod.EvaluationCoalescer(
+        evaluate, tick=0.01, reschedule=lambda cid, deadline: rescheduled.__setitem__(cid, deadline)
+    )
+    started = time.time()
+    coalescer.mark(1)
+    coalescer.mark(2)
+    coalescer.mark(3)
+    await asyncio.sleep(0.05)
+
+    assert sorted(calls) == [1, 2, 3]
+    assert coalescer.stats()["evaluations"] == 3 and coalescer.stats()["failed"] == 1
+    # The returned deadline is kept, the failure retried; no drivers left means nothing to schedule
+    assert rescheduled[2] == 1234.0
+    assert started + coalescer_mod.EVALUATION_RETRY_S <= rescheduled[1] <= time.time() + coalescer_mod.EVALUATION_RETRY_S
+    assert 3 not in rescheduled
+
+
+@pytest.mark.asyncio
+async def test_newest_view_is_handed_to_the_evaluation():
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(view)
+
+    coalescer = coalescer_mod.EvaluationCoalescer(evaluate, tick=0.02)
+    coalescer.mark(1, "v1")
+    coalescer.mark(1, "v2")
+    coalescer.mark(1)
+    await asyncio.sleep(0.05)
+    coalescer.mark(1)
+    await asyncio.sleep(0.05)
+
+    # The first run takes the newest view; a view is used at most once
+    assert calls == ["v2", None]
@@ -0,0 +1,115 @@
+import json
+import mmap
+import numpy as np
+import pytest
+
+import backend.app.crosswalk_index as crosswalk_index
+
+
+def _extract():
+    return {"elements": [
+        {"type": "node", "id": 1, "lat": 47.5000, "lon": 19.0400},
+        {"type": "node", "id": 2, "lat": 47.5010, "lon": 19.0400},
+        {"type": "node", "id": 3, "lat": 47.5011, "lon": 19.0401},
+        {"type": "way", "id": 10, "nodes": [2, 3], "geometry": [
+            {"lat": 47.5010, "lon": 19.0400},
+            {"lat": 47.5011, "lon": 19.0401},
+        ]},
+    ]}
+
+
+def test_overpass_nodes_of_a_way_belong_to_the_way():
+    ids, lats, lons, kinds = crosswalk_index.overpass_points(_extract()["elements"])
+    assert ids == [10, 10, 1]
+    assert kinds == [crosswalk_index.KIND_WAY, crosswalk_index.KIND_WAY, crosswalk_index.KIND_NODE]
+
+
+def test_load_and_query_extract(tmp_path):
+    path = tmp_path / "crossings.json"
+    path.write_text(json.dumps(_extract()))
+    index = crosswalk_index.load_overpass(str(path))
+
+    assert len(index) == 2 and index.points == 3
+    found = index.query(47.5000, 19.0400, 200)
+    assert [cw.id for cw in found] == [1, 10]
+    assert found[0].distance == pytest.approx(0.0, abs=1e-6)
+    assert found[1].kind == "way"
+    assert found[1].distance == pytest.approx(111.2, abs=0.5)
+    assert [cw.id for cw in index.query(47.5000, 19.0400, 50)] == [1]
+    assert index.query(47.5000, 19.0400, 200, limit=1)[0].id == 1
+
+
+def test_query_matches_brute_force():
+    extract = crosswalk_index.synthetic_extract(5000, 47.4979, 19.0402, 3000, seed=4)
+    index = crosswalk_index.CrosswalkIndex.from_points(
+        *crosswalk_index.overpass_points(extract["elements"]), cell_m=100
+    )
+    assert index.extent_m > 0
+    rng = np.random.default_rng(9)
+    for _ in range(50):
+        lat = 47.4979 + rng.uniform(-0.03, 0.03)
+        lon = 19.0402 + rng.uniform(-0.04, 0.04)
+        radius = float(rng.uniform(10, 600))
+        distance = crosswalk_index.haversine_m(lat, lon, index.lats, index.lons)
+        expected = sorted(set(int(i) for i in index.point_ids[distance <= radius]))
+        found = index.query(lat, lon, radius)
+        assert sorted(cw.id for cw in found) == expected
+        assert [cw.distance for cw in found] == sorted(cw.distance for cw in found)
+
+
+def test_nearest_points_matches_single_queries():
+    extract = crosswalk_index.synthetic_extract(3000, 47.4979, 19.0402, 2000, seed=7)
+    index = crosswalk_index.CrosswalkIndex.from_points(*crosswalk_index.overpass_points(extract["elements"]), cell_m=100)
+    rng = np.random.default_rng(3)
+    lats = 47.4979 + rng.uniform(-0.02, 0.02, 40)
+    lons = 19.0402 + rng.uniform(-0.03, 0.03, 40)
+    radii = rng.uniform(0, 500, 40)
+
+    query, rows, points, distance = index.nearest_points(lats, lons, radii)
+    for q in range(40):
+        expected = {cw.id: cw.distance for cw in index.query(lats[q], lons[q], radii[q])}
+        found = {int(index.ids[r]): d for r, d in zip(rows[query == q], distance[query == q])}
+        assert found.keys() == expected.keys()
+        assert all(found[i] == pytest.approx(expected[i]) for i in found)
+    assert index.nearest_points([], [], [])[0].size == 0
+
+
+def test_compact_file_round_trip(tmp_path):
+    source = tmp_path / "crossings.json"
+    source.write_text(json.dumps(crosswalk_index.synthetic_extract(3000, 47.4979, 19.0402, 2000, seed=2)))
+    path = str(tmp_path / "crossings.cwx")
+    built = crosswalk_index.build_compact(str(source), path)
+    mapped = crosswalk_index.load_index(path)
+
+    assert isinstance(mapped._buffer, mmap.mmap)
+    assert not mapped.lats.flags.writeable
+    assert (len(mapped), mapped.points, mapped.extent_m) == (len(built), built.points, built.extent_m)
+    for name in ("ids", "kinds", "keys", "offsets", "lats", "lons"):
+        assert np.array_equal(getattr(mapped, name), getattr(built, name))
+    for lat, lon in [(47.4979, 19.0402), (47.505, 19.03), (47.49, 19.05)]:
+        assert mapped.query(lat, lon, 300) == built.query(lat, lon, 300)
+
+
+def test_compact_file_rejects_other_files(tmp_path):
+    path = tmp_path / "bogus.cwx"
+    path.write_bytes(b"{}" * 64)
+    with pytest.raises(ValueError):
+        crosswalk_index.open_compact(str(path))
+
+
+def test_radius_is_clamped_and_empty_index():
+    index = crosswalk_index.random_index(2000, 0.0, 0.0, 5000, seed=1)
+    assert len(index.query(0.0, 0.0, 1e9)) == len(index.query(0.0, 0.0, crosswalk_index.CROSSWALK_MAX_RADIUS_M))
+    assert crosswalk_index.empty_index().query(0.0, 0.0, 500) == []
+
+
+def test_nearby_crosswalks_uses_configured_extract(tmp_path, monkeypatch):
+    path = tmp_path / "crossings.json"
+    path.write_text(json.dumps(_extract()))
+    monkeypatch.setattr(crosswalk_index, "CROSSWALK_DATA_PATH", str(path))
+    monkeypatch.setattr(crosswalk_index, "_index", None)
+
+    found = crosswalk_index.nearby_crosswalks(47.5000, 19.0400, 50)
+    assert found == [{"id": 1, "lat": 47.5, "lon": 19.04, "distance": 0.0, "kind": "node"}]
+    with pytest.raises(ValueError):
+        crosswalk_index.nearby_crosswalks(91.0, 0.0, 50)
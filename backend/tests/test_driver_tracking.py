@@ -0,0 +1,214 @@
+import asyncio
+import importlib
+import numpy as np
+import pytest
+
+import backend.app.crosswalk_index as crosswalk_index
+import backend.app.driver_tracking as driver_tracking
+import backend.app.memory_store as memory_store
+
+LAT, LON = 47.5, 19.04
+
+
+def _offset(north_m, east_m=0.0):
+    return (
+        LAT + north_m / crosswalk_index.M_PER_DEG_LAT,
+        LON + east_m / (crosswalk_index.M_PER_DEG_LAT * np.cos(np.radians(LAT))),
+    )
+
+
+def _index():
+    # Crosswalk 1 ahead (north), 2 further ahead, 3 behind
+    points = [_offset(100), _offset(250), _offset(-100)]
+    lats, lons = zip(*points)
+    return crosswalk_index.CrosswalkIndex.from_points([1, 2, 3], lats, lons, [crosswalk_index.KIND_NODE] * 3)
+
+
+class FakeSio:
+    def __init__(self):
+        self.rooms = set()
+
+    async def enter_room(self, sid, room):
+        self.rooms.add((sid, room))
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, crosswalk_id, deadline, view=None):
+        self.scheduled.append(crosswalk_id)
+
+
+class FakeCoalescer:
+    def __init__(self):
+        self.marked = []
+
+    def mark(self, crosswalk_id, view=None):
+        self.marked.append(crosswalk_id)
+
+
+@pytest.fixture
+def env(monkeypatch):
+    db = memory_store.MemoryClient()
+    sio, scheduler, coalescer = FakeSio(), FakeScheduler(), FakeCoalescer()
+    applied = []
+    state = importlib.import_module(driver_tracking.DriverFix.__module__)
+
+    async def fake_get_client():
+        return db
+
+    async def recording_apply(db_, changes):
+        applied.append(changes)
+        await state.apply_driver_changes(db_, changes)
+
+    async def fake_leave_room(sid, room):
+        sio.rooms.discard((sid, room))
+
+    monkeypatch.setattr(driver_tracking, "get_client", fake_get_client)
+    monkeypatch.setattr(driver_tracking, "apply_driver_changes", recording_apply)
+    monkeypatch.setattr(driver_tracking, "sio_server", sio)
+    monkeypatch.setattr(driver_tracking, "leave_room", fake_leave_room)
+    monkeypatch.setattr(driver_tracking, "get_scheduler", lambda: scheduler)
+    monkeypatch.setattr(driver_tracking, "get_coalescer", lambda: coalescer)
+    monkeypatch.setattr(driver_tracking, "get_shard_router", lambda: None)
+    return {"db": db, "sio": sio, "coalescer": coalescer, "applied": applied, "state": state}
+
+
+def test_locate_uses_reach_and_heading():
+    index = _index()
+    Position = driver_tracking.DriverPosition
+    located = driver_tracking.locate(index, [
+        Position(LAT, LON, 14.0, 0.0),  # heading north
+        Position(LAT, LON, 14.0, 180.0),  # heading south
+        Position(LAT, LON, 0.0, None),  # parked: no trusted heading
+        Position(*_offset(-20000), 14.0, 0.0),  # far away
+    ])
+    assert located[0].keys() == {1, 2}
+    assert located[0][1] == pytest.approx(100.0, abs=0.1)
+    assert located[1].keys() == {3}
+    assert located[2].keys() == {1, 2, 3}
+    assert located[3] == {}
+
+
+@pytest.mark.asyncio
+async def test_fixes_of_many_drivers_apply_in_one_batch(env):
+    tracker = driver_tracking.DriverTracker(tick=0.01, index=_index())
+    Position = driver_tracking.DriverPosition
+
+    results = await asyncio.gather(
+        tracker.submit("d1", Position(LAT, LON, 14.0, 0.0)),
+        tracker.submit("d2", Position(LAT, LON, 14.0, 180.0)),
+        tracker.submit("d1", Position(*_offset(10), 14.0, 0.0)),
+    )
+    assert results[0] == results[2]
+    assert results[2][1] == pytest.approx(90.0, abs=0.1)
+    assert len(env["applied"]) == 1
+    assert sorted(env["coalescer"].marked) == [1, 2, 3]
+    assert ("d1", "cw:1:drivers") in env["sio"].rooms
+
+    cw1 = await env["state"].get_crosswalk(env["db"], 1)
+    assert cw1["drivers"]["d1"]["distance"] == pytest.approx(90.0, abs=0.1)
+    assert await env["state"].get_memberships(env["db"], "d1") == [1, 2]
+
+    # d1 passes crosswalk 1 (now behind it) and leaves it; crosswalk 2 is updated
+    await tracker.submit("d1", Position(*_offset(150), 14.0, 0.0))
+    changes = env["applied"][-1]
+    assert changes[1] == {"d1": None}
+    assert changes[2]["d1"].joined is False
+    assert ("d1", "cw:1:drivers") not in env["sio"].rooms
+    assert "d1" not in (await env["state"].get_crosswalk(env["db"], 1))["drivers"]
+
+    stats = tracker.stats()
+    assert stats["drivers"] == 2 and stats["merged"] == 1
+    assert (stats["entered"], stats["updated"], stats["left"]) == (3, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_failed_write_is_retried_against_old_state(env, monkeypatch):
+    tracker = driver_tracking.DriverTracker(tick=0.01, index=_index())
+
+    async def failing_apply(db, changes):
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(driver_tracking, "apply_driver_changes", failing_apply)
+    with pytest.raises(RuntimeError):
+        await tracker.submit("d1", driver_tracking.DriverPosition(LAT, LON, 14.0, 0.0))
+    assert tracker.stats()["failed"] == 1
+
+    monkeypatch.setattr(driver_tracking, "apply_driver_changes", env["state"].apply_driver_changes)
+    await tracker.submit("d1", driver_tracking.DriverPosition(LAT, LON, 14.0, 0.0))
+    assert await env["state"].get_memberships(env["db"], "d1") == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_fix_pending_at_disconnect_is_dropped(env):
+    tracker = driver_tracking.DriverTracker(tick=0.01, index=_index())
+    Position = driver_tracking.DriverPosition
+
+    submitted = asyncio.ensure_future(tracker.submit("d1", Position(LAT, LON, 14.0, 0.0)))
+    other = asyncio.ensure_future(tracker.submit("d2", Position(LAT, LON, 14.0, 0.0)))
+    await asyncio.sleep(0)
+    tracker.forget("d1")  # disconnect within the same tick
+
+    assert await submitted == {}
+    assert set(await other) == {1, 2}
+    assert list(env["applied"][0][1]) == ["d2"]
+    assert "d1" not in (await env["state"].get_crosswalk(env["db"], 1))["drivers"]
+    assert tracker.stats()["drivers"] == 1
+
+
+@pytest.mark.asyncio
+async def test_remote_crosswalks_are_forwarded(env, monkeypatch):
+    class FakeRouter:
+        node_id = "a"
+
+        def __init__(self):
+            self.forwarded = []
+
+        def owner(self, crosswalk_id):
+            return "b" if crosswalk_id == 2 else "a"
+
+        async def forward(self, event, crosswalk_id, sid, data):
+            self.forwarded.append((event, crosswalk_id, sid, data["distance"]))
+            return True
+
+    router = FakeRouter()
+    monkeypatch.setattr(driver_tracking, "get_shard_router", lambda: router)
+    tracker = driver_tracking.DriverTracker(tick=0.01, index=_index())
+
+    await tracker.submit("d1", driver_tracking.DriverPosition(LAT, LON, 14.0, 0.0))
+    assert [f[:3] for f in router.forwarded] == [("driver_enter", 2, "d1")]
+    assert list(env["applied"][-1]) == [1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("during", ["before_write", "during_write"])
+async def test_disconnect_during_tick_is_not_undone(env, monkeypatch, during):
+    tracker = driver_tracking.DriverTracker(tick=0.01, index=_index())
+    Position = driver_tracking.DriverPosition
+    real_get_client = driver_tracking.get_client
+    real_apply = driver_tracking.apply_driver_changes
+
+    async def forgetting_get_client():
+        tracker.forget("d1")
+        return await real_get_client()
+
+    async def forgetting_apply(db, changes):
+        await real_apply(db, changes)
+        tracker.forget("d1")  # disconnect cleanup ran while the batch was in flight
+
+    if during == "before_write":
+        monkeypatch.setattr(driver_tracking, "get_client", forgetting_get_client)
+    else:
+        monkeypatch.setattr(driver_tracking, "apply_driver_changes", forgetting_apply)
+
+    d1 = asyncio.ensure_future(tracker.submit("d1", Position(LAT, LON, 14.0, 0.0)))
+    d2 = asyncio.ensure_future(tracker.submit("d2", Position(LAT, LON, 14.0, 0.0)))
+    assert await d1 == {}
+    assert set(await d2) == {1, 2}
+
+    cw1 = await env["state"].get_crosswalk(env["db"], 1)
+    assert set(cw1["drivers"]) == {"d2"}
+    assert ("d1", "cw:1:drivers") not in env["sio"].rooms
+    assert tracker.stats()["drivers"] == 1
@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from google.api_core.exceptions import DeadlineExceeded
+from google.auth.credentials import AnonymousCredentials
+
+import backend.app.firestore_pool as firestore_pool
+
+
+def _pool(**kwargs):
+    def factory():
+        return firestore_pool.PooledAsyncClient(
+            project="test", credentials=AnonymousCredentials(), database="walkaware-db"
+        )
+
+    return firestore_pool.FirestorePool(factory, **kwargs)
+
+
+def test_parse_deadlines():
+    deadlines = firestore_pool.parse_deadlines("get=2, update=5", 30.0)
+    assert deadlines == {"get": 2.0, "set": 30.0, "update": 5.0, "create": 30.0, "delete": 30.0}
+    with pytest.raises(ValueError):
+        firestore_pool.parse_deadlines("scan=1", 30.0)
+
+
+def test_client_prefers_least_loaded_channel():
+    pool = _pool(size=3)
+    clients = {id(pool.client()) for _ in range(6)}
+    assert len(clients) == 3
+
+    busy = pool.client()
+    busy._pool_slot.inflight = 5
+    assert all(pool.client() is not busy for _ in range(6))
+
+
+@pytest.mark.asyncio
+async def test_operations_get_timeouts_and_are_recorded(monkeypatch):
+    calls = []
+
+    async def fake_update(self, field_updates, option=None, retry=None, timeout=None):
+        calls.append((self.path, field_updates, timeout))
+        return "ok"
+
+    monkeypatch.setattr(firestore_pool.AsyncDocumentReference, "update", fake_update)
+    pool = _pool(size=2, request_timeout=3.0)
+    ref = pool.client().collection("crosswalks").document("1")
+
+    assert isinstance(ref, firestore_pool.PooledDocumentReference)
+    assert await ref.update({"peds": []}) == "ok"
+    assert await ref.update({"peds": []}, timeout=1.0) == "ok"
+
+    assert calls == [("crosswalks/1", {"peds": []}, 3.0), ("crosswalks/1", {"peds": []}, 1.0)]
+    stats = pool.stats()
+    assert stats["operations"]["update"]["count"] == 2
+    assert stats["operations"]["get"]["count"] == 0
+    assert stats["inflight"] == [0, 0]
+
+
+@pytest.mark.asyncio
+async def test_deadline_and_errors_are_counted(monkeypatch):
+    async def slow_get(self, *args, **kwargs):
+        await asyncio.sleep(1)
+
+    async def failing_delete(self, *args, **kwargs):
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(firestore_pool.AsyncDocumentReference, "get", slow_get)
+    monkeypatch.setattr(firestore_pool.AsyncDocumentReference, "delete", failing_delete)
+    pool = _pool(size=1, deadlines={op: 0.02 for op in firestore_pool.OPERATIONS})
+    ref = pool.client().document("sessions/s1")
+
+    with pytest.raises(DeadlineExceeded):
+        await ref.get()
+    with pytest.raises(RuntimeError):
+        await ref.delete()
+
+    ops = pool.stats()["operations"]
+    assert ops["get"]["timeouts"] == 1
+    assert ops["delete"]["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_saturation_when_channel_is_full(monkeypatch):
+    release = asyncio.Event()
+    running = {"now": 0, "max": 0}
+
+    async def held_set(self, *args, **kwargs):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await release.wait()
+        running["now"] -= 1
+
+    monkeypatch.setattr(firestore_pool.AsyncDocumentReference, "set", held_set)
+    pool = _pool(size=1, max_inflight=2)
+    client = pool.client()
+    tasks = [asyncio.create_task(client.document(f"sessions/s{i}").set({})) for i in range(4)]
+    await asyncio.sleep(0.01)
+
+    stats = pool.stats()
+    assert running["max"] == 2
+    assert stats["saturated"] == 2
+    assert stats["inflight"] == [4]
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert pool.stats()["operations"]["set"]["count"] == 4
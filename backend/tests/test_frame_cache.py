@@ -0,0 +1,41 @@
+import pytest
+
+import backend.app.frame_cache as frame_cache
+
+
+def test_near_duplicate_frame_hits_within_ttl():
+    cache = frame_cache.PredictionCache(max_distance=4, ttl=2.0, max_clients=8)
+    assert cache.lookup("sid", 0b1010, now=0.0) is None
+    cache.store("sid", 0b1010, True, now=0.0)
+
+    # Three differing bits is still "the same" frame
+    assert cache.lookup("sid", 0b0100, now=1.0) is True
+    # A different client never sees another client's result
+    assert cache.lookup("other", 0b1010, now=1.0) is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2
+    assert stats["hit_rate"] == pytest.approx(1 / 3)
+
+
+def test_distant_hash_and_expired_entry_miss():
+    cache = frame_cache.PredictionCache(max_distance=2, ttl=1.0, max_clients=8)
+    cache.store("sid", 0, False, now=0.0)
+    assert cache.lookup("sid", 0b111, now=0.5) is None
+    assert cache.lookup("sid", 0, now=5.0) is None
+    assert cache.stats()["clients"] == 0
+
+
+def test_lru_eviction_across_clients():
+    cache = frame_cache.PredictionCache(max_distance=0, ttl=10.0, max_clients=2)
+    cache.store("a", 1, True, now=0.0)
+    cache.store("b", 2, True, now=0.0)
+    assert cache.lookup("a", 1, now=0.1) is True  # refresh "a"
+    cache.store("c", 3, True, now=0.2)
+
+    assert cache.lookup("b", 2, now=0.3) is None
+    assert cache.lookup("a", 1, now=0.3) is True
+    assert cache.stats()["evictions"] == 1
+
+    cache.forget("a")
+    assert cache.lookup("a", 1, now=0.4) is None
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import os
 import types
@@ -32,6 +33,11 @@ class FakeClient:
         return FakeBucket(name, self.records)
 
 
+@pytest.fixture(autouse=True)
+def fresh_client(monkeypatch):
+    monkeypatch.setattr(gcs, "_client", None)
+
+
 def test_parse_data_url_variants():
     raw = b"abc"
     data_url = "data:image/png;base64," + base64.b64encode(raw).decode()
@@ -91,3 +97,96 @@ async def test_async_upload_storage_exception(monkeypatch):
     monkeypatch.setattr(gcs, "storage", Boom())
     uri = await gcs.async_upload_image_base64_to_gcs("data:image/jpeg;base64,AA==", is_crosswalk=True)
     assert uri is None
+
+
+def test_parse_frame_raw_bytes_sniffs_type():
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 8
+    out, mime, ext = gcs._parse_frame(png)
+    assert out is png and mime == "image/png" and ext == "png"
+
+    webp = b"RIFF\x00\x00\x00\x00WEBPVP8 "
+    assert gcs._parse_frame(webp)[1:] == ("image/webp", "webp")
+    assert gcs._parse_frame(b"GIF89a")[1:] == ("image/gif", "gif")
+    assert gcs._parse_frame(b"\xff\xd8\xff\xe0")[1:] == ("image/jpeg", "jpg")
+
+    raw = b"abc"
+    data_url = "data:image/png;base64," + base64.b64encode(raw).decode()
+    assert gcs._parse_frame(data_url) == (raw, "image/png", "png")
+
+
+@pytest.mark.asyncio
+async def test_async_upload_raw_bytes(monkeypatch):
+    records = []
+    monkeypatch.setattr(gcs, "GCS_BUCKET", "test-bucket")
+    monkeypatch.setattr(gcs, "storage", types.SimpleNamespace(Client=lambda: FakeClient(records)))
+
+    raw = b"\xff\xd8\xff\xe0jpegdata"
+    uri = await gcs.async_upload_image_to_gcs(raw, is_crosswalk=True)
+    assert uri is not None and uri.endswith(".jpg")
+    assert records[0][1] == raw and records[0][2] == "image/jpeg"
+
+
+@pytest.mark.asyncio
+async def test_storage_client_is_reused(monkeypatch):
+    records, created = [], []
+
+    def make_client():
+        created.append(1)
+        return FakeClient(records)
+
+    monkeypatch.setattr(gcs, "GCS_BUCKET", "test-bucket")
+    monkeypatch.setattr(gcs, "storage", types.SimpleNamespace(Client=make_client))
+
+    for _ in range(3):
+        assert await gcs.async_upload_image_to_gcs(b"\xff\xd8jpeg", is_crosswalk=True) is not None
+    assert len(records) == 3 and len(created) == 1
+
+
+@pytest.mark.asyncio
+async def test_uploader_dedups_and_rate_limits_per_client():
+    done = []
+
+    async def upload(frame, is_crosswalk):
+        done.append(frame)
+        return "gs://b/x"
+
+    uploader = gcs.ImageUploader(upload, workers=2, max_queued=10, per_minute=2, dedup_distance=2)
+    assert uploader.offer("a", b"f1", True, frame_hash=0b0000, now=0.0)
+    # Within 2 bits of the last accepted frame
+    assert not uploader.offer("a", b"f2", True, frame_hash=0b0011, now=1.0)
+    assert uploader.offer("a", b"f3", True, frame_hash=0b1111, now=2.0)
+    assert not uploader.offer("a", b"f4", True, frame_hash=0xFF00, now=3.0)
+    # Other clients have their own budget; a minute later "a" has its own back
+    assert uploader.offer("b", b"g1", False, frame_hash=0xFF00, now=3.0)
+    assert uploader.offer("a", b"f5", True, frame_hash=0xFF00, now=61.0)
+
+    await asyncio.sleep(0.01)
+    assert sorted(done) == [b"f1", b"f3", b"f5", b"g1"]
+    stats = uploader.stats()
+    assert stats["uploaded"] == 4 and stats["duplicates"] == 1 and stats["rate_limited"] == 1
+    assert stats["queued"] == 0 and stats["upload_ms_p50"] is not None
+    await uploader.close()
+
+
+@pytest.mark.asyncio
+async def test_uploader_drops_when_queue_is_full():
+    release = asyncio.Event()
+    started = []
+
+    async def upload(frame, is_crosswalk):
+        started.append(frame)
+        await release.wait()
+        return None
+
+    uploader = gcs.ImageUploader(upload, workers=1, max_queued=2, per_minute=0, dedup_distance=-1)
+    assert uploader.offer("a", b"1", True)
+    await asyncio.sleep(0)  # the worker takes frame 1
+    assert uploader.offer("a", b"2", True) and uploader.offer("a", b"3", True)
+    assert not uploader.offer("a", b"4", True)
+    assert uploader.stats()["queued"] == 2 and uploader.stats()["dropped"] == 1
+
+    release.set()
+    await asyncio.sleep(0.01)
+    assert started == [b"1", b"2", b"3"]
+    assert uploader.stats()["failed"] == 3
+    await uploader.close()
@@ -1,4 +1,5 @@
 import asyncio
+import time
 import pytest
 
 import backend.app.handlers as handlers
@@ -8,6 +9,7 @@ class CaptureSio:
     def __init__(self):
         self.emits = []
         self.bg_tasks = []
+        self.rooms = []
 
     async def emit(self, event, data=None, to=None):
         self.emits.append((event, data, to))
@@ -15,18 +17,56 @@ class CaptureSio:
     def start_background_task(self, target, *args, **kwargs):
         self.bg_tasks.append((target, args, kwargs))
 
+    async def enter_room(self, sid, room):
+        self.rooms.append(("enter", sid, room))
+
+    async def leave_room(self, sid, room):
+        self.rooms.append(("leave", sid, room))
+
+
+class FakeCoalescer:
+    def __init__(self):
+        self.marked = []
+
+    def mark(self, crosswalk_id, view=None):
+        self.marked.append(crosswalk_id)
+
+
+class FakeUploader:
+    def __init__(self):
+        self.offers = []
+
+    def offer(self, key, frame, is_crosswalk, frame_hash=None):
+        self.offers.append((key, frame, is_crosswalk, frame_hash))
+        return True
+
+    def forget(self, key):
+        pass
+
+
+class FakeBatcher:
+    def __init__(self, predict):
+        self.predict = predict
+
+    async def submit(self, frame):
+        return self.predict(frame)
+
 
 @pytest.mark.asyncio
 async def test_predict_emit_and_save(monkeypatch):
     sio = CaptureSio()
     monkeypatch.setattr(handlers, "sio_server", sio)
-    monkeypatch.setattr(handlers, "predictImageIsCrosswalk", lambda img: True)
+    monkeypatch.setattr(handlers, "get_prediction_batcher", lambda: FakeBatcher(lambda img: True))
+    uploader = FakeUploader()
+    monkeypatch.setattr(handlers, "get_image_uploader", lambda: uploader)
 
     sid = "sid1"
     await handlers.predict(sid, "user", "data:image/jpeg;base64,AA==", save=True)
 
     assert ("predict_result_user", True, sid) in sio.emits
-    assert len(sio.bg_tasks) == 1
+    # Undecodable frame: no dhash, so no dedup for it
+    assert uploader.offers == [(sid, "data:image/jpeg;base64,AA==", True, None)]
+    assert sio.bg_tasks == []
 
 
 @pytest.mark.asyncio
@@ -35,7 +75,7 @@ async def test_predict_error_path(monkeypatch):
     monkeypatch.setattr(handlers, "sio_server", sio)
     def boom(_):
         raise RuntimeError("fail")
-    monkeypatch.setattr(handlers, "predictImageIsCrosswalk", boom)
+    monkeypatch.setattr(handlers, "get_prediction_batcher", lambda: FakeBatcher(boom))
 
     sid = "sid2"
     await handlers.predict(sid, "bob", "data:image/jpeg;base64,AA==", save=False)
@@ -51,7 +91,7 @@ async def test_connect_and_disconnect_cleanup(monkeypatch):
     async def fake_get_client():
         return object()
 
-    async def fake_list_ids(db):
+    async def fake_memberships(db, sid):
         return [1]
 
     fake_cw = {"peds": ["sid"], "drivers": {"sid": {}}}
@@ -68,11 +108,11 @@ async def test_connect_and_disconnect_cleanup(monkeypatch):
     async def fake_set_role(db, sid, role):
         calls["set_role"].append((sid, role))
 
-    async def fake_notify(cid):
+    async def fake_notify(cid, view=None):
         calls["notif"].append(cid)
 
     monkeypatch.setattr(handlers, "get_client", fake_get_client)
-    monkeypatch.setattr(handlers, "list_crosswalk_ids", fake_list_ids)
+    monkeypatch.setattr(handlers, "get_memberships", fake_memberships)
     monkeypatch.setattr(handlers, "get_crosswalk", fake_get_cw)
     monkeypatch.setattr(handlers, "remove_ped", fake_remove_ped)
     monkeypatch.setattr(handlers, "remove_driver", fake_remove_driver)
@@ -104,31 +144,81 @@ async def test_ped_enter_leave_triggers(monkeypatch):
         return None
 
     cw = {"last_broadcast": {"ped_critical_min_distance": 7.5}}
-    async def fake_get_cw(db, cid):
-        return cw
-
-    started = {"val": False}
-    async def fake_add_running_task(db, cid):
-        started["val"] = True
-        return True
+    async def fake_get_cw_view(db, cid):
+        return handlers.CrosswalkView(cw, 0, time.time())
 
     monkeypatch.setattr(handlers, "get_client", fake_get_client)
     monkeypatch.setattr(handlers, "set_role", fake_set_role)
     monkeypatch.setattr(handlers, "add_ped", fake_add_ped)
-    monkeypatch.setattr(handlers, "get_crosswalk", fake_get_cw)
-    monkeypatch.setattr(handlers, "add_running_task", fake_add_running_task)
+    monkeypatch.setattr(handlers, "get_crosswalk_view", fake_get_cw_view)
+    coalescer = FakeCoalescer()
+    monkeypatch.setattr(handlers, "get_coalescer", lambda: coalescer)
 
     await handlers.ped_enter("sidp", {"crosswalk_id": 42})
 
     assert any(evt == "ped_critical" and payload["crosswalk_id"] == 42 for evt, payload, to in sio.emits)
-    assert len(sio.bg_tasks) == 1
+    assert coalescer.marked == [42]
     
     async def fake_remove_ped(db, cid, sid):
         return None
     monkeypatch.setattr(handlers, "remove_ped", fake_remove_ped)
 
+    monkeypatch.setattr(handlers, "leave_room", sio.leave_room)
+
     await handlers.ped_leave("sidp", {"crosswalk_id": 42})
-    assert len(sio.bg_tasks) == 2 
+    assert coalescer.marked == [42, 42]
+    assert sio.rooms == [("enter", "sidp", "cw:42:peds"), ("leave", "sidp", "cw:42:peds")]
+
+
+@pytest.mark.asyncio
+async def test_nearby_crosswalks_ack(monkeypatch):
+    calls = []
+
+    def fake_query(lat, lon, radius, limit):
+        calls.append((lat, lon, radius, limit))
+        return [{"id": 1, "lat": lat, "lon": lon, "distance": 0.0, "kind": "node"}]
+
+    monkeypatch.setattr(handlers, "query_nearby_crosswalks", fake_query)
+
+    ack = await handlers.nearby_crosswalks("sid", {"lat": "47.5", "lon": 19.04, "radius": 100})
+    assert ack["crosswalks"][0]["id"] == 1
+    assert calls == [(47.5, 19.04, 100.0, None)]
+    assert "error" in await handlers.nearby_crosswalks("sid", {"lon": 19.04})
+
+
+@pytest.mark.asyncio
+async def test_relevant_crosswalks_ack(monkeypatch):
+    calls = []
+
+    async def fake_search(lat, lon, speed, heading):
+        calls.append((lat, lon, speed, heading))
+        return [{"id": 3, "duration": 12.0}]
+
+    monkeypatch.setattr(handlers, "search_relevant_crosswalks", fake_search)
+
+    ack = await handlers.relevant_crosswalks("sid", {"lat": 47.5, "lon": 19.04, "speed": "12", "heading": 90})
+    assert ack == {"crosswalks": [{"id": 3, "duration": 12.0}]}
+    await handlers.relevant_crosswalks("sid", {"lat": 47.5, "lon": 19.04})
+    assert calls == [(47.5, 19.04, 12.0, 90.0), (47.5, 19.04, 0.0, None)]
+    assert "error" in await handlers.relevant_crosswalks("sid", {"lat": 47.5})
+
+
+@pytest.mark.asyncio
+async def test_driver_position_ack(monkeypatch):
+    submitted = []
+
+    class FakeTracker:
+        async def submit(self, sid, position):
+            submitted.append((sid, position))
+            return {4: 120.0, 3: 35.5}
+
+    monkeypatch.setattr(handlers, "get_driver_tracker", lambda: FakeTracker())
+
+    ack = await handlers.driver_position("d1", {"lat": 47.5, "lon": "19.04", "speed": 12, "heading": 270})
+    assert ack == {"crosswalks": [{"crosswalk_id": 3, "distance": 35.5}, {"crosswalk_id": 4, "distance": 120.0}]}
+    assert submitted == [("d1", handlers.DriverPosition(47.5, 19.04, 12.0, 270.0))]
+    assert "error" in await handlers.driver_position("d1", {"lat": 100.0, "lon": 19.04})
+    assert len(submitted) == 1
 
 
 @pytest.mark.asyncio
@@ -161,31 +251,184 @@ async def test_driver_enter_update_leave(monkeypatch):
     async def fake_remove_driver(db, cid, sid):
         return None
 
-    async def fake_add_running_task(db, cid):
-        return True
-
     monkeypatch.setattr(handlers, "set_role", fake_set_role)
     monkeypatch.setattr(handlers, "add_driver", fake_add_driver)
     monkeypatch.setattr(handlers, "update_driver", fake_update_driver)
     monkeypatch.setattr(handlers, "remove_driver", fake_remove_driver)
-    monkeypatch.setattr(handlers, "add_running_task", fake_add_running_task)
+    coalescer = FakeCoalescer()
+    monkeypatch.setattr(handlers, "get_coalescer", lambda: coalescer)
+
+    scheduled = []
+
+    class FakeScheduler:
+        def schedule(self, cid, deadline):
+            scheduled.append((cid, deadline))
+
+    monkeypatch.setattr(handlers, "get_scheduler", lambda: FakeScheduler())
+
+    monkeypatch.setattr(handlers, "leave_room", sio.leave_room)
 
+    before = time.time()
     await handlers.driver_enter("sidd", {"crosswalk_id": 9, "distance": 12.3, "speed": 3.4})
     await handlers.driver_update("sidd", {"crosswalk_id": 9, "distance": 10.0, "speed": 2.5})
     await handlers.driver_leave("sidd", {"crosswalk_id": 9})
 
-    assert len(sio.bg_tasks) == 3
+    assert coalescer.marked == [9, 9, 9]
+    assert sio.rooms == [("enter", "sidd", "cw:9:drivers"), ("leave", "sidd", "cw:9:drivers")]
+    assert [cid for cid, _ in scheduled] == [9, 9]
+    assert all(deadline >= before + handlers.DRIVER_PRESENCE_TTL for _, deadline in scheduled)
 
 
 @pytest.mark.asyncio
-async def test_ensure_background_task_not_started_when_flag_false(monkeypatch):
+async def test_driver_update_batch_is_one_grouped_write(monkeypatch):
     sio = CaptureSio()
     monkeypatch.setattr(handlers, "sio_server", sio)
+
     async def fake_get_client():
         return object()
-    async def fake_add_running_task(db, cid):
-        return False
+
+    applied = []
+
+    async def fake_apply(db, changes):
+        applied.append(changes)
+
+    async def fake_get_memberships(db, sid):
+        return []
+
     monkeypatch.setattr(handlers, "get_client", fake_get_client)
-    monkeypatch.setattr(handlers, "add_running_task", fake_add_running_task)
-    await handlers._ensure_background_task_running(123)
-    assert len(sio.bg_tasks) == 0
+    monkeypatch.setattr(handlers, "get_memberships", fake_get_memberships)
+    monkeypatch.setattr(handlers, "apply_driver_changes", fake_apply)
+    coalescer = FakeCoalescer()
+    monkeypatch.setattr(handlers, "get_coalescer", lambda: coalescer)
+    scheduled = []
+
+    class FakeScheduler:
+        def schedule(self, cid, deadline):
+            scheduled.append(cid)
+
+    monkeypatch.setattr(handlers, "get_scheduler", lambda: FakeScheduler())
+
+    await handlers.driver_update_batch("sidd", {
+        "speed": 8.0,
+        "crosswalks": [{"crosswalk_id": 1, "distance": 40.0}, {"crosswalk_id": 2, "distance": 75.0, "speed": 7.5}, {}],
+    })
+    await handlers.driver_update_batch("sidd", {"speed": 8.0, "crosswalks": []})
+
+    assert applied == [{
+        1: {"sidd": handlers.DriverFix(40.0, 8.0, joined=True)},
+        2: {"sidd": handlers.DriverFix(75.0, 7.5, joined=True)},
+    }]
+    assert coalescer.marked == [1, 2] and scheduled == [1, 2]
+    assert sio.rooms == [("enter", "sidd", "cw:1:drivers"), ("enter", "sidd", "cw:2:drivers")]
+
+
+@pytest.mark.asyncio
+async def test_driver_update_batch_writes_membership_only_on_join(monkeypatch):
+    import backend.app.memory_store as memory_store
+
+    sio = CaptureSio()
+    monkeypatch.setattr(handlers, "sio_server", sio)
+    db = memory_store.MemoryClient()
+
+    async def fake_get_client():
+        return db
+
+    class FakeScheduler:
+        def schedule(self, cid, deadline):
+            pass
+
+    monkeypatch.setattr(handlers, "get_client", fake_get_client)
+    monkeypatch.setattr(handlers, "get_coalescer", lambda: FakeCoalescer())
+    monkeypatch.setattr(handlers, "get_scheduler", lambda: FakeScheduler())
+    writes = []
+    real_write = db._write
+
+    def recording_write(collection, doc_id, data):
+        writes.append((collection, doc_id))
+        return real_write(collection, doc_id, data)
+
+    monkeypatch.setattr(db, "_write", recording_write)
+    batch = {"speed": 8.0, "crosswalks": [{"crosswalk_id": 1, "distance": 40.0}, {"crosswalk_id": 2, "distance": 75.0}]}
+
+    await handlers.driver_update_batch("sidd", batch)
+    assert ("sessions", "sidd") in writes
+    assert await handlers.get_memberships(db, "sidd") == [1, 2]
+
+    # Same crosswalks a second later: driver fixes only, no session or room changes
+    writes.clear()
+    sio.rooms.clear()
+    await handlers.driver_update_batch("sidd", {**batch, "crosswalks": batch["crosswalks"] + [{"crosswalk_id": 3, "distance": 90.0}]})
+    await handlers.driver_update_batch("sidd", batch)
+    assert writes.count(("sessions", "sidd")) == 1
+    assert sio.rooms == [("enter", "sidd", "cw:3:drivers")]
+    assert (await handlers.get_crosswalk(db, 1))["drivers"]["sidd"]["distance"] == 40.0
+
+
+@pytest.mark.asyncio
+async def test_predict_superseded_frame_gets_no_reply(monkeypatch):
+    sio = CaptureSio()
+    monkeypatch.setattr(handlers, "sio_server", sio)
+
+    class DroppingAdmission:
+        async def run(self, key, work):
+            return False, None
+
+    monkeypatch.setattr(handlers, "get_frame_admission", lambda: DroppingAdmission())
+    uploader = FakeUploader()
+    monkeypatch.setattr(handlers, "get_image_uploader", lambda: uploader)
+
+    await handlers.predict("sid3", "eve", "data:image/jpeg;base64,AA==", save=True)
+
+    assert sio.emits == []
+    assert uploader.offers == []
+
+
+@pytest.mark.asyncio
+async def test_predict_accepts_binary_frame(monkeypatch):
+    sio = CaptureSio()
+    monkeypatch.setattr(handlers, "sio_server", sio)
+    seen = []
+
+    def fake_predict(frame):
+        seen.append(frame)
+        return False
+
+    monkeypatch.setattr(handlers, "get_prediction_batcher", lambda: FakeBatcher(fake_predict))
+    monkeypatch.setattr(handlers, "frame_dhash", lambda frame: 7)
+    uploader = FakeUploader()
+    monkeypatch.setattr(handlers, "get_image_uploader", lambda: uploader)
+
+    raw = b"\xff\xd8\xff\xe0jpeg"
+    await handlers.predict("sid4", "zoe", raw, save=True)
+
+    assert seen == [raw]
+    assert ("predict_result_zoe", False, "sid4") in sio.emits
+    assert uploader.offers == [("sid4", raw, False, 7)]
+
+
+@pytest.mark.asyncio
+async def test_predict_reuses_cached_result_for_same_frame(monkeypatch):
+    import backend.app.frame_cache as frame_cache
+
+    sio = CaptureSio()
+    monkeypatch.setattr(handlers, "sio_server", sio)
+    calls = []
+
+    def fake_predict(frame):
+        calls.append(frame)
+        return True
+
+    cache = frame_cache.PredictionCache(max_distance=0, ttl=60.0)
+    monkeypatch.setattr(handlers, "get_prediction_cache", lambda: cache)
+    monkeypatch.setattr(handlers, "frame_dhash", lambda frame: 42)
+    monkeypatch.setattr(handlers, "get_prediction_batcher", lambda: FakeBatcher(fake_predict))
+
+    await handlers.predict("sid5", "kim", b"frame-1")
+    await handlers.predict("sid5", "kim", b"frame-2")
+
+    assert calls == [b"frame-1"]
+    assert [e for e in sio.emits if e[0] == "predict_result_kim"] == [
+        ("predict_result_kim", True, "sid5"),
+        ("predict_result_kim", True, "sid5"),
+    ]
+    assert cache.stats()["hits"] == 1
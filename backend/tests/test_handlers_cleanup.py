@@ -8,7 +8,7 @@ async def test_cleanup_sid_membership_ped(monkeypatch):
     async def fake_get_client():
         return object()
 
-    async def fake_list_ids(db):
+    async def fake_memberships(db, sid):
         return [5]
 
     cw_store = {"peds": ["sid"], "drivers": {}}
@@ -20,11 +20,11 @@ async def test_cleanup_sid_membership_ped(monkeypatch):
     async def fake_remove_ped(db, cid, sid):
         called["remove_ped"] += 1
 
-    async def fake_notify(cid):
+    async def fake_notify(cid, view=None):
         called["notif"] += 1
 
     monkeypatch.setattr(handlers, "get_client", fake_get_client)
-    monkeypatch.setattr(handlers, "list_crosswalk_ids", fake_list_ids)
+    monkeypatch.setattr(handlers, "get_memberships", fake_memberships)
     monkeypatch.setattr(handlers, "get_crosswalk", fake_get_cw)
     monkeypatch.setattr(handlers, "remove_ped", fake_remove_ped)
     monkeypatch.setattr(handlers, "handle_distance_based_notifications", fake_notify)
@@ -40,7 +40,7 @@ async def test_cleanup_sid_membership_driver(monkeypatch):
     async def fake_get_client():
         return object()
 
-    async def fake_list_ids(db):
+    async def fake_memberships(db, sid):
         return [1]
 
     cw_store = {"peds": [], "drivers": {"sid": {}}}
@@ -52,11 +52,11 @@ async def test_cleanup_sid_membership_driver(monkeypatch):
     async def fake_remove_driver(db, cid, sid):
         called["remove_driver"] += 1
 
-    async def fake_notify(cid):
+    async def fake_notify(cid, view=None):
         called["notif"] += 1
 
     monkeypatch.setattr(handlers, "get_client", fake_get_client)
-    monkeypatch.setattr(handlers, "list_crosswalk_ids", fake_list_ids)
+    monkeypatch.setattr(handlers, "get_memberships", fake_memberships)
     monkeypatch.setattr(handlers, "get_crosswalk", fake_get_cw)
     monkeypatch.setattr(handlers, "remove_driver", fake_remove_driver)
     monkeypatch.setattr(handlers, "handle_distance_based_notifications", fake_notify)
@@ -65,3 +65,90 @@ async def test_cleanup_sid_membership_driver(monkeypatch):
 
     assert called["remove_driver"] == 1
     assert called["notif"] == 1
+
+
+@pytest.mark.asyncio
+async def test_disconnect_only_reads_joined_crosswalks(monkeypatch):
+    import backend.app.memory_store as memory_store
+
+    db = memory_store.MemoryClient()
+    for cid in range(50):
+        await handlers.add_ped(db, cid, f"other{cid}")
+    await handlers.add_ped(db, 3, "sid")
+    await handlers.add_driver(db, 7, "sid", 40.0, speed=5.0)
+    await handlers.remove_ped(db, 3, "sid")
+    await handlers.add_ped(db, 4, "sid")
+
+    async def fake_get_client():
+        return db
+
+    reads = []
+    real_get_crosswalk = handlers.get_crosswalk
+
+    async def counting_get_crosswalk(db_, cid):
+        reads.append(cid)
+        return await real_get_crosswalk(db_, cid)
+
+    notified = []
+
+    async def fake_notify(cid, view=None):
+        notified.append(cid)
+
+    monkeypatch.setattr(handlers, "get_client", fake_get_client)
+    monkeypatch.setattr(handlers, "get_crosswalk", counting_get_crosswalk)
+    monkeypatch.setattr(handlers, "handle_distance_based_notifications", fake_notify)
+
+    await handlers.disconnect("sid")
+
+    assert sorted(reads) == [4, 7]
+    assert sorted(notified) == [4, 7]
+    assert "sid" not in (await real_get_crosswalk(db, 4))["peds"]
+    assert "sid" not in (await real_get_crosswalk(db, 7))["drivers"]
+    assert await handlers.get_memberships(db, "sid") == []
+
+
+@pytest.mark.asyncio
+async def test_disconnect_hands_its_view_to_the_evaluation(monkeypatch):
+    import importlib
+    import backend.app.memory_store as memory_store
+
+    notifications = importlib.import_module(handlers.handle_distance_based_notifications.__module__)
+    db = memory_store.MemoryClient()
+    await handlers.add_ped(db, 8101, "sid")
+    await handlers.add_ped(db, 8101, "other")
+    await handlers.add_driver(db, 8102, "sid", 40.0, speed=5.0)
+    await handlers.add_driver(db, 8102, "drv", 30.0, speed=5.0)
+
+    async def fake_get_client():
+        return db
+
+    async def noop(*args):
+        pass
+
+    monkeypatch.setattr(handlers, "get_client", fake_get_client)
+    monkeypatch.setattr(notifications, "get_client", fake_get_client)
+    monkeypatch.setattr(notifications, "emit_to_room", noop)
+    monkeypatch.setattr(notifications, "emit_to_sids", noop)
+    preconditions = []
+    real_update_crosswalk = notifications.update_crosswalk
+
+    async def recording_update(db, cid, updates, last_update_time=None):
+        preconditions.append(last_update_time)
+        await real_update_crosswalk(db, cid, updates, last_update_time)
+
+    monkeypatch.setattr(notifications, "update_crosswalk", recording_update)
+    before = notifications.get_view_stats().stats()
+
+    await handlers.disconnect("sid")
+
+    after = notifications.get_view_stats().stats()
+    assert after["evaluations"] - before["evaluations"] == 2
+    assert after["reads"] == before["reads"]
+    assert after["views_used"] - before["views_used"] == 2
+    # The handed-on views keep the removal's update time, so the evaluation writes are conditional
+    assert len(preconditions) == 2 and None not in preconditions
+    cw = await handlers.get_crosswalk(db, 8101)
+    assert cw["peds"] == ["other"]
+    assert cw["last_broadcast"]["presence"]["ped_count"] == 1
+    cw = await handlers.get_crosswalk(db, 8102)
+    assert list(cw["drivers"]) == ["drv"]
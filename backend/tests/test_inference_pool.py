@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+import pytest
+
+import backend.app.inference_pool as inference_pool
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_in_worker_thread_with_initializer():
+    inits = []
+
+    def init():
+        inits.append(threading.current_thread().name)
+
+    pool = inference_pool.InferencePool(kind="thread", workers=1, max_pending=2, initializer=init)
+    try:
+        name = await pool.run(lambda: threading.current_thread().name)
+        await pool.run(lambda: None)
+    finally:
+        pool.shutdown()
+
+    assert name.startswith("inference")
+    assert inits == [name]
+    assert pool.stats()["completed"] == 2
+
+
+@pytest.mark.asyncio
+async def test_event_loop_stays_responsive_during_inference():
+    pool = inference_pool.InferencePool(kind="thread", workers=1, max_pending=1, initializer=None)
+    ticks = []
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    try:
+        await asyncio.gather(pool.run(time.sleep, 0.2), ticker())
+    finally:
+        pool.shutdown()
+
+    assert len(ticks) == 5
+    assert ticks[-1] - ticks[0] < 0.15
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_saturated():
+    pool = inference_pool.InferencePool(kind="thread", workers=1, max_pending=1, initializer=None)
+    try:
+        busy = asyncio.ensure_future(pool.run(time.sleep, 0.1))
+        await asyncio.sleep(0)
+        with pytest.raises(inference_pool.InferenceOverloaded):
+            await pool.run(lambda: None)
+        await busy
+    finally:
+        pool.shutdown()
+
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["pending"] == 0
+
+
+def test_unknown_executor_kind():
+    with pytest.raises(ValueError):
+        inference_pool.InferencePool(kind="gpu")
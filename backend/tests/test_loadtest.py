@@ -0,0 +1,61 @@
+import importlib
+import pytest
+
+import backend.app.loadtest as loadtest
+
+
+def test_percentiles():
+    assert loadtest.percentiles([])["count"] == 0
+    stats = loadtest.percentiles([0.001 * i for i in range(1, 101)])
+    assert stats["count"] == 100
+    assert stats["p50"] == pytest.approx(50.5)
+    assert stats["max"] == pytest.approx(100.0)
+
+
+def test_expected_critical_matches_server_rule():
+    # 15 m away at 10 m/s is critical, 400 m away is not
+    assert loadtest.expected_critical(15.0, 10.0)
+    assert not loadtest.expected_critical(400.0, 10.0)
+
+
+def test_compare_reports_relative_change():
+    before = {
+        "commit": "aaa",
+        "params": {"peds": 10},
+        "alert_latency_ms": {"p50": 100.0, "p99": 200.0},
+        "events": {"sent_per_s": 50.0},
+    }
+    after = {
+        "commit": "bbb",
+        "params": {"peds": 10},
+        "alert_latency_ms": {"p50": 80.0, "p99": None},
+        "events": {"sent_per_s": 50.0},
+    }
+    lines = loadtest.compare(before, after)
+    assert "aaa" in lines[0] and "bbb" in lines[0]
+    assert not any(line.startswith("warning") for line in lines)
+    alert_p50 = next(line for line in lines if "alert p50" in line)
+    assert alert_p50.endswith("-20.0%")
+    alert_p99 = next(line for line in lines if "alert p99" in line)
+    assert alert_p99.rstrip().endswith("-")
+
+    after["params"] = {"peds": 20}
+    assert any(line.startswith("warning") for line in loadtest.compare(before, after))
+
+
+@pytest.mark.asyncio
+async def test_stub_model_never_loads_the_real_one(monkeypatch):
+    batching = importlib.import_module("app.batching")
+    inference_pool = importlib.import_module("app.inference_pool")
+    monkeypatch.setattr(batching, "_batcher", None)
+    monkeypatch.setattr(inference_pool, "_pool", None)
+    monkeypatch.setattr(loadtest, "LOADTEST_PREDICT_MS", 0.0)
+
+    batcher = loadtest.install_stub_model()
+
+    # The pool /stats and shutdown see is the stub's, and its workers load no model
+    assert batching.get_prediction_batcher() is batcher
+    assert inference_pool.get_inference_pool()._initializer is None
+    assert await batcher.submit(b"frame") is False
+    await batcher.close()
+    inference_pool.get_inference_pool().shutdown()
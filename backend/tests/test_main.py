@@ -10,3 +10,26 @@ def test_fastapi_test_endpoint(monkeypatch):
     client = TestClient(main.app)
     resp = client.get("/test")
     assert resp.status_code == 200
+
+
+def test_stats_endpoint():
+    client = TestClient(main.app)
+    resp = client.get("/stats")
+    assert resp.status_code == 200
+    body = resp.json()
+    assert set(body["predict"]) == {"admission", "cache", "batcher", "pool", "uploads"}
+    assert "dropped" in body["predict"]["admission"]
+    assert "dropped" in body["predict"]["uploads"]
+
+
+def test_nearby_crosswalks_endpoint(monkeypatch):
+    import backend.app.crosswalk_index as crosswalk_index
+
+    index = crosswalk_index.CrosswalkIndex.from_points([7], [47.5], [19.04], [crosswalk_index.KIND_NODE])
+    monkeypatch.setitem(main.nearby_crosswalks.__globals__, "_index", index)
+    client = TestClient(main.app)
+
+    resp = client.get("/crosswalks/nearby", params={"lat": 47.5001, "lon": 19.04, "radius": 50})
+    assert resp.status_code == 200
+    assert [cw["id"] for cw in resp.json()["crosswalks"]] == [7]
+    assert client.get("/crosswalks/nearby", params={"lat": 95, "lon": 19.04}).status_code == 422
@@ -0,0 +1,298 @@
+import asyncio
+import pytest
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion, DELETE_FIELD
+
+import backend.app.memory_store as memory_store
+
+
+@pytest.mark.asyncio
+async def test_document_set_update_and_sentinels():
+    db = memory_store.MemoryClient()
+    ref = db.collection("crosswalks").document("1")
+
+    assert (await ref.get()).exists is False
+    with pytest.raises(NotFound):
+        await ref.update({"peds": ArrayUnion(["p1"])})
+
+    await ref.set({"peds": [], "drivers": {}, "last_broadcast": {}})
+    await ref.update({"peds": ArrayUnion(["p1", "p2"])})
+    await ref.update({"peds": ArrayUnion(["p1"])})
+    await ref.update({"drivers.d1": {"distance": 10.0, "speed": 3.0, "ts": 1.0}})
+    await ref.update({"drivers.d1.distance": 8.0, "last_broadcast.driver_critical_active.d1": 8.0})
+
+    snap = await ref.get()
+    data = snap.to_dict()
+    assert data["peds"] == ["p1", "p2"]
+    assert data["drivers"]["d1"] == {"distance": 8.0, "speed": 3.0, "ts": 1.0}
+    assert snap.get("last_broadcast.driver_critical_active.d1") == 8.0
+
+    await ref.update({
+        "peds": ArrayRemove(["p1"]),
+        "drivers.d1": DELETE_FIELD,
+        "last_broadcast.driver_critical_active.d1": DELETE_FIELD,
+        "last_broadcast.missing.key": DELETE_FIELD,
+    })
+    data = (await ref.get()).to_dict()
+    assert data == {"peds": ["p2"], "drivers": {}, "last_broadcast": {"driver_critical_active": {}}}
+
+    # Snapshots are isolated from later writes and from caller mutation
+    snap = await ref.get()
+    snap.to_dict()["peds"].append("x")
+    await ref.update({"peds": ArrayUnion(["p3"])})
+    assert snap.to_dict()["peds"] == ["p2"]
+
+
+@pytest.mark.asyncio
+async def test_set_merge_create_delete_and_collection_get():
+    db = memory_store.MemoryClient()
+    sessions = db.collection("sessions")
+    await sessions.document("s1").set({"role": "ped", "subscriptions": ["1"]})
+    await sessions.document("s1").set({"role": None}, merge=True)
+    assert (await sessions.document("s1").get()).to_dict() == {"role": None, "subscriptions": ["1"]}
+
+    runtime = db.collection("runtime").document("7")
+    await runtime.create({"ts": 1})
+    with pytest.raises(AlreadyExists):
+        await runtime.create({"ts": 2})
+    await runtime.delete()
+    await runtime.delete()
+    assert (await runtime.get()).exists is False
+
+    docs = await db.collection("sessions").select([]).get()
+    assert [d.id for d in docs] == ["s1"]
+
+
+@pytest.mark.asyncio
+async def test_state_helpers_run_on_memory_client():
+    import backend.app.state as state
+
+    db = memory_store.MemoryClient()
+    await state.add_ped(db, 1, "p1")
+    await state.add_driver(db, 1, "d1", distance=40.0, speed=5.0)
+    await state.update_driver(db, 1, "d1", distance=35.0)
+    await state.set_last_broadcast_value(db, 1, "ped_critical_min_distance", 35.0)
+    await state.clear_last_broadcast_key(db, 1, "ped_critical_min_distance")
+
+    cw = await state.get_crosswalk(db, 1)
+    assert cw["peds"] == ["p1"]
+    assert cw["drivers"]["d1"]["distance"] == 35.0
+    assert "ped_critical_min_distance" not in cw["last_broadcast"]
+    assert await state.list_crosswalk_ids(db) == [1]
+
+    assert await state.add_running_task(db, 1) is True
+    assert await state.add_running_task(db, 1) is False
+    assert await state.remove_running_task(db, 1) is True
+
+
+@pytest.mark.asyncio
+async def test_batched_driver_changes_on_memory_client():
+    import backend.app.state as state
+
+    db = memory_store.MemoryClient()
+    await state.add_ped(db, 1, "p1")
+    await state.add_driver(db, 1, "d0", distance=80.0)
+    await state.set_last_broadcast_value(db, 1, "driver_critical_active", {"d1": True})
+
+    await state.apply_driver_changes(db, {
+        1: {"d1": state.DriverFix(40.0, 10.0, joined=True), "d0": state.DriverFix(70.0)},
+        2: {"d1": state.DriverFix(120.0, 10.0, joined=True)},
+    })
+    cw1, cw2 = await state.get_crosswalk(db, 1), await state.get_crosswalk(db, 2)
+    assert cw1["peds"] == ["p1"]
+    assert cw1["drivers"]["d1"]["distance"] == 40.0 and cw1["drivers"]["d0"]["distance"] == 70.0
+    assert cw2["drivers"]["d1"]["speed"] == 10.0
+    assert await state.get_memberships(db, "d1") == [1, 2]
+    assert (await state.session_ref(db, "d1").get()).to_dict()["role"] == "driver"
+
+    await state.apply_driver_changes(db, {1: {"d1": None}, 2: {"d1": state.DriverFix(90.0, 10.0)}})
+    cw1, cw2 = await state.get_crosswalk(db, 1), await state.get_crosswalk(db, 2)
+    assert "d1" not in cw1["drivers"]
+    assert cw1["last_broadcast"]["driver_critical_active"] == {}
+    assert "last_broadcast" not in cw2
+    assert cw2["drivers"]["d1"]["distance"] == 90.0
+    assert await state.get_memberships(db, "d1") == [2]
+
+
+@pytest.mark.asyncio
+async def test_update_with_last_update_time_precondition():
+    db = memory_store.MemoryClient()
+    ref = db.collection("crosswalks").document("1")
+    await ref.set({"drivers": {}})
+    first = (await ref.get()).update_time
+
+    await ref.update({"drivers.d1": {"distance": 1.0}}, option=db.write_option(last_update_time=first))
+    second = (await ref.get()).update_time
+    assert second > first
+
+    with pytest.raises(FailedPrecondition):
+        await ref.update({"drivers.d1": {"distance": 2.0}}, option=db.write_option(last_update_time=first))
+    assert (await ref.get()).get("drivers.d1.distance") == 1.0
+
+
+class RecordingBatch:
+    def __init__(self, firestore):
+        self._firestore = firestore
+        self._ops = []
+
+    def set(self, ref, data):
+        self._ops.append((ref.set, (data,)))
+
+    def delete(self, ref):
+        self._ops.append((ref.delete, ()))
+
+    async def commit(self):
+        self._firestore.commits += 1
+        for op, args in self._ops:
+            await op(*args)
+
+
+class RecordingFirestore:
+    def __init__(self):
+        self.writes = []
+        self.commits = 0
+
+    def batch(self):
+        return RecordingBatch(self)
+
+    def collection(self, name):
+        outer = self
+
+        class Doc:
+            def __init__(self, doc_id):
+                self.doc_id = doc_id
+
+            async def set(self, data):
+                outer.writes.append(("set", name, self.doc_id, data))
+
+            async def delete(self):
+                outer.writes.append(("delete", name, self.doc_id, None))
+
+        class Col:
+            def document(self, doc_id):
+                return Doc(doc_id)
+
+        return Col()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_coalesces_and_flushes_on_close():
+    firestore = RecordingFirestore()
+    persister = memory_store.FirestorePersister(firestore, interval=3600)
+    db = memory_store.MemoryClient(persister=persister)
+
+    ref = db.collection("crosswalks").document("5")
+    await ref.set({"peds": [], "drivers": {}})
+    for i in range(10):
+        await ref.update({f"drivers.d1": {"distance": float(i)}})
+    await db.collection("runtime").document("5").create({"ts": 1})
+    await db.collection("sessions").document("gone").set({"role": None})
+    await db.collection("sessions").document("gone").delete()
+
+    assert firestore.writes == []
+    await db.close()
+
+    assert sorted(firestore.writes, key=lambda w: w[1]) == [
+        ("set", "crosswalks", "5", {"peds": [], "drivers": {"d1": {"distance": 9.0}}}),
+        ("delete", "sessions", "gone", None),
+    ]
+    assert firestore.commits == 1
+    assert persister.stats() == {
+        "dirty": 0, "buffered": 13, "merged": 11, "flushed": 2, "batches": 1, "failed": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_write_behind_background_flush_and_retry():
+    class Flaky(RecordingFirestore):
+        fail = True
+
+        def collection(self, name):
+            col = super().collection(name)
+            outer = self
+
+            class Wrapped:
+                def document(self, doc_id):
+                    doc = col.document(doc_id)
+
+                    class D:
+                        async def set(self, data):
+                            if outer.fail:
+                                outer.fail = False
+                                raise RuntimeError("unavailable")
+                            await doc.set(data)
+
+                    return D()
+
+            return Wrapped()
+
+    firestore = Flaky()
+    persister = memory_store.FirestorePersister(firestore, interval=0.01)
+    db = memory_store.MemoryClient(persister=persister)
+    await db.collection("crosswalks").document("1").set({"peds": ["p"]})
+
+    for _ in range(50):
+        if firestore.writes:
+            break
+        await asyncio.sleep(0.01)
+    await db.close()
+
+    assert firestore.writes == [("set", "crosswalks", "1", {"peds": ["p"]})]
+    assert persister.stats()["failed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_early_in_bounded_batches():
+    firestore = RecordingFirestore()
+    persister = memory_store.FirestorePersister(firestore, interval=3600, max_dirty=5, batch_size=2)
+    db = memory_store.MemoryClient(persister=persister)
+
+    for i in range(4):
+        await db.collection("crosswalks").document(str(i)).set({"peds": []})
+    await asyncio.sleep(0.01)
+    assert firestore.writes == []
+
+    await db.collection("crosswalks").document("4").set({"peds": []})
+    for _ in range(50):
+        if len(firestore.writes) == 5:
+            break
+        await asyncio.sleep(0.01)
+
+    assert len(firestore.writes) == 5
+    assert firestore.commits == 3
+    assert persister.stats()["batches"] == 3
+    await db.close()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_close_waits_for_the_flush_in_progress():
+    class Slow(RecordingFirestore):
+        def batch(self):
+            batch = super().batch()
+            commit = batch.commit
+
+            async def slow_commit():
+                self.committing = True
+                await asyncio.sleep(0.05)
+                await commit()
+
+            batch.commit = slow_commit
+            return batch
+
+    firestore = Slow()
+    firestore.committing = False
+    persister = memory_store.FirestorePersister(firestore, interval=0.01, batch_size=2)
+    db = memory_store.MemoryClient(persister=persister)
+    for i in range(5):
+        await db.collection("crosswalks").document(str(i)).set({"peds": [f"p{i}"]})
+
+    for _ in range(50):
+        if firestore.committing:
+            break
+        await asyncio.sleep(0.005)
+    assert firestore.committing and firestore.writes == []
+    await db.close()
+
+    # Every document of the interrupted periodic flush, including its later chunks
+    assert sorted(w[2] for w in firestore.writes) == ["0", "1", "2", "3", "4"]
+    assert persister.stats()["dirty"] == 0
@@ -1,25 +1,28 @@
 import asyncio
+import copy
+import importlib
 import time
 import pytest
 
 import backend.app.notifications as notifications
+import backend.app.memory_store as notifications_memory_store
 
 
-class FakeDoc:
-    def __init__(self, store):
-        self.store = store
+def _use_store(monkeypatch, store):
+    """Serves the crosswalk from `store` and applies evaluation writes to it."""
 
-    async def update(self, data):
-        lb = self.store.setdefault("last_broadcast", {})
-        if "last_broadcast" in data:
-            self.store["last_broadcast"] = data["last_broadcast"]
-        if "drivers" in data:
-            self.store["drivers"] = data["drivers"]
+    async def fake_get_client():
+        return object()
+
+    async def fake_get_crosswalk_view(db, cid):
+        return notifications.CrosswalkView(copy.deepcopy(store), 0, time.time())
 
+    async def fake_update_crosswalk(db, cid, updates, last_update_time=None):
+        notifications_memory_store._apply_updates(store, updates)
 
-class FakeDB:
-    def __init__(self, store):
-        self.store = store
+    monkeypatch.setattr(notifications, "get_client", fake_get_client)
+    monkeypatch.setattr(notifications, "get_crosswalk_view", fake_get_crosswalk_view)
+    monkeypatch.setattr(notifications, "update_crosswalk", fake_update_crosswalk)
 
 
 @pytest.mark.asyncio
@@ -39,29 +42,20 @@ async def test_notifications_flows(monkeypatch):
     async def fake_emit_to_sids(sids, event, payload):
         events.append((tuple(sids), event, payload))
 
-    def fake_crosswalk_ref(db, cid):
-        return FakeDoc(store)
-
-    async def fake_get_client():
-        return FakeDB(store)
-
-    async def fake_get_crosswalk(db, cid):
-        return dict(store)
-
-    async def fake_remove_running_task(db, cid):
-        return None
+    async def fake_emit_to_room(room, event, payload):
+        events.append((room, event, payload))
 
     monkeypatch.setattr(notifications, "emit_to_sids", fake_emit_to_sids)
-    monkeypatch.setattr(notifications, "crosswalk_ref", fake_crosswalk_ref)
-    monkeypatch.setattr(notifications, "get_client", fake_get_client)
-    monkeypatch.setattr(notifications, "get_crosswalk", fake_get_crosswalk)
-    monkeypatch.setattr(notifications, "remove_running_task", fake_remove_running_task)
+    monkeypatch.setattr(notifications, "emit_to_room", fake_emit_to_room)
+    _use_store(monkeypatch, store)
 
     await notifications.handle_distance_based_notifications(1)
 
-    assert any(ev == "driver_critical" and sids == ("drv2",) for sids, ev, _ in events)
-    assert any(ev == "ped_critical" for _, ev, _ in events)
-    assert any(ev == "presence" for _, ev, _ in events)
+    assert any(ev == "driver_critical" and sids == ("drv1", "drv2") for sids, ev, _ in events)
+    assert any(ev == "ped_critical" and room == "cw:1:peds" for room, ev, _ in events)
+    assert any(ev == "presence" and room == ["cw:1:peds", "cw:1:drivers"] for room, ev, _ in events)
+    assert "drv_expired" not in store["drivers"]
+    assert store["last_broadcast"]["driver_critical_active"] == {"drv1": 12.0, "drv2": 8.2}
 
     store["peds"] = []
     store["drivers"]["drv2"]["distance"] = 1000.0
@@ -71,3 +65,217 @@ async def test_notifications_flows(monkeypatch):
 
     assert any(ev == "alert_end" for _, ev, _ in events)
     assert any(ev == "presence" for _, ev, _ in events)
+    assert "ped_critical_min_distance" not in store["last_broadcast"]
+
+
+@pytest.mark.asyncio
+async def test_presence_only_sent_on_change_or_keepalive(monkeypatch):
+    store = {"peds": ["ped1"], "drivers": {}, "last_broadcast": {}}
+    events = []
+
+    async def fake_emit_to_sids(sids, event, payload):
+        events.append(event)
+
+    async def fake_emit_to_room(room, event, payload):
+        events.append(event)
+
+    monkeypatch.setattr(notifications, "emit_to_sids", fake_emit_to_sids)
+    monkeypatch.setattr(notifications, "emit_to_room", fake_emit_to_room)
+    _use_store(monkeypatch, store)
+
+    await notifications.handle_distance_based_notifications(1)
+    assert events == ["presence"]
+    assert store["last_broadcast"]["presence"]["ped_count"] == 1
+
+    events.clear()
+    await notifications.handle_distance_based_notifications(1)
+    assert events == []
+
+    store["peds"] = ["ped1", "ped2"]
+    await notifications.handle_distance_based_notifications(1)
+    assert events == ["presence"]
+
+    # ped3 joins as ped1 leaves: same counts, but ped3 still needs its first presence
+    events.clear()
+    store["peds"] = ["ped2", "ped3"]
+    await notifications.handle_distance_based_notifications(1)
+    assert events == ["presence"]
+
+    events.clear()
+    monkeypatch.setattr(notifications, "PRESENCE_KEEPALIVE_S", 30.0)
+    store["last_broadcast"]["presence"]["ts"] = time.time() - 31
+    await notifications.handle_distance_based_notifications(1)
+    assert events == ["presence"]
+
+
+class CountingClient(notifications_memory_store.MemoryClient):
+    """MemoryClient that counts document reads."""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def collection(self, name):
+        query = super().collection(name)
+        client = self
+
+        class CountedQuery:
+            def document(self, doc_id):
+                ref = query.document(doc_id)
+                get = ref.get
+
+                async def counted_get(*args, **kwargs):
+                    client.reads += 1
+                    return await get(*args, **kwargs)
+
+                ref.get = counted_get
+                return ref
+
+        return CountedQuery()
+
+
+@pytest.mark.asyncio
+async def test_evaluation_reads_only_without_a_fresh_view(monkeypatch):
+    state = importlib.import_module(notifications.CrosswalkView.__module__)
+    db = CountingClient()
+    cid = 9101
+    await db.collection("crosswalks").document(str(cid)).set({
+        "peds": ["p1"],
+        "drivers": {"d1": {"distance": 40.0, "speed": 5.0, "ts": time.time()}},
+        "last_broadcast": {},
+    })
+
+    async def fake_get_client():
+        return db
+
+    async def noop(*args):
+        pass
+
+    monkeypatch.setattr(notifications, "get_client", fake_get_client)
+    monkeypatch.setattr(notifications, "emit_to_room", noop)
+    monkeypatch.setattr(notifications, "emit_to_sids", noop)
+
+    def fresh_view():
+        data, update_time = db._raw("crosswalks", str(cid))
+        return notifications.CrosswalkView(data, state.crosswalk_generation(cid), time.time(), update_time)
+
+    # No view: one read
+    assert await notifications.handle_distance_based_notifications(cid) is not None
+    assert db.reads == 1
+
+    # A fresh view: no read
+    view = fresh_view()
+    assert await notifications.handle_distance_based_notifications(cid, view) is not None
+    assert db.reads == 1
+
+    # A driver update since then makes that view stale
+    await state.update_driver(db, cid, "d1", 35.0, speed=5.0)
+    await notifications.handle_distance_based_notifications(cid, view)
+    assert db.reads == 2
+
+    # Current but too old
+    old = fresh_view()._replace(read_at=time.time() - 60)
+    await notifications.handle_distance_based_notifications(cid, old)
+    assert db.reads == 3
+
+    stats = notifications.get_view_stats().stats()
+    assert stats["views_used"] >= 1 and stats["views_stale"] >= 2
+    assert 0 < stats["reads_per_evaluation"] <= 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_update_is_not_overwritten(monkeypatch):
+    db = notifications_memory_store.MemoryClient()
+    cid = 9102
+    ref = db.collection("crosswalks").document(str(cid))
+    await ref.set({
+        "peds": ["p1"],
+        "drivers": {
+            "d1": {"distance": 40.0, "speed": 5.0, "ts": time.time() - 10_000},
+            "d2": {"distance": 20.0, "speed": 5.0, "ts": time.time()},
+        },
+        "last_broadcast": {},
+    })
+    events = []
+
+    async def fake_get_client():
+        return db
+
+    async def fake_emit_to_sids(sids, event, payload):
+        events.append((event, tuple(sids)))
+
+    async def noop(*args):
+        pass
+
+    monkeypatch.setattr(notifications, "get_client", fake_get_client)
+    monkeypatch.setattr(notifications, "emit_to_room", noop)
+    monkeypatch.setattr(notifications, "emit_to_sids", fake_emit_to_sids)
+    view = await notifications.get_crosswalk_view(db, cid)
+
+    # Another node refreshes d1 after the view was read
+    await ref.update({"drivers.d1.ts": time.time(), "drivers.d1.distance": 15.0})
+    before = notifications.get_write_stats().stats()
+    await notifications.handle_distance_based_notifications(cid, view)
+    after = notifications.get_write_stats().stats()
+
+    # The stale view would have expired d1; the conflict forces a re-evaluation
+    assert after["conflicts"] - before["conflicts"] == 1
+    assert after["writes"] - before["writes"] == 1
+    data = db.export_document("crosswalks", str(cid))
+    assert data["drivers"]["d1"]["distance"] == 15.0
+    assert data["last_broadcast"]["driver_critical_active"] == {"d1": 15.0, "d2": 20.0}
+    assert events == [("driver_critical", ("d1", "d2"))]
+
+
+@pytest.mark.asyncio
+async def test_evaluation_gives_up_after_bounded_retries(monkeypatch):
+    store = {"peds": ["p1"], "drivers": {}, "last_broadcast": {}}
+    attempts = []
+    events = []
+
+    async def conflicting_update(db, cid, updates, last_update_time=None):
+        attempts.append(updates)
+        raise notifications.FailedPrecondition("changed")
+
+    async def fake_emit_to_room(room, event, payload):
+        events.append(event)
+
+    _use_store(monkeypatch, store)
+    monkeypatch.setattr(notifications, "update_crosswalk", conflicting_update)
+    monkeypatch.setattr(notifications, "emit_to_room", fake_emit_to_room)
+    before = notifications.get_write_stats().stats()
+
+    # A retry deadline, not None: None would drop the crosswalk from the scheduler
+    started = time.time()
+    retry_at = await notifications.handle_distance_based_notifications(1)
+    assert started < retry_at <= time.time() + notifications.EVALUATION_RETRY_S
+
+    assert len(attempts) == notifications.EVALUATION_MAX_ATTEMPTS
+    assert notifications.get_write_stats().stats()["gave_up"] - before["gave_up"] == 1
+    assert events == []
+
+
+@pytest.mark.asyncio
+async def test_unchanged_evaluation_writes_nothing(monkeypatch):
+    now = time.time()
+    store = {
+        "peds": ["p1"],
+        "drivers": {"d1": {"distance": 500.0, "speed": 5.0, "ts": now}},
+        "last_broadcast": {"presence": {
+            "ped_count": 1, "driver_count": 1, "members": notifications._members_digest(["p1"], {"d1": {}}), "ts": now,
+        }},
+    }
+    writes = []
+
+    async def recording_update(db, cid, updates, last_update_time=None):
+        writes.append(updates)
+
+    async def noop(*args):
+        pass
+
+    _use_store(monkeypatch, store)
+    monkeypatch.setattr(notifications, "update_crosswalk", recording_update)
+    monkeypatch.setattr(notifications, "emit_to_room", noop)
+
+    assert await notifications.handle_distance_based_notifications(1) == pytest.approx(now + notifications.DRIVER_PRESENCE_TTL)
+    assert writes == []
@@ -17,3 +17,40 @@ async def test_emit_to_sids_handles_exceptions(monkeypatch):
 
     await notifications.emit_to_sids(["a", "b"], "evt", {"x": 1})
     assert calls["emits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_emit_to_sids_is_concurrent(monkeypatch):
+    import asyncio
+
+    state = {"in_flight": 0, "max": 0}
+
+    class SlowSio:
+        async def emit(self, event, payload, to=None):
+            state["in_flight"] += 1
+            state["max"] = max(state["max"], state["in_flight"])
+            await asyncio.sleep(0.01)
+            state["in_flight"] -= 1
+
+    monkeypatch.setattr(notifications, "sio_server", SlowSio())
+
+    await notifications.emit_to_sids(["a", "b", "c"], "evt", {"x": 1})
+    assert state["max"] == 3
+
+
+@pytest.mark.asyncio
+async def test_emit_to_room_emits_once_and_records_latency(monkeypatch):
+    calls = []
+
+    class FakeSio:
+        async def emit(self, event, payload, room=None):
+            calls.append((event, room))
+
+    stats = notifications.FanoutStats()
+    monkeypatch.setattr(notifications, "sio_server", FakeSio())
+    monkeypatch.setattr(notifications, "_fanout_stats", stats)
+
+    await notifications.emit_presence(4, ["p1", "p2"], ["d1"])
+
+    assert calls == [("presence", ["cw:4:peds", "cw:4:drivers"])]
+    assert stats.stats()["fanouts"] == 1
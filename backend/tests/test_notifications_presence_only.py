@@ -10,28 +10,26 @@ async def test_presence_emission_only(monkeypatch):
     async def fake_get_client():
         return object()
 
-    async def fake_get_crosswalk(db, cid):
-        return dict(store)
+    async def fake_get_crosswalk_view(db, cid):
+        return notifications.CrosswalkView(dict(store), 0, 0.0)
 
     updated = {"val": False}
-    class FakeDoc:
-        async def update(self, data):
-            updated["val"] = True
-    def fake_crosswalk_ref(db, cid):
-        return FakeDoc()
+    async def fake_update_crosswalk(db, cid, updates, last_update_time=None):
+        updated["val"] = True
 
     emitted = []
     async def fake_emit_to_sids(sids, evt, payload):
         emitted.append((evt, payload))
 
-    async def fake_remove_running_task(db, cid):
-        return None
 
     monkeypatch.setattr(notifications, "get_client", fake_get_client)
-    monkeypatch.setattr(notifications, "get_crosswalk", fake_get_crosswalk)
-    monkeypatch.setattr(notifications, "crosswalk_ref", fake_crosswalk_ref)
+    monkeypatch.setattr(notifications, "get_crosswalk_view", fake_get_crosswalk_view)
+    monkeypatch.setattr(notifications, "update_crosswalk", fake_update_crosswalk)
+    async def fake_emit_to_room(room, evt, payload):
+        emitted.append((evt, payload))
+
     monkeypatch.setattr(notifications, "emit_to_sids", fake_emit_to_sids)
-    monkeypatch.setattr(notifications, "remove_running_task", fake_remove_running_task)
+    monkeypatch.setattr(notifications, "emit_to_room", fake_emit_to_room)
 
     await notifications.handle_distance_based_notifications(7)
 
@@ -22,10 +22,10 @@ class FakeModel:
     def __init__(self, res):
         self._res = res
 
-    def predict(self, source):
-        # Ensure we received an image-like object from base64_to_image
-        assert isinstance(source, np.ndarray)
-        return [self._res]
+    def predict(self, source, **kwargs):
+        # Ensure we received the preprocessed NCHW batch built from base64_to_image
+        assert tuple(source.shape[1:]) == (3, 224, 224)
+        return [self._res for _ in range(len(source))]
 
 
 @pytest.fixture(autouse=True)
@@ -52,6 +52,28 @@ def test_predict_false_wrong_class(monkeypatch):
     assert prediction.predictImageIsCrosswalk("data:image/jpeg;base64,AA==") is False
 
 
+def test_predict_batch_one_result_per_frame(monkeypatch):
+    fake_res = FakeResult(top1=0, conf=0.95)
+    monkeypatch.setattr(prediction, "get_model", lambda: FakeModel(fake_res))
+    out = prediction.predictImagesAreCrosswalk(["a", "b", "c"])
+    assert out == [True, True, True]
+
+
+def test_predict_batch_isolates_decode_errors(monkeypatch):
+    fake_res = FakeResult(top1=1, conf=0.99)
+    monkeypatch.setattr(prediction, "get_model", lambda: FakeModel(fake_res))
+
+    def decode(s):
+        if s == "bad":
+            raise ValueError("corrupt")
+        return np.zeros((1, 1, 3), dtype=np.uint8)
+
+    monkeypatch.setattr(prediction, "base64_to_image", decode)
+    out = prediction.predictImagesAreCrosswalk(["ok", "bad"])
+    assert out[0] is False
+    assert isinstance(out[1], ValueError)
+
+
 def test_base64_to_image_real_decode():
     # Create a small valid JPEG in-memory and ensure we can decode it back
     img = np.zeros((2, 2, 3), dtype=np.uint8)
@@ -67,6 +89,33 @@ def test_base64_to_image_real_decode():
     out = pred2.base64_to_image(data_url)
     assert isinstance(out, np.ndarray) and out.ndim == 3
 
+    # Binary Socket.IO attachments arrive as raw encoded bytes
+    out_raw = pred2.decode_frame(buf.tobytes())
+    assert isinstance(out_raw, np.ndarray) and out_raw.shape == out.shape
+
+
+def test_jpeg_size_and_reduced_decode():
+    img = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    ok, buf = cv2.imencode(".jpg", img)
+    assert ok
+    assert prediction.jpeg_size(buf.tobytes()) == (1920, 1080)
+    assert prediction.jpeg_size(b"not a jpeg") is None
+
+    data_url = "data:image/jpeg;base64," + base64.b64encode(buf.tobytes()).decode()
+    out = prediction.decode_frame(data_url)
+    # 1080 / 4 = 270 is the smallest DCT-scaled size still >= 224
+    assert out.shape == (270, 480, 3)
+
+
+def test_frame_buffer_is_reused():
+    buffer = prediction.FrameBuffer()
+    img = np.full((300, 400, 3), 255, dtype=np.uint8)
+    first = buffer.load([img, img])
+    second = buffer.load([img])
+    assert first.shape == (2, 3, 224, 224)
+    assert np.shares_memory(first, second)
+    assert np.allclose(second, 1.0)
+
 
 def test_get_model_singleton_and_path(monkeypatch):
     calls = {"count": 0, "path": None}
@@ -86,3 +135,75 @@ def test_get_model_singleton_and_path(monkeypatch):
     assert m1 is m2
     assert calls["count"] == 1
     assert os.path.basename(calls["path"]) == "best.pt"
+
+
+def test_unknown_backend_rejected():
+    with pytest.raises(ValueError):
+        prediction._load_backend("tpu")
+
+
+def test_preprocess_resizes_shorter_edge_and_center_crops():
+    img = np.zeros((480, 640, 3), dtype=np.uint8)
+    img[:, :, 2] = 255  # pure red in BGR
+    out = prediction.preprocess_image(img)
+    assert out.shape == (3, 224, 224) and out.dtype == np.float32
+    assert np.allclose(out[0], 1.0) and np.allclose(out[1:], 0.0)
+
+
+def test_onnx_backend_matches_torch(tmp_path):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    import importlib
+    import shutil
+    import backend.prediction as pred
+
+    pred = importlib.reload(pred)
+    weights = tmp_path / "best.pt"
+    shutil.copy(os.path.join(os.path.dirname(pred.__file__), "best.pt"), weights)
+    onnx_backend = pred.OnnxBackend(pred.export_onnx(weights))
+    torch_backend = pred.TorchBackend(pred.YOLO(str(weights)))
+
+    rng = np.random.default_rng(0)
+    images = [
+        rng.integers(0, 255, (224, 224, 3), dtype=np.uint8),
+        rng.integers(0, 255, (480, 640, 3), dtype=np.uint8),
+        np.tile(np.array([[[255], [0]]], dtype=np.uint8), (240, 160, 3)),  # zebra-like stripes
+    ]
+    for (t_top1, t_conf), (o_top1, o_conf) in zip(torch_backend.classify(images), onnx_backend.classify(images)):
+        assert t_top1 == o_top1
+        assert abs(t_conf - o_conf) < 0.02
+        assert pred.isCrosswalk(t_top1, t_conf) == pred.isCrosswalk(o_top1, o_conf)
+
+
+def test_onnx_backend_requires_an_exported_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(prediction, "_weights_path", lambda: tmp_path / "best.pt")
+
+    def no_export(*args, **kwargs):
+        raise AssertionError("workers must not export the model")
+
+    monkeypatch.setattr(prediction, "export_onnx", no_export)
+    with pytest.raises(FileNotFoundError, match="python prediction.py"):
+        prediction._load_backend("onnx")
+    assert prediction.onnx_model_path(int8=True) == tmp_path / "best.int8.onnx"
+
+
+def test_frame_dhash_is_stable_for_similar_frames():
+    rng = np.random.default_rng(1)
+    base = cv2.resize(rng.integers(0, 255, (8, 9, 3), dtype=np.uint8), (640, 480), interpolation=cv2.INTER_NEAREST)
+    noisy = np.clip(base.astype(np.int16) + rng.integers(-3, 4, base.shape), 0, 255).astype(np.uint8)
+    other = 255 - base
+
+    def encode(img):
+        ok, buf = cv2.imencode(".jpg", img)
+        assert ok
+        return buf.tobytes()
+
+    h_base = prediction.frame_dhash(encode(base))
+    h_noisy = prediction.frame_dhash("data:image/jpeg;base64," + base64.b64encode(encode(noisy)).decode())
+    h_other = prediction.frame_dhash(encode(other))
+
+    assert (h_base ^ h_noisy).bit_count() <= 4
+    assert (h_base ^ h_other).bit_count() > 16
+
+    with pytest.raises(ValueError):
+        prediction.frame_dhash(b"not an image")
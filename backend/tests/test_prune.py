@@ -1,6 +1,10 @@
 import asyncio
+import copy
+import importlib
+import time
 import pytest
 
+import backend.app.memory_store as memory_store
 import backend.app.prune as prune
 
 
@@ -9,6 +13,7 @@ class FakeDoc:
         self.id = str(id)
         self._data = data
         self.exists = True
+        self.update_time = 1000.0 + id
 
     def to_dict(self):
         return dict(self._data)
@@ -32,72 +37,193 @@ class FakeDB:
         raise KeyError(name)
 
 
+async def _run_briefly(scheduler, seconds):
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(seconds)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
 @pytest.mark.asyncio
-async def test_prune_loop_one_iteration(monkeypatch):
-    fake_db = FakeDB(docs=[(1, {"peds": [], "drivers": {}})])
+async def test_scheduler_evaluates_at_deadline_and_reschedules():
+    calls = []
 
-    async def fake_get_client():
-        return fake_db
+    async def evaluate(cid, view=None):
+        calls.append((cid, time.time()))
+        # Drivers remain once, then the crosswalk empties
+        return time.time() + 0.02 if len(calls) == 1 else None
+
+    scheduler = prune.NotificationScheduler(evaluate)
+    start = time.time()
+    scheduler.schedule(7, start + 0.02)
+    await _run_briefly(scheduler, 0.15)
 
-    called = {"val": 0}
+    assert [cid for cid, _ in calls] == [7, 7]
+    assert calls[0][1] >= start + 0.02
+    assert scheduler.stats()["tracked"] == 0
+    assert scheduler.stats()["evaluations"] == 2
 
-    async def fake_handle(cid, cw):
-        called["val"] += 1
-        raise asyncio.CancelledError
 
-    async def fast_sleep(_):
+@pytest.mark.asyncio
+async def test_scheduler_keeps_earliest_deadline_only():
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(cid)
         return None
 
-    monkeypatch.setattr(prune, "get_client", fake_get_client)
-    monkeypatch.setattr(prune, "handle_distance_based_notifications", fake_handle)
-    monkeypatch.setattr(prune, "PRUNE_LOOP_INTERVAL", 0)
-    monkeypatch.setattr(asyncio, "sleep", fast_sleep)
+    scheduler = prune.NotificationScheduler(evaluate)
+    now = time.time()
+    scheduler.schedule(1, now + 0.01)
+    scheduler.schedule(1, now + 10)
+    scheduler.schedule(2, now + 10)
+    await _run_briefly(scheduler, 0.05)
+
+    assert calls == [1]
+    assert scheduler.stats()["tracked"] == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_wakes_up_for_earlier_deadline():
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(cid)
+        return None
 
+    scheduler = prune.NotificationScheduler(evaluate)
+    scheduler.schedule(1, time.time() + 60)
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(0.01)
+    scheduler.schedule(2, time.time())
+    await asyncio.sleep(0.02)
+    task.cancel()
     with pytest.raises(asyncio.CancelledError):
-        await prune.prune_loop()
+        await task
 
-    assert called["val"] == 1
+    assert calls == [2]
 
 
-def test_register_prune_creates_task(monkeypatch):
-    created = {"val": False}
+@pytest.mark.asyncio
+async def test_scheduler_bounds_concurrency_and_survives_errors():
+    running = {"now": 0, "max": 0}
+
+    async def evaluate(cid, view=None):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        if cid == 0:
+            raise RuntimeError("boom")
+        return None
 
-    def fake_create_task(coro):
-        created["val"] = True
-        class T:
-            pass
-        return T()
+    scheduler = prune.NotificationScheduler(evaluate, concurrency=2)
+    now = time.time()
+    for cid in range(6):
+        scheduler.schedule(cid, now)
+    await _run_briefly(scheduler, 0.1)
+
+    assert running["max"] == 2
+    assert scheduler.stats()["evaluations"] == 6
 
-    monkeypatch.setattr(prune.asyncio, "create_task", fake_create_task)
-    prune.register_prune(object())
-    assert created["val"] is True
+
+@pytest.mark.asyncio
+async def test_failed_evaluations_are_retried_until_driver_is_pruned(monkeypatch):
+    notifications = importlib.import_module(prune.handle_distance_based_notifications.__module__)
+    store = {"peds": ["p1"], "drivers": {"d1": {"distance": 5.0, "ts": time.time() - 60}}, "last_broadcast": {}}
+    reads = []
+
+    async def fake_get_client():
+        return object()
+
+    async def flaky_get_crosswalk_view(db, cid):
+        reads.append(cid)
+        if len(reads) == 1:
+            raise RuntimeError("transient read error")
+        return notifications.CrosswalkView(copy.deepcopy(store), 0, time.time())
+
+    async def fake_update_crosswalk(db, cid, updates, last_update_time=None):
+        memory_store._apply_updates(store, updates)
+
+    async def fake_emit(*args):
+        pass
+
+    monkeypatch.setattr(notifications, "get_client", fake_get_client)
+    monkeypatch.setattr(notifications, "get_crosswalk_view", flaky_get_crosswalk_view)
+    monkeypatch.setattr(notifications, "update_crosswalk", fake_update_crosswalk)
+    monkeypatch.setattr(notifications, "emit_to_room", fake_emit)
+    monkeypatch.setattr(notifications, "emit_to_sids", fake_emit)
+    monkeypatch.setattr(notifications, "emit_presence", fake_emit)
+    monkeypatch.setattr(notifications, "EVALUATION_RETRY_S", 0.01)
+    calls = []
+
+    async def evaluate(cid, view=None):
+        calls.append(cid)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return await notifications.handle_distance_based_notifications(cid, view)
+
+    scheduler = prune.NotificationScheduler(evaluate, retry_interval=0.01)
+    scheduler.schedule(1, time.time())
+    await _run_briefly(scheduler, 0.15)
+
+    # Raised, then failed to read, then pruned the driver and stopped tracking it
+    assert calls == [1, 1, 1] and len(reads) == 2
+    assert store["drivers"] == {}
+    assert scheduler.stats()["retries"] == 1 and scheduler.stats()["tracked"] == 0
 
 
 @pytest.mark.asyncio
-async def test_prune_loop_except_and_sleep(monkeypatch):
+async def test_bootstrap_seeds_crosswalks_with_drivers(monkeypatch):
+    now = time.time()
+    fake_db = FakeDB(docs=[
+        (1, {"peds": ["p"], "drivers": {}}),
+        (2, {"drivers": {"a": {"ts": now - 5}, "b": {"ts": now - 1}}}),
+    ])
+
+    async def fake_get_client():
+        return fake_db
+
+    monkeypatch.setattr(prune, "get_client", fake_get_client)
+    scheduler = prune.NotificationScheduler(lambda cid: None)
+    await prune.bootstrap_scheduler(scheduler)
+
+    assert scheduler._deadlines == {2: pytest.approx(now - 5 + prune.DRIVER_PRESENCE_TTL)}
+    # The scanned document is handed to the evaluation instead of being read again
+    assert scheduler._views[2].data["drivers"].keys() == {"a", "b"}
+    assert scheduler._views[2].update_time == 1002.0
+
+
+@pytest.mark.asyncio
+async def test_bootstrap_ignores_read_errors(monkeypatch):
     class BoomCollection:
         async def get(self):
             raise RuntimeError("boom")
 
-    class FakeDB:
+    class BoomDB:
         def collection(self, name):
-            if name == "crosswalks":
-                return BoomCollection()
-            raise KeyError(name)
+            return BoomCollection()
 
     async def fake_get_client():
-        return FakeDB()
+        return BoomDB()
 
-    sleep_called = {"v": False}
+    monkeypatch.setattr(prune, "get_client", fake_get_client)
+    scheduler = prune.NotificationScheduler(lambda cid: None)
+    await prune.bootstrap_scheduler(scheduler)
+    assert scheduler.stats()["tracked"] == 0
 
-    async def fake_sleep(_):
-        sleep_called["v"] = True
-        raise asyncio.CancelledError
 
-    monkeypatch.setattr(prune, "get_client", fake_get_client)
-    monkeypatch.setattr(prune.asyncio, "sleep", fake_sleep)
+def test_register_prune_creates_task(monkeypatch):
+    created = {"val": False}
 
-    with pytest.raises(asyncio.CancelledError):
-        await prune.prune_loop()
+    def fake_create_task(coro):
+        created["val"] = True
+        coro.close()
+        class T:
+            pass
+        return T()
 
-    assert sleep_called["v"] is True
+    monkeypatch.setattr(prune.asyncio, "create_task", fake_create_task)
+    prune.register_prune(object())
+    assert created["val"] is True
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+import backend.app.crosswalk_index as crosswalk_index
+import backend.app.relevant_crosswalks as relevant
+
+LAT, LON = 47.5, 19.04
+
+
+def _offset(north_m, east_m):
+    return (
+        LAT + north_m / crosswalk_index.M_PER_DEG_LAT,
+        LON + east_m / (crosswalk_index.M_PER_DEG_LAT * np.cos(np.radians(LAT))),
+    )
+
+
+def _index(points):
+    lats, lons = zip(*[_offset(n, e) for n, e in points])
+    return crosswalk_index.CrosswalkIndex.from_points(
+        list(range(1, len(points) + 1)), lats, lons, [crosswalk_index.KIND_NODE] * len(points)
+    )
+
+
+class CountingRouter:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    async def durations(self, lat, lon, speed, points):
+        self.calls.append(list(points))
+        if self.fail:
+            raise RuntimeError("routing down")
+        return [float(crosswalk_index.haversine_m(lat, lon, p_lat, p_lon)) / speed for p_lat, p_lon in points]
+
+    async def close(self):
+        pass
+
+
+def test_bearing_and_cone():
+    assert relevant.bearing_deg(LAT, LON, *_offset(100, 0)) == pytest.approx(0.0, abs=0.1)
+    assert relevant.bearing_deg(LAT, LON, *_offset(0, 100)) == pytest.approx(90.0, abs=0.1)
+
+    points = [_offset(200, 0), _offset(-200, 0), _offset(0, 200), _offset(10, -10), _offset(900, 0)]
+    lats, lons = map(np.array, zip(*points))
+    distances = crosswalk_index.haversine_m(LAT, LON, lats, lons)
+    # Heading north at 14 m/s: ahead, not behind or abeam; very close always; 900 m out of reach
+    assert relevant.prefilter(LAT, LON, 14.0, 0.0, lats, lons, distances).tolist() == [True, False, False, True, False]
+    # Standing still: no trusted heading, so only the reach applies
+    assert relevant.prefilter(LAT, LON, 0.0, 0.0, lats, lons, distances).tolist() == [True, True, True, True, False]
+
+
+def test_route_cache_expires_and_evicts():
+    cache = relevant.RouteCache(ttl=10.0, max_entries=2)
+    cache.store(("s", 1), 12.0, now=0.0)
+    assert cache.lookup(("s", 1), now=5.0) == (True, 12.0)
+    assert cache.lookup(("s", 1), now=11.0) == (False, None)
+    cache.store(("s", 1), None, now=20.0)
+    cache.store(("s", 2), 3.0, now=20.0)
+    cache.store(("s", 3), 4.0, now=20.0)
+    assert cache.lookup(("s", 1), now=21.0) == (False, None)
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_search_routes_only_prefiltered_misses():
+    index = _index([(150, 0), (300, 10), (-150, 0), (0, 150), (5000, 0)])
+    router = CountingRouter()
+    searcher = relevant.RelevantCrosswalkSearcher(index=index, router=router)
+
+    found = await searcher.search(LAT, LON, 14.0, 0.0)
+    assert [cw["id"] for cw in found] == [1, 2]
+    assert found[0]["duration"] == pytest.approx(150 / 14.0, rel=1e-3)
+    assert len(router.calls) == 1 and len(router.calls[0]) == 2
+
+    # Same road segment: served from the cache
+    assert [cw["id"] for cw in await searcher.search(LAT, LON, 14.0, 0.0)] == [1, 2]
+    assert len(router.calls) == 1
+
+    stats = searcher.stats()
+    assert stats["searches"] == 2
+    assert stats["routed"] == 2
+    assert stats["cache"]["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_durations_over_the_horizon_are_dropped():
+    index = _index([(150, 0), (330, 0)])
+    searcher = relevant.RelevantCrosswalkSearcher(index=index, router=CountingRouter())
+    # 330 m at 14 m/s is 23.6 s, 150 m is 10.7 s
+    assert [cw["id"] for cw in await searcher.search(LAT, LON, 14.0, 0.0, max_duration=20.0)] == [1]
+
+
+@pytest.mark.asyncio
+async def test_router_failure_falls_back_without_caching():
+    index = _index([(150, 0)])
+    searcher = relevant.RelevantCrosswalkSearcher(index=index, router=CountingRouter(fail=True))
+
+    found = await searcher.search(LAT, LON, 14.0, 0.0)
+    assert [cw["id"] for cw in found] == [1]
+    assert found[0]["duration"] == pytest.approx(150 * relevant.ROUTE_DETOUR / 14.0, rel=1e-3)
+    assert searcher.stats()["routing_errors"] == 1
+    assert searcher.cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stand_in_durations_follow_each_drivers_speed():
+    index = _index([(150, 0)])
+    searcher = relevant.RelevantCrosswalkSearcher(index=index, router=relevant.StraightLineRouter())
+
+    slow = await searcher.search(LAT, LON, 14.0, 0.0)
+    fast = await searcher.search(LAT, LON, 28.0, 0.0)
+    assert slow[0]["duration"] == pytest.approx(150 * relevant.ROUTE_DETOUR / 14.0, rel=1e-3)
+    assert fast[0]["duration"] == pytest.approx(150 * relevant.ROUTE_DETOUR / 28.0, rel=1e-3)
+    assert searcher.cache.stats()["entries"] == 0
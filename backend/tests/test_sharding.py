@@ -0,0 +1,345 @@
+import asyncio
+import importlib
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import backend.app.sharding as sharding
+MemoryClient = sharding.MemoryClient
+
+
+@pytest.fixture(autouse=True)
+def memory_state(monkeypatch):
+    db = MemoryClient()
+
+    async def fake_get_client():
+        return db
+
+    monkeypatch.setattr(sharding, "get_client", fake_get_client)
+    return db
+
+
+def test_hash_ring_is_deterministic_and_balanced():
+    ring = sharding.HashRing(["a", "b", "c"], vnodes=64)
+    again = sharding.HashRing(["c", "a", "b"], vnodes=64)
+    owners = [ring.owner(i) for i in range(3000)]
+
+    assert owners == [again.owner(i) for i in range(3000)]
+    for node in "abc":
+        assert 600 < owners.count(node) < 1400
+    assert ring.owner(17) == ring.owner("17")
+
+
+def test_hash_ring_moves_only_affected_keys():
+    ring = sharding.HashRing(["a", "b", "c"])
+    before = {i: ring.owner(i) for i in range(3000)}
+
+    ring.add("d")
+    after_add = {i: ring.owner(i) for i in range(3000)}
+    moved = [i for i in before if before[i] != after_add[i]]
+    assert all(after_add[i] == "d" for i in moved)
+    assert len(moved) < 1200
+
+    ring.remove("d")
+    assert {i: ring.owner(i) for i in range(3000)} == before
+    assert sharding.HashRing().owner(1) is None
+
+
+async def _settle(seconds=0.05):
+    await asyncio.sleep(seconds)
+
+
+def _routers(broker, *names, stores=None):
+    def state(name):
+        async def get_state():
+            return stores[name]
+        return get_state if stores is not None else None
+
+    return [
+        sharding.ShardRouter(broker, node_id=name, heartbeat_interval=0.01, node_ttl=0.1, vnodes=16, state=state(name))
+        for name in names
+    ]
+
+
+def _key_owned_by(router, node):
+    return next(i for i in range(1000) if router.owner(i) == node)
+
+
+@pytest.mark.asyncio
+async def test_routers_agree_and_forward_to_owner(monkeypatch):
+    broker = sharding.LocalBroker()
+    a, b = _routers(broker, "a", "b")
+    calls = []
+
+    async def handler(sid, data):
+        calls.append((sid, data))
+
+    monkeypatch.setitem(sharding._handlers, "ping", handler)
+    await a.start()
+    await b.start()
+    await _settle()
+
+    assert a.ring.nodes == b.ring.nodes == {"a", "b"}
+    key = _key_owned_by(a, "b")
+    assert b.is_local(key) and not a.is_local(key)
+    assert await a.forward("ping", key, "sid1", {"crosswalk_id": key}) is True
+    assert await b.forward("ping", key, "sid1", {"crosswalk_id": key}) is False
+    await _settle()
+
+    assert calls == [("sid1", {"crosswalk_id": key})]
+    assert a.stats()["forwarded"] == 1 and b.stats()["received"] == 1
+
+    await a.stop()
+    await b.stop()
+
+
+@pytest.mark.asyncio
+async def test_sharded_decorator_runs_locally_or_forwards(monkeypatch):
+    broker = sharding.LocalBroker()
+    a, b = _routers(broker, "a", "b")
+    calls = []
+
+    async def shard_test_event(sid, data):
+        calls.append(data.get("crosswalk_id"))
+
+    routed = sharding.sharded(shard_test_event)
+    await a.start()
+    await b.start()
+    await _settle()
+
+    monkeypatch.setattr(sharding, "_router", a)
+    local_key, remote_key = _key_owned_by(a, "a"), _key_owned_by(a, "b")
+    await routed("sid", {"crosswalk_id": local_key})
+    await routed("sid", {"crosswalk_id": remote_key})
+    await routed("sid", {})
+    await _settle()
+
+    # The local and id-less events run here, the remote one on b
+    assert sorted(calls, key=str) == sorted([local_key, remote_key, None], key=str)
+    assert a.stats()["forwarded"] == 1 and b.stats()["received"] == 1
+
+    await a.stop()
+    await b.stop()
+    sharding._handlers.pop("shard_test_event", None)
+
+
+@pytest.mark.asyncio
+async def test_sharded_batch_splits_entries_by_owner(monkeypatch):
+    broker = sharding.LocalBroker()
+    a, b = _routers(broker, "a", "b")
+    calls = []
+
+    async def shard_batch_test_event(sid, data):
+        calls.append((data["speed"], sorted(e["crosswalk_id"] for e in data["crosswalks"])))
+
+    routed = sharding.sharded_batch(shard_batch_test_event)
+    await a.start()
+    await b.start()
+    await _settle()
+
+    monkeypatch.setattr(sharding, "_router", a)
+    local_keys = [i for i in range(1000) if a.owner(i) == "a"][:2]
+    remote_keys = [i for i in range(1000) if a.owner(i) == "b"][:3]
+    entries = [{"crosswalk_id": k, "distance": 10.0} for k in local_keys + remote_keys]
+    await routed("sid", {"speed": 5.0, "crosswalks": entries})
+    await _settle()
+
+    # One event per owning node, each with only its own entries
+    assert sorted(calls) == sorted([(5.0, sorted(local_keys)), (5.0, sorted(remote_keys))])
+    assert a.stats()["forwarded"] == 1 and b.stats()["received"] == 1
+
+    await a.stop()
+    await b.stop()
+    sharding._handlers.pop("shard_batch_test_event", None)
+
+
+@pytest.mark.asyncio
+async def test_cluster_wide_runs_on_every_node(monkeypatch):
+    broker = sharding.LocalBroker()
+    a, b = _routers(broker, "a", "b")
+    calls = []
+
+    async def shard_test_cleanup(sid):
+        calls.append(sid)
+
+    run = sharding.cluster_wide(shard_test_cleanup)
+    await a.start()
+    await b.start()
+    monkeypatch.setattr(sharding, "_router", a)
+    await run("gone")
+    await _settle()
+
+    # Once locally on a, once on b via the broadcast
+    assert calls == ["gone", "gone"]
+
+    await a.stop()
+    await b.stop()
+    sharding._handlers.pop("shard_test_cleanup", None)
+
+
+async def _disconnect(db, sid):
+    # What the disconnect handler does on each node, against that node's store
+    state = importlib.import_module(sharding.touch_crosswalk.__module__)
+    for crosswalk_id in await state.get_memberships(db, sid):
+        cw = await state.get_crosswalk(db, crosswalk_id)
+        if cw and sid in (cw.get("peds") or []):
+            await state.remove_ped(db, crosswalk_id, sid)
+
+
+@pytest.mark.asyncio
+async def test_join_and_leave_hand_off_memory_state(monkeypatch):
+    prune = importlib.import_module("app.prune")
+    broker = sharding.LocalBroker()
+    stores = {"a": MemoryClient(), "b": MemoryClient()}
+    expired = []
+
+    async def evaluate(crosswalk_id, view):
+        # Stand-in for the TTL prune of handle_distance_based_notifications
+        for store in stores.values():
+            cw, _ = store._read("crosswalks", str(crosswalk_id))
+            if cw is not None and cw.get("drivers"):
+                cw["drivers"] = {}
+                expired.append(crosswalk_id)
+        return None
+
+    scheduler = prune.NotificationScheduler(evaluate)
+    monkeypatch.setattr(prune, "_scheduler", scheduler)
+    a, b = _routers(broker, "a", "b", stores=stores)
+    stale = time.time() - sharding.DRIVER_PRESENCE_TTL
+    for i in range(20):
+        stores["a"].import_document("crosswalks", str(i), {"peds": [f"p{i}"], "drivers": {f"d{i}": {"distance": 40.0, "ts": stale}}})
+        stores["a"].import_document("sessions", f"p{i}", {"role": "ped", "subscriptions": [i]})
+        stores["a"].import_document("sessions", f"d{i}", {"role": "driver", "subscriptions": [i]})
+
+    await a.start()
+    await _settle()
+    # a is alone and owns everything; b joins and receives its share
+    await b.start()
+    await _settle()
+
+    moved = [str(i) for i in range(20) if a.owner(i) == "b"]
+    assert moved
+    assert sorted(stores["a"].document_ids("crosswalks") + stores["b"].document_ids("crosswalks"), key=int) == [str(i) for i in range(20)]
+    assert sorted(stores["b"].document_ids("crosswalks"), key=int) == moved
+    assert stores["b"].export_document("crosswalks", moved[0])["peds"] == [f"p{moved[0]}"]
+    # Memberships moved with their crosswalk
+    assert stores["b"].export_document("sessions", f"p{moved[0]}") == {"role": "ped", "subscriptions": [int(moved[0])]}
+    assert stores["a"].export_document("sessions", f"p{moved[0]}")["subscriptions"] == []
+
+    # A ped disconnecting after the handoff is removed by the new owner
+    for store in stores.values():
+        await _disconnect(store, f"p{moved[0]}")
+    assert stores["b"].export_document("crosswalks", moved[0])["peds"] == []
+
+    # The handed-off drivers' expiry is scheduled on the new owner
+    runner = asyncio.get_running_loop().create_task(scheduler.run())
+    await _settle()
+    runner.cancel()
+    assert {str(i) for i in expired} >= set(moved)
+    assert stores["b"].export_document("crosswalks", moved[0])["drivers"] == {}
+
+    # b leaves gracefully and hands everything back
+    await b.stop()
+    await _settle()
+    assert a.ring.nodes == {"a"}
+    assert sorted(stores["a"].document_ids("crosswalks"), key=int) == [str(i) for i in range(20)]
+    assert stores["b"].document_ids("crosswalks") == []
+    assert stores["a"].export_document("sessions", f"p{moved[1]}")["subscriptions"] == [int(moved[1])]
+
+    await a.stop()
+
+
+@pytest.mark.asyncio
+async def test_silent_node_expires_from_ring():
+    broker = sharding.LocalBroker()
+    a, b = _routers(broker, "a", "b")
+    await a.start()
+    await b.start()
+    await _settle()
+    assert a.ring.nodes == {"a", "b"}
+
+    # Simulate a crash: b stops heartbeating without announcing it
+    for task in list(b._tasks):
+        task.cancel()
+    await asyncio.sleep(0.2)
+
+    assert a.ring.nodes == {"a"}
+    assert a.stats()["rebalances"] >= 2
+    await a.stop()
+
+
+async def _start_broker_process(port=0):
+    backend = Path(sharding.__file__).resolve().parents[1]
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "app.sharding", "broker", "--port", str(port),
+        cwd=str(backend), stdout=asyncio.subprocess.PIPE,
+    )
+    line = (await asyncio.wait_for(proc.stdout.readline(), 10)).decode()
+    return proc, int(line.rsplit(":", 1)[1])
+
+
+@pytest.mark.asyncio
+async def test_routers_over_broker_process(monkeypatch):
+    # The stand-in broker runs as its own process, as in a local multi-node setup
+    proc, port = await _start_broker_process()
+    try:
+        brokers = [sharding.create_broker(f"tcp://127.0.0.1:{port}") for _ in range(2)]
+        a, b = sharding.ShardRouter(brokers[0], node_id="a", heartbeat_interval=0.02, node_ttl=1, vnodes=16), \
+            sharding.ShardRouter(brokers[1], node_id="b", heartbeat_interval=0.02, node_ttl=1, vnodes=16)
+        got = asyncio.get_running_loop().create_future()
+
+        async def handler(sid, data):
+            got.set_result((sid, data))
+
+        monkeypatch.setitem(sharding._handlers, "ping", handler)
+        await a.start()
+        await b.start()
+        await _settle(0.2)
+
+        assert a.ring.nodes == b.ring.nodes == {"a", "b"}
+        key = _key_owned_by(a, "b")
+        assert await a.forward("ping", key, "sid9", {"crosswalk_id": key})
+        assert await asyncio.wait_for(got, 5) == ("sid9", {"crosswalk_id": key})
+
+        await a.stop()
+        await b.stop()
+        for broker in brokers:
+            await broker.close()
+    finally:
+        proc.terminate()
+        await proc.wait()
+
+
+@pytest.mark.asyncio
+async def test_tcp_broker_reconnects_and_resubscribes():
+    proc, port = await _start_broker_process()
+    subscriber = sharding.TcpBroker("127.0.0.1", port, reconnect_delay=0.02, reconnect_delay_max=0.1)
+    publisher = sharding.TcpBroker("127.0.0.1", port, reconnect_delay=0.02, reconnect_delay_max=0.1)
+    try:
+        sub = await subscriber.subscribe("ch")
+        await publisher.publish("ch", {"n": 1})
+        assert await asyncio.wait_for(sub.__anext__(), 5) == {"n": 1}
+
+        # The broker restarts on the same port; clients retry until it is back
+        proc.terminate()
+        await proc.wait()
+        await asyncio.sleep(0.1)
+        proc, _ = await _start_broker_process(port)
+        # Messages published before both ends are back are lost, so keep publishing
+        received = None
+        for _ in range(50):
+            try:
+                await publisher.publish("ch", {"n": 2})
+                received = await asyncio.wait_for(sub.__anext__(), 0.1)
+                break
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(0.02)
+        assert received == {"n": 2}
+        assert subscriber.reconnects and publisher.reconnects
+    finally:
+        await subscriber.close()
+        await publisher.close()
+        proc.terminate()
+        await proc.wait()
@@ -1,4 +1,5 @@
 import asyncio
+import importlib
 import pytest
 
 import backend.app.state as state
@@ -23,9 +24,10 @@ class NotFound(Exception):
 
 
 class FakeDocRef:
-    def __init__(self, store, doc_id):
+    def __init__(self, store, doc_id, collection=""):
         self.store = store
         self.id = str(doc_id)
+        self.path = f"{collection}/{self.id}"
 
     async def get(self, transaction=None):
         return self
@@ -89,7 +91,7 @@ class FakeCollection:
         self._sub = db._data.setdefault(name, {})
 
     def document(self, doc_id):
-        return FakeDocRef(self._sub, doc_id)
+        return FakeDocRef(self._sub, doc_id, self.name)
 
     def select(self, fields):
         return self
@@ -98,10 +100,29 @@ class FakeCollection:
         return [FakeDocRef(self._sub, k) for k in list(self._sub.keys())]
 
 
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+
+    def update(self, ref, data, option=None):
+        self.updates.append((ref, data))
+
+    async def commit(self):
+        self.db.batches.append([(ref.path, dict(data)) for ref, data in self.updates])
+        for ref, data in self.updates:
+            await ref.update(data)
+        return []
+
+
 class FakeDB:
     def __init__(self):
         self._data = {}
         self._runtime = {}
+        self.batches = []
+
+    def batch(self):
+        return FakeBatch(self)
 
     def collection(self, name):
         return FakeCollection(self, name)
@@ -198,9 +219,78 @@ async def test_get_client_singleton(monkeypatch):
         def __init__(self, database=None):
             self.database = database
 
-    monkeypatch.setattr(state, "AsyncClient", StubClient)
+    firestore_pool = importlib.import_module(state.create_pool.__module__)
+    monkeypatch.setattr(firestore_pool, "PooledAsyncClient", StubClient)
     monkeypatch.setattr(state, "_client", None)
+    monkeypatch.setattr(state, "_update_buffer", None)
 
     c1 = await state.get_client()
     c2 = await state.get_client()
     assert isinstance(c1, StubClient) and c1 is c2
+    assert c1.database == state.FIRESTORE_DATABASE
+    assert state.pool_stats()["clients"] == 1
+    assert state.update_buffer_stats()["buffered"] == 0
+
+
+@pytest.mark.asyncio
+async def test_get_client_memory_backends(monkeypatch):
+    class StubClient:
+        def __init__(self, database=None):
+            self.database = database
+
+    monkeypatch.setattr(state, "AsyncClient", StubClient)
+
+    assert isinstance(state._create_client("memory"), state.MemoryClient)
+    wb = state._create_client("write_behind")
+    assert isinstance(wb, state.MemoryClient) and wb._persister is not None
+    with pytest.raises(ValueError):
+        state._create_client("redis")
+
+    monkeypatch.setattr(state, "_client", wb)
+    await state.close_client()
+
+
+def test_crosswalk_generations_are_bounded(monkeypatch):
+    monkeypatch.setattr(state, "_crosswalk_generations", state.OrderedDict())
+    monkeypatch.setattr(state, "CROSSWALK_GENERATIONS_MAX", 3)
+
+    for crosswalk_id in (1, 2, 3, 1, 4):
+        state.touch_crosswalk(crosswalk_id)
+
+    # 2 was written least recently and made room for 4
+    assert state.crosswalk_generations() == {"3": 1, "1": 2, "4": 1}
+    state.forget_crosswalk(1)
+    assert state.crosswalk_generation(1) == 0 and set(state.crosswalk_generations()) == {"3", "4"}
+
+
+@pytest.mark.asyncio
+async def test_driver_updates_to_one_crosswalk_are_batched(monkeypatch):
+    db = FakeDB()
+    await state.add_driver(db, 1, "d1", distance=50.0, speed=10.0)
+    await state.add_driver(db, 1, "d2", distance=60.0, speed=10.0)
+    pool = state.FirestorePool(lambda: db)
+    buffer = state.FieldUpdateBuffer(pool.client, interval=0.01)
+    monkeypatch.setattr(state, "_client", pool)
+    monkeypatch.setattr(state, "_update_buffer", buffer)
+
+    await asyncio.gather(
+        *(state.update_driver(db, 1, "d1", distance=50.0 - i, speed=10.0) for i in range(10)),
+        state.update_driver(db, 1, "d2", distance=55.0, speed=None),
+    )
+
+    assert len(db.batches) == 1 and len(db.batches[0]) == 1
+    path, fields = db.batches[0][0]
+    assert path == "crosswalks/1"
+    assert fields["drivers.d1.distance"] == 41.0 and fields["drivers.d2.distance"] == 55.0
+    cw = await state.get_crosswalk(db, 1)
+    assert cw["drivers"]["d1"]["distance"] == 41.0 and cw["drivers"]["d2"]["speed"] is None
+    stats = state.update_buffer_stats()
+    assert (stats["buffered"], stats["merged"], stats["batches"]) == (11, 10, 1)
+
+    # Evaluation writes without a precondition join the same merged write
+    await asyncio.gather(
+        state.update_driver(db, 1, "d1", distance=30.0, speed=10.0),
+        state.update_crosswalk(db, 1, {"last_broadcast.presence": {"driver_count": 2}}),
+    )
+    assert len(db.batches) == 2 and len(db.batches[1]) == 1
+    await state.close_client()
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+import backend.app.update_buffer as update_buffer
+
+
+class FakeRef:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    async def update(self, fields, option=None):
+        self.client.writes.append((self.path, dict(fields), option))
+        if self.path in self.client.missing:
+            raise NotFound(self.path)
+        if option is not None and option != self.client.update_times.get(self.path):
+            raise FailedPrecondition(self.path)
+        self.client.update_times[self.path] = self.client.update_times.get(self.path, 0) + 1
+        return self.client.update_times[self.path]
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.updates = []
+
+    def update(self, ref, fields):
+        self.updates.append((ref, dict(fields)))
+
+    async def commit(self):
+        self.client.batches.append([(ref.path, fields) for ref, fields in self.updates])
+        if any(ref.path in self.client.missing for ref, _ in self.updates):
+            raise NotFound("batch")
+        return [await ref.update(fields) for ref, fields in self.updates]
+
+
+class FakeClient:
+    def __init__(self):
+        self.batches = []
+        self.writes = []
+        self.missing = set()
+        self.update_times = {}
+
+    def ref(self, path):
+        return FakeRef(self, path)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def test_merge_field_keeps_paths_disjoint():
+    fields = {}
+    update_buffer.merge_field(fields, "drivers.d1.distance", 10.0)
+    update_buffer.merge_field(fields, "drivers.d1.ts", 1.0)
+    update_buffer.merge_field(fields, "drivers.d1.distance", 8.0)
+    assert fields == {"drivers.d1.distance": 8.0, "drivers.d1.ts": 1.0}
+
+    # A deleted driver supersedes its pending fields
+    update_buffer.merge_field(fields, "drivers.d1", DELETE_FIELD)
+    assert fields == {"drivers.d1": DELETE_FIELD}
+
+    # Fields written after the delete recreate the entry with just those fields
+    update_buffer.merge_field(fields, "drivers.d1.distance", 5.0)
+    assert fields == {"drivers.d1": {"distance": 5.0}}
+    update_buffer.merge_field(fields, "drivers.d1.speed", DELETE_FIELD)
+    assert fields == {"drivers.d1": {"distance": 5.0}}
+
+
+@pytest.mark.asyncio
+async def test_updates_merge_per_document_into_one_batch():
+    client = FakeClient()
+    buffer = update_buffer.FieldUpdateBuffer(lambda: client, interval=0.01)
+
+    results = await asyncio.gather(
+        buffer.update(client.ref("crosswalks/1"), {"drivers.d1.distance": 10.0}),
+        buffer.update(client.ref("crosswalks/1"), {"drivers.d1.distance": 9.0, "drivers.d2.distance": 20.0}),
+        buffer.update(client.ref("crosswalks/2"), {"drivers.d3.distance": 30.0}),
+    )
+
+    assert client.batches == [[
+        ("crosswalks/1", {"drivers.d1.distance": 9.0, "drivers.d2.distance": 20.0}),
+        ("crosswalks/2", {"drivers.d3.distance": 30.0}),
+    ]]
+    assert results == [1, 1, 1]
+    assert buffer.stats()["merged"] == 1
+
+
+@pytest.mark.asyncio
+async def test_size_cap_flushes_before_the_interval():
+    client = FakeClient()
+    buffer = update_buffer.FieldUpdateBuffer(lambda: client, interval=10.0, max_pending=2)
+
+    await asyncio.wait_for(asyncio.gather(
+        buffer.update(client.ref("crosswalks/1"), {"drivers.d1.distance": 1.0}),
+        buffer.update(client.ref("crosswalks/2"), {"drivers.d1.distance": 2.0}),
+    ), 1.0)
+    assert len(client.batches) == 1
+
+
+@pytest.mark.asyncio
+async def test_conditional_updates_are_checked_before_the_merged_writes():
+    client = FakeClient()
+    client.update_times["crosswalks/1"] = 5
+    buffer = update_buffer.FieldUpdateBuffer(lambda: client, interval=0.01)
+
+    driver, evaluated, stale = await asyncio.gather(
+        buffer.update(client.ref("crosswalks/1"), {"drivers.d1.distance": 9.0}),
+        buffer.update(client.ref("crosswalks/1"), {"last_broadcast.presence": {"driver_count": 1}}, option=5),
+        buffer.update(client.ref("crosswalks/1"), {"last_broadcast.presence": {}}, option=4),
+        return_exceptions=True,
+    )
+    # The evaluation read the document before the pending driver update was written
+    assert evaluated == 6 and driver == 7
+    assert isinstance(stale, FailedPrecondition)
+    assert [(path, option) for path, _, option in client.writes] == [
+        ("crosswalks/1", 5), ("crosswalks/1", 4), ("crosswalks/1", None),
+    ]
+    assert buffer.stats()["failed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_only_fails_the_failing_documents():
+    client = FakeClient()
+    client.missing.add("crosswalks/9")
+    buffer = update_buffer.FieldUpdateBuffer(lambda: client, interval=0.01)
+
+    ok, missing = await asyncio.gather(
+        buffer.update(client.ref("crosswalks/1"), {"drivers.d1.distance": 1.0}),
+        buffer.update(client.ref("crosswalks/9"), {"drivers.d1.distance": 1.0}),
+        return_exceptions=True,
+    )
+    assert ok == 1
+    assert isinstance(missing, NotFound)
+    assert buffer.stats()["failed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_close_writes_pending_updates():
+    client = FakeClient()
+    buffer = update_buffer.FieldUpdateBuffer(lambda: client, interval=10.0)
+
+    pending = asyncio.ensure_future(buffer.update(client.ref("crosswalks/1"), {"drivers.d1.distance": 1.0}))
+    await asyncio.sleep(0)
+    await buffer.close()
+    assert await pending == 1
+    assert buffer.stats()["pending"] == 0
@@ -150,7 +150,7 @@ describe('useDriverCommunicator extra cases', () => {
     expect(socket.emit).toHaveBeenCalledWith('driver_leave', { crosswalk_id: 1 })
   })
 
-  it('emits periodic driver_update with distance and speed payload', () => {
+  it('emits one periodic driver_update_batch with distances and speed', () => {
     const socket = createSocketMock()
     const setAlert = vi.fn()
 
@@ -169,10 +169,10 @@ describe('useDriverCommunicator extra cases', () => {
       vi.advanceTimersByTime(1000)
     })
 
-    expect(socket.emit).toHaveBeenCalledWith(
-      'driver_update',
-      expect.objectContaining({ crosswalk_id: 1, distance: 12, speed: null })
-    )
+    expect(socket.emit).toHaveBeenCalledWith('driver_update_batch', {
+      crosswalks: [{ crosswalk_id: 1, distance: 12 }],
+      speed: null,
+    })
   })
 
   it('presence ignored while there are active criticals', () => {
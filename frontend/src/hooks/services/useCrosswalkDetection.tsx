@@ -1,5 +1,6 @@
 import React, { SetStateAction, useEffect, useRef } from "react";
 import { Socket } from "socket.io-client";
+import { dataUrlToBytes } from "@/utils/frameEncoding";
 
 
 
@@ -63,7 +64,7 @@ const useCrosswalkDetection = (
                 intervalId.current = window.setInterval(() => {
 
                     if (imageRef.current != "") {
-                        socket.emit("predict", user_guid, imageRef.current, allowImageStorage);
+                        socket.emit("predict", user_guid, dataUrlToBytes(imageRef.current), allowImageStorage);
                     }
                 }, 1000 / 2);
             }
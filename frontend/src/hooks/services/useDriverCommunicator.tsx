@@ -139,21 +139,23 @@ const useDriverCommuncicator = (
         if (joinedIds.current.size > 0) {
             if (!intervalId.current) {
                 intervalId.current = setInterval(() => {
+                        // One event for every joined crosswalk instead of one driver_update each
+                        const crosswalks: { crosswalk_id: number; distance?: number }[] = [];
+                        let speed: number | null = null;
                         for (const id of joinedIds.current) {
                             const cw = (dangeredRef.current ?? []).find(c => c.id === id);
                             const distance = cw?.distance;
-                            const payload: { crosswalk_id: number; distance?: number; speed?: number | null } = { crosswalk_id: id };
-                            if (typeof distance === 'number' && isFinite(distance)) payload.distance = distance;
-                            if (cw && typeof cw.speed === 'number' && isFinite(cw.speed)) {
-                                payload.speed = cw.speed;
-                            } else {
-                                payload.speed = null;
-                            }
-                            try {
-                                socket.emit('driver_update', payload);
-                            } catch {
-                                // ignore
+                            const entry: { crosswalk_id: number; distance?: number } = { crosswalk_id: id };
+                            if (typeof distance === 'number' && isFinite(distance)) entry.distance = distance;
+                            if (speed === null && cw && typeof cw.speed === 'number' && isFinite(cw.speed)) {
+                                speed = cw.speed;
                             }
+                            crosswalks.push(entry);
+                        }
+                        try {
+                            socket.emit('driver_update_batch', { crosswalks, speed });
+                        } catch {
+                            // ignore
                         }
                 }, UPDATE_INTERVAL_MS);
             }
@@ -0,0 +1,11 @@
+// Converts a canvas data URL into the raw encoded image bytes, so frames can be
+// sent to the backend as a binary Socket.IO attachment instead of base64 text.
+export function dataUrlToBytes(dataUrl: string): Uint8Array {
+    const base64 = dataUrl.slice(dataUrl.indexOf(',') + 1);
+    const binary = atob(base64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}